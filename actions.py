@@ -1,5 +1,11 @@
 import queue
 import threading
+import logging
+import socket
+import time
+import collections
+
+log = logging.getLogger('tyggbot')
 
 
 class Action:
@@ -16,37 +22,241 @@ class Action:
         self.func(*self.args, **self.kwargs)
 
 
-class ActionQueue:
+class ActionLaneStats:
     def __init__(self):
-        self.queue = queue.Queue()
+        self.num_added = 0
+        self.num_dropped = 0
+        self.num_run = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run_time = 0.0
+
+    def __str__(self):
+        avg_wait = self.total_wait / self.num_run if self.num_run > 0 else 0
+        avg_run_time = self.total_run_time / self.num_run if self.num_run > 0 else 0
+        return 'added={0} dropped={1} run={2} avg_wait={3:.0f}ms max_wait={4:.0f}ms avg_run={5:.0f}ms'.format(
+                self.num_added, self.num_dropped, self.num_run, avg_wait * 1000, self.max_wait * 1000, avg_run_time * 1000)
+
+
+class ActionQueue:
+    """
+    Runs actions on a pool of worker threads.
 
-    """ Starts a thread which will continuously check the queue for actions. """
+    Actions are added to one of the lanes below. Workers always take the
+    oldest action from the most important lane that has any actions.
+    Each lane holds at most `max_backlog' actions. When a lane is full,
+    the overflow policy decides what happens: 'drop_oldest' drops the
+    oldest action in the lane to make room, 'reject' drops the new action.
+
+    Several actions can run at the same time, so they must not change any
+    state the main thread uses (users, emotes, the connections). Pass the
+    results to the MainThreadQueue instead, like the *_stage1 methods of
+    TyggBot do.
+    """
+
+    lanes = ('high', 'normal', 'low')
+
+    def __init__(self, num_workers=1, max_backlog=1000, overflow='drop_oldest'):
+        if overflow not in ('drop_oldest', 'reject'):
+            raise ValueError('Unknown overflow policy: {0}'.format(overflow))
+
+        self.num_workers = num_workers
+        self.max_backlog = max_backlog
+        self.overflow = overflow
+
+        self.cond = threading.Condition()
+        self.queues = collections.OrderedDict((lane, collections.deque()) for lane in self.lanes)
+        self.lane_stats = dict((lane, ActionLaneStats()) for lane in self.lanes)
+
+    """ Starts the worker threads which will continuously check the queue for actions. """
     def start(self):
-        t = threading.Thread(target=self._action_parser)
-        t.daemon = True
-        t.start()
+        for i in range(0, self.num_workers):
+            t = threading.Thread(target=self._action_parser, name='ActionWorker-{0}'.format(i))
+            t.daemon = True
+            t.start()
 
     """ Start a loop which waits and things to be added into the queue.
     Note: This is a blocking method, and should be run in a separate thread
     This method is started automatically if ActionQueue is declared threaded. """
     def _action_parser(self):
         while True:
-            action = self.queue.get()
+            lane, action = self._get()
+            self._run(lane, action)
+
+    def _get(self, block=True):
+        with self.cond:
+            while True:
+                for lane, lane_queue in self.queues.items():
+                    if len(lane_queue) > 0:
+                        return lane, lane_queue.popleft()
+
+                if not block:
+                    return None, None
+
+                self.cond.wait()
+
+    def _run(self, lane, action):
+        start = time.time()
+        try:
             action.run()
+        except:
+            log.exception('Unhandled exception in action {0}'.format(action.func))
+
+        stats = self.lane_stats[lane]
+        with self.cond:
+            wait = start - action.queued_at
+            stats.num_run += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            stats.total_run_time += time.time() - start
 
     """ Run a single action in the queue if the queue is not empty. """
     def parse_action(self):
-        if not self.queue.empty():
-            action = self.queue.get()
-            action.run()
+        lane, action = self._get(block=False)
+        if action is not None:
+            self._run(lane, action)
 
-    def add(self, f, args=[], kwargs={}):
+    def add(self, f, args=[], kwargs={}, lane='normal'):
+        """
+        Add an action to the given lane.
+        Returns False if the action was dropped because the lane is full.
+        """
         action = Action()
         action.func = f
 
         action.args = args
         action.kwargs = kwargs
-        self._add(action)
+        return self._add(action, lane)
+
+    def _add(self, action, lane='normal'):
+        action.queued_at = time.time()
+        with self.cond:
+            lane_queue = self.queues[lane]
+            stats = self.lane_stats[lane]
+            stats.num_added += 1
+
+            if len(lane_queue) >= self.max_backlog:
+                stats.num_dropped += 1
+                if self.overflow == 'reject':
+                    log.warning('Action queue lane {0} is full, dropping {1}'.format(lane, action.func))
+                    return False
+
+                dropped = lane_queue.popleft()
+                log.warning('Action queue lane {0} is full, dropping {1}'.format(lane, dropped.func))
+
+            lane_queue.append(action)
+            self.cond.notify()
+
+        return True
+
+    def stats(self):
+        with self.cond:
+            data = collections.OrderedDict()
+            for lane, lane_queue in self.queues.items():
+                data[lane] = 'depth={0} {1}'.format(len(lane_queue), self.lane_stats[lane])
+            return data
+
 
-    def _add(self, action):
+class MainThreadQueue:
+    """
+    Queue of actions that are run on the reactor's thread.
+
+    The queue registers itself with the reactor as a pseudo-connection, with
+    one end of a socket pair as its socket. Adding an action writes a byte to
+    the other end, which wakes the reactor's select() up right away.
+    Each wakeup runs queued actions for up to `time_budget' seconds.
+    """
+
+    def __init__(self, reactor, time_budget=0.05):
+        self.queue = queue.Queue()
+        self.reactor = reactor
+        self.time_budget = time_budget
+
+        self.socket, self.wakeup_socket = socket.socketpair()
+        self.socket.setblocking(False)
+        self.wakeup_socket.setblocking(False)
+
+        self.num_actions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+
+        with self.reactor.mutex:
+            self.reactor.connections.append(self)
+
+    def add(self, f, args=[], kwargs={}):
+        """ Add an action to be run on the reactor's thread """
+        action = Action()
+        action.func = f
+
+        action.args = args
+        action.kwargs = kwargs
+        action.queued_at = time.time()
         self.queue.put(action)
+        self.wakeup()
+        return True
+
+    def wakeup(self):
+        try:
+            self.wakeup_socket.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The socket buffer is full, so a wakeup is already pending
+            pass
+
+    def process_data(self):
+        """ Called by the reactor when our socket is readable """
+        try:
+            while self.socket.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        self.parse_actions()
+
+    def disconnect(self, message=''):
+        """ Called by the reactor's disconnect_all """
+        pass
+
+    def parse_action(self):
+        self.parse_actions(max_actions=1)
+
+    def parse_actions(self, max_actions=None):
+        """ Run queued actions until the queue is empty or we run out of time """
+        start = time.time()
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        num_run = 0
+
+        while max_actions is None or num_run < max_actions:
+            try:
+                action = self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+            now = time.time()
+            wait = now - action.queued_at
+            self.num_actions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            try:
+                action.run()
+            except:
+                log.exception('Unhandled exception in action {0}'.format(action.func))
+            num_run += 1
+
+            if time.time() - start >= self.time_budget:
+                break
+
+        if not self.queue.empty():
+            # Let the reactor handle other connections before we continue
+            self.wakeup()
+
+    def stats(self):
+        avg_wait = self.total_wait / self.num_actions if self.num_actions > 0 else 0
+        return collections.OrderedDict([
+            ('depth', self.queue.qsize()),
+            ('max_depth', self.max_depth),
+            ('actions', self.num_actions),
+            ('avg_wait', '{0:.1f}ms'.format(avg_wait * 1000)),
+            ('max_wait', '{0:.1f}ms'.format(self.max_wait * 1000)),
+            ])
@@ -1,8 +1,16 @@
 import urllib.parse
-import urllib.request
 import json
 import logging
-import requests
+import threading
+import time
+import os
+import re
+import bisect
+import hashlib
+import posixpath
+import collections
+
+import httpclient
 
 log = logging.getLogger('tyggbot')
 
@@ -11,13 +19,15 @@ class APIBase:
     @staticmethod
     def _get(url, headers={}):
         try:
-            req = urllib.request.Request(url, None, headers)
-            response = urllib.request.urlopen(req)
+            response = httpclient.get(url, headers=headers)
         except Exception as e:
             return None
 
+        if response.status_code >= 400:
+            return None
+
         try:
-            return response.read().decode('utf-8')
+            return response.content.decode('utf-8')
         except Exception as e:
             log.error(e)
             return None
@@ -59,14 +69,18 @@ class APIBase:
 
     def post(self, endpoints=[], parameters={}, data={}):
         try:
-            req = urllib.request.Request(self.get_url(endpoints, parameters), urllib.parse.urlencode(data).encode('utf-8'), self.headers)
-            response = urllib.request.urlopen(req)
+            # POST requests are not retried, since they might not be idempotent
+            response = httpclient.post(self.get_url(endpoints, parameters), data=urllib.parse.urlencode(data).encode('utf-8'), headers=self.headers, retries=0)
         except Exception as e:
             log.error(e)
             return None
 
+        if response.status_code >= 400:
+            log.error('HTTP error {0} while posting to {1}'.format(response.status_code, self.get_url(endpoints, parameters)))
+            return None
+
         try:
-            return response.read().decode('utf-8')
+            return response.content.decode('utf-8')
         except Exception as e:
             log.error(e)
             return None
@@ -124,19 +138,297 @@ class TwitchAPI(APIBase):
             self.headers['Authorization'] = 'OAuth ' + oauth
 
 
+class SafeBrowsingLookup:
+    def __init__(self, url):
+        self.url = url
+        self.bad = None  # None until we have a verdict, and if the lookup failed
+        self.done = threading.Event()
+
+
+class SafeBrowsingHashPrefixes:
+    """ A locally synced list of Safe Browsing hash prefixes.
+
+    The file contains one hex-encoded SHA256 hash prefix per line, and can be
+    updated with scripts/update_safebrowsing.py. A URL with no matching prefix
+    is not on any of the lists, so it doesn't have to be looked up remotely.
+    """
+    reload_interval = 60  # How often we check if the file has been updated
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.last_reload = 0
+        self.prefixes = None  # prefixes[length] = sorted list of prefixes with that length, None until the file has been loaded
+        self.reload()
+
+    def reload(self):
+        self.last_reload = time.time()
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            log.error('Safe Browsing prefix file {0} not found'.format(self.path))
+            return
+
+        if mtime == self.mtime:
+            return
+
+        prefixes = {}
+        num_bad_lines = 0
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line) == 0 or line.startswith('#'):
+                        continue
+                    try:
+                        prefix = bytes.fromhex(line)
+                    except ValueError:
+                        num_bad_lines += 1
+                        continue
+                    prefixes.setdefault(len(prefix), []).append(prefix)
+        except (OSError, UnicodeDecodeError):
+            log.exception('Unable to read Safe Browsing prefix file {0}'.format(self.path))
+            return
+
+        if num_bad_lines > 0:
+            log.warning('Skipped {0} lines in {1} that are not hex-encoded hash prefixes'.format(num_bad_lines, self.path))
+
+        for prefix_list in prefixes.values():
+            prefix_list.sort()
+
+        self.prefixes = prefixes
+        self.mtime = mtime
+        log.info('Loaded {0} Safe Browsing hash prefixes'.format(sum(len(l) for l in prefixes.values())))
+
+    def matches(self, url):
+        """ Returns True if any of the url's host/path expressions has a hash matching a prefix in the list.
+        Until a prefix list has been loaded, every url matches, so every url is looked up remotely. """
+        if time.time() - self.last_reload > self.reload_interval:
+            self.reload()
+
+        if self.prefixes is None:
+            return True
+
+        for expression in SafeBrowsingHashPrefixes.get_expressions(url):
+            full_hash = hashlib.sha256(expression.encode('utf-8')).digest()
+            for length, prefix_list in self.prefixes.items():
+                prefix = full_hash[:length]
+                i = bisect.bisect_left(prefix_list, prefix)
+                if i < len(prefix_list) and prefix_list[i] == prefix:
+                    return True
+
+        return False
+
+    @staticmethod
+    def get_expressions(url):
+        """ Returns the host suffix/path prefix expressions for url, as described in the Safe Browsing API documentation. """
+        if '://' not in url:
+            url = 'http://' + url
+        parsed = urllib.parse.urlsplit(url)
+
+        host = parsed.hostname or ''
+        host = re.sub(r'\.+', '.', host.strip('.')).lower()
+        path = posixpath.normpath('/' + parsed.path.lstrip('/'))
+        if parsed.path.endswith('/') and not path.endswith('/'):
+            path += '/'
+        query = parsed.query
+
+        if re.match(r'^\d+\.\d+\.\d+\.\d+$', host):
+            hosts = [host]
+        else:
+            # The exact host, and up to 4 hosts formed from the last 5 components (skipping the TLD)
+            labels = host.split('.')[-5:]
+            hosts = [host] + ['.'.join(labels[i:]) for i in range(0, len(labels) - 1)]
+            hosts = list(collections.OrderedDict.fromkeys(hosts))[:5]
+
+        paths = []
+        if query:
+            paths.append(path + '?' + query)
+        paths.append(path)
+        parts = path.split('/')[1:-1]
+        prefix = '/'
+        paths.append(prefix)
+        for part in parts[:3]:
+            prefix += part + '/'
+            paths.append(prefix)
+        paths = list(collections.OrderedDict.fromkeys(paths))
+
+        return [h + p for h in hosts for p in paths]
+
+
 class SafeBrowsingAPI:
-    def __init__(self, apikey, appname, appvers):
+    """ Client for the Safe Browsing Lookup API.
+
+    URLs that are checked at the same time (e.g. by several sublink checks)
+    are sent to the API in one batched request, and verdicts are cached.
+    If a local hash prefix list is available, URLs that don't match any
+    prefix are cleared without asking the API at all.
+    base_url can be pointed at a local stand-in server for testing.
+    """
+    default_base_url = 'https://sb-ssl.google.com/safebrowsing/api/lookup'
+    max_batch_size = 500  # The maximum number of URLs in one request allowed by the API
+    batch_delay = 0.05  # Time to wait for more URLs before sending a request
+    cache_ttl = 30 * 60
+    lookup_timeout = 15  # How long check_urls waits for a verdict before treating the url as unknown
+
+    def __init__(self, apikey, appname, appvers, base_url=None, prefix_file=None):
         self.apikey = apikey
         self.appname = appname
         self.appvers = appvers
+        self.base_url = base_url or self.default_base_url
+
+        self.timeout = (2, 3)
+
+        self.lock = threading.Lock()
+        self.cache = {}  # cache[url] = (bad, expires)
+        self.pending = []
+        self.pending_cond = threading.Condition(self.lock)
+
+        self.num_requests = 0
+        self.num_failed_requests = 0
+        self.num_lookups = 0
+        self.num_failed_lookups = 0
+        self.num_timeouts = 0
+        self.num_cleared_locally = 0
+
+        self.hash_prefixes = SafeBrowsingHashPrefixes(prefix_file) if prefix_file else None
+
+        t = threading.Thread(target=self._batch_sender, name='SafeBrowsingAPI')
+        t.daemon = True
+        t.start()
         return
 
     def check_url(self, url):
-        base_url = 'https://sb-ssl.google.com/safebrowsing/api/lookup?client=' + self.appname + '&key=' + self.apikey + '&appver=' + self.appvers + '&pver=3.1&url='
-        url2 = base_url + urllib.parse.quote(url, '')
-        r = requests.get(url2)
+        """ Returns True if the url is malware or phishing. """
+        return self.check_urls([url])[url]
+
+    def check_urls(self, urls):
+        """ Returns a dict with a bool for every url, True meaning the url is malware or phishing. """
+        results = {}
+        lookups = []
+        now = time.time()
+
+        with self.lock:
+            for url in urls:
+                cached = self.cache.get(url)
+                if cached is not None and cached[1] > now:
+                    results[url] = cached[0]
+                elif self.hash_prefixes is not None and not self.hash_prefixes.matches(url):
+                    # Not on any list, no need to ask the API
+                    results[url] = False
+                    self.num_cleared_locally += 1
+                else:
+                    lookup = SafeBrowsingLookup(url)
+                    self.pending.append(lookup)
+                    lookups.append(lookup)
+
+            if len(lookups) > 0:
+                self.pending_cond.notify()
+
+        # A url we couldn't get a verdict for is treated as not bad, the failure is logged and counted in stats()
+        deadline = time.time() + self.lookup_timeout
+        for lookup in lookups:
+            if lookup.done.wait(max(0, deadline - time.time())):
+                results[lookup.url] = lookup.bad is True
+            else:
+                log.warning('Timed out waiting for the Safe Browsing API to check {0}'.format(lookup.url))
+                results[lookup.url] = False
+                with self.lock:
+                    self.num_timeouts += 1
+
+        return results
+
+    def stats(self):
+        with self.lock:
+            data = collections.OrderedDict()
+            data['cache_size'] = len(self.cache)
+            data['pending'] = len(self.pending)
+            data['cleared_locally'] = self.num_cleared_locally
+            data['requests'] = self.num_requests
+            data['failed_requests'] = self.num_failed_requests
+            data['lookups'] = self.num_lookups
+            data['failed_lookups'] = self.num_failed_lookups
+            data['timeouts'] = self.num_timeouts
+            return data
+
+    def _batch_sender(self):
+        while True:
+            try:
+                self._send_batch()
+            except:
+                log.exception('Unhandled exception in the Safe Browsing batch sender')
+
+    def _send_batch(self):
+        with self.lock:
+            while len(self.pending) == 0:
+                self.pending_cond.wait()
+
+        # Give other checks a moment to add their URLs to the batch
+        time.sleep(self.batch_delay)
+
+        with self.lock:
+            batch = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+
+        try:
+            verdicts = self._lookup([lookup.url for lookup in batch])
+
+            num_failed = len([bad for bad in verdicts if bad is None])
+            if num_failed > 0:
+                log.warning('The Safe Browsing API gave no verdict for {0}/{1} urls, they are not cached'.format(num_failed, len(batch)))
+
+            expires = time.time() + self.cache_ttl
+            with self.lock:
+                self.num_requests += 1
+                self.num_lookups += len(batch)
+                if num_failed > 0:
+                    self.num_failed_requests += 1
+                    self.num_failed_lookups += num_failed
+
+                for lookup, bad in zip(batch, verdicts):
+                    lookup.bad = bad
+                    if bad is not None:
+                        self.cache[lookup.url] = (bad, expires)
+
+                # Drop expired verdicts
+                if len(self.cache) > 10000:
+                    now = time.time()
+                    self.cache = {url: v for url, v in self.cache.items() if v[1] > now}
+        except:
+            with self.lock:
+                self.num_requests += 1
+                self.num_lookups += len(batch)
+                self.num_failed_requests += 1
+                self.num_failed_lookups += len(batch)
+            raise
+        finally:
+            # Never leave a check waiting, even if the lookup failed
+            for lookup in batch:
+                lookup.done.set()
+
+    def _lookup(self, urls):
+        """ Look up a batch of URLs. Returns a list of True/False verdicts, or None for URLs we couldn't look up. """
+        parameters = {
+                'client': self.appname,
+                'key': self.apikey,
+                'appver': self.appvers,
+                'pver': '3.1',
+                }
+        body = '{0}\n{1}'.format(len(urls), '\n'.join(urls))
+
+        try:
+            r = httpclient.post(self.base_url, params=parameters, data=body.encode('utf-8'), timeout=self.timeout, retries=1)
+        except Exception:
+            log.exception('Caught exception while looking up urls with the Safe Browsing API')
+            return [None] * len(urls)
+
+        if r.status_code == 204:
+            return [False] * len(urls)  # None of the urls are malware or phishing
 
         if r.status_code == 200:
-            return True  # malware or phishing
+            lines = r.text.splitlines()
+            if len(lines) == len(urls):
+                return [line.strip() != 'ok' for line in lines]
 
-        return False  # some handling of error codes should be added, they're just ignored for now
+        log.error('Unexpected response from the Safe Browsing API ({0})'.format(r.status_code))
+        return [None] * len(urls)
@@ -0,0 +1,203 @@
+import collections
+import os
+import sys
+import logging
+
+import irc.client
+
+from models.connection import ConnectionManager, Connector
+from models.whisperconnection import WhisperConnectionManager
+from apiwrappers import TwitchAPI
+import httpclient
+from timingwheel import TimingWheel
+from actions import ActionQueue, MainThreadQueue
+from journal import Journal
+from snapshot import Snapshot
+from tyggbot import TyggBot
+
+log = logging.getLogger('tyggbot')
+
+
+class TMI:
+    message_limit = 90
+    whispers_message_limit = 3
+    whispers_limit_interval = 3  # in seconds
+
+
+class BotHost:
+    """
+    Runs the bots for one or more channels in a single process.
+
+    Every channel has its own config file, database, users, commands,
+    filters and settings (a TyggBot). The reactor, timers, chat and
+    whisper connections, worker threads and the link checker are shared,
+    so a new channel only adds a JOIN on the existing chat connections.
+
+    All channels have to use the same bot account. Shared resources are
+    set up from the first config file, and whispers to the bot are handled
+    by the first channel.
+    """
+
+    def __init__(self, configs, args):
+        config = configs[0]
+        self.nickname = config['main']['nickname']
+        self.password = config['main']['password']
+        self.version = TyggBot.version
+
+        self.check_configs(configs)
+
+        self.reactor = irc.client.Reactor()
+
+        # All timers used by the bot are kept in a timing wheel, which the reactor turns
+        self.timers = TimingWheel()
+        self.reactor.execute_every(self.timers.resolution, self.timers.advance)
+
+        # Chat and whisper connections are opened in parallel by the connector
+        self.connector = Connector(self.timers)
+        self.connection_manager = ConnectionManager(self.reactor, self, TMI.message_limit)
+        self.whisper_manager = WhisperConnectionManager(self.reactor, self, None, TMI.whispers_message_limit, TMI.whispers_limit_interval)
+
+        self.twitchapi = TwitchAPI(type='api')
+
+        # Actions in this queue are run in a pool of worker threads.
+        # This means actions should NOT access any database-related stuff,
+        # or change any of the bots' state. Hand the results to the mainthread_queue instead.
+        num_workers = 4
+        max_backlog = 1000
+        overflow = 'drop_oldest'
+        if 'actions' in config:
+            if 'num_workers' in config['actions']:
+                num_workers = int(config['actions']['num_workers'])
+            if 'max_backlog' in config['actions']:
+                max_backlog = int(config['actions']['max_backlog'])
+            if 'overflow' in config['actions']:
+                overflow = config['actions']['overflow']
+        self.action_queue = ActionQueue(num_workers=num_workers, max_backlog=max_backlog, overflow=overflow)
+        self.action_queue.start()
+
+        """
+        For actions that need to access the main thread,
+        we can use the mainthread_queue.
+        """
+        self.mainthread_queue = MainThreadQueue(self.reactor)
+
+        self.link_checker = None  # created by the first channel
+
+        self.stats_cb = {}
+        self.stats_cb['http'] = httpclient.client.stats
+        self.stats_cb['timers'] = self.timers.stats
+        self.stats_cb['connector'] = self.connector.stats
+        self.stats_cb['actions'] = self.action_queue.stats
+        self.stats_cb['mainthread'] = self.mainthread_queue.stats
+
+        self.reactor.add_global_handler('all_events', self._dispatcher, -10)
+
+        self.bots = collections.OrderedDict()  # channel -> TyggBot
+        for config in configs:
+            bot = TyggBot(config, args, self)
+            self.bots[bot.channel] = bot
+            log.info('Loaded channel {0}'.format(bot.channel))
+
+        self.primary = next(iter(self.bots.values()))
+        self.streamer = self.primary.streamer
+        self.db = self.primary.db  # whisper accounts are read from the first channel's database
+
+        self.whisper_manager.start(accounts=[{'username': self.nickname, 'oauth': self.password}])
+
+    def check_configs(self, configs):
+        """ Exit if the channels can't share one process """
+        base_path = os.path.dirname(os.path.realpath(__file__))
+        channels = set()
+        paths = set()
+        for config in configs:
+            if config['main']['nickname'] != self.nickname:
+                log.error('All channels have to use the same bot account, found both {0} and {1}'.format(self.nickname, config['main']['nickname']))
+                sys.exit(1)
+
+            channel = '#' + config['main']['streamer'] if 'streamer' in config['main'] else config['main'].get('target')
+            if channel in channels:
+                log.error('Channel {0} is in more than one config file'.format(channel))
+                sys.exit(1)
+            channels.add(channel)
+
+            if 'journal' in config:
+                path = Journal.path_from_config(config['journal'], base_path)
+                if path in paths:
+                    log.error('Every channel needs its own journal path, {0} is used twice'.format(path))
+                    sys.exit(1)
+                paths.add(path)
+
+            if 'snapshot' in config:
+                path = Snapshot.path_from_config(config['snapshot'], base_path)
+                if path in paths:
+                    log.error('Every channel needs its own snapshot path, {0} is used twice'.format(path))
+                    sys.exit(1)
+                paths.add(path)
+
+    def execute_delayed(self, delay, function, arguments=()):
+        return self.timers.execute_delayed(delay, function, arguments)
+
+    def execute_every(self, period, function, arguments=()):
+        return self.timers.execute_every(period, function, arguments)
+
+    def connect(self):
+        return self.connection_manager.start()
+
+    def start(self):
+        """Start the IRC client."""
+        self.reactor.process_forever()
+
+    def _dispatcher(self, connection, event):
+        if connection == self.connection_manager.get_main_conn() or connection in self.whisper_manager:
+            method = getattr(self, 'on_' + event.type, None)
+            if method:
+                method(connection, event)
+                return
+
+            bot = self.find_bot(event)
+            if bot:
+                do_nothing = lambda c, e: None
+                method = getattr(bot, 'on_' + event.type, do_nothing)
+                method(connection, event)
+
+    def find_bot(self, event):
+        """ Returns the bot for the channel the event was sent to """
+        if event.type == 'whisper':
+            return self.primary
+
+        if event.type == 'namreply':
+            # arguments: channel type, channel, space-separated list of names
+            return self.bots.get(event.arguments[1])
+
+        return self.bots.get(event.target)
+
+    def on_welcome(self, chatconn, event):
+        if chatconn in self.whisper_manager:
+            log.debug('Connected to Whisper server.')
+            self.whisper_manager.on_welcome(chatconn)
+        else:
+            log.debug('Connected to IRC server.')
+
+    def on_disconnect(self, chatconn, event):
+        if chatconn in self.whisper_manager:
+            log.debug('Disconnecting from Whisper server')
+            self.whisper_manager.on_disconnect(chatconn)
+
+        else:
+            log.debug('Disconnected from IRC server')
+            self.connection_manager.on_disconnect(chatconn)
+
+    def on_chat_connected(self):
+        for bot in self.bots.values():
+            bot.say_welcome()
+
+    def quit(self):
+        for bot in self.bots.values():
+            try:
+                bot.quit()
+            except:
+                log.exception('Unhandled exception while quitting in {0}'.format(bot.channel))
+
+        self.whisper_manager.quit()
+
+        sys.exit(0)
@@ -1,3 +1,4 @@
+import importlib.util
 import json
 import re
 import logging
@@ -5,12 +6,16 @@ import time
 
 log = logging.getLogger('tyggbot')
 
-try:
-    from userdispatch import UserDispatch
-    Dispatch = UserDispatch
-    log.info('Using UserDispatch')
-except:
-    log.exception('No user dispatch available')
+# userdispatch.py is optional, and overrides the default Dispatch if it exists
+if importlib.util.find_spec('userdispatch') is not None:
+    try:
+        from userdispatch import UserDispatch
+        Dispatch = UserDispatch
+        log.info('Using UserDispatch')
+    except:
+        log.exception('Unable to load UserDispatch')
+        from dispatch import Dispatch
+else:
     from dispatch import Dispatch
 
 
@@ -55,6 +60,7 @@ class Command:
         self.type = '?'
         self.cost = 0
         self.can_execute_with_whisper = False
+        self.journal = None
 
     @classmethod
     def from_json(cls, json):
@@ -136,6 +142,9 @@ class Command:
                 args.update(self.extra_args)
                 ret = self.action.run(tyggbot, source, message, event, args)
                 self.num_uses += 1
+                # Commands that aren't in the database (id -1) have no stable key to replay their uses under
+                if self.journal is not None and self.id != -1:
+                    self.journal.record('command', self.id, 'num_uses', 1)
                 self.synced = False
                 if ret is not False:
                     if self.cost > 0:
@@ -171,6 +180,7 @@ class Filter:
                 log.error('Exception caught while loading Filter extra arguments ({0}): {1}'.format(data['extra_args'], e))
 
         self.synced = True
+        self.journal = None
 
     def is_enabled(self):
         return self.enabled == 1 and self.action is not None
@@ -193,4 +203,6 @@ class Filter:
         args.update(self.extra_args)
         self.action.run(tyggbot, source, message, event, args)
         self.num_uses += 1
+        if self.journal is not None and self.id != -1:
+            self.journal.record('filter', self.id, 'num_uses', 1)
         self.synced = False
@@ -0,0 +1,264 @@
+import contextlib
+import threading
+import collections
+import time
+
+import logging
+
+import pymysql
+
+from querytrace import QueryTracer
+
+log = logging.getLogger('tyggbot')
+
+
+class PoolCursor:
+    """
+    A cursor on a connection checked out from a ConnectionPool.
+    Closing the cursor returns the connection to the pool.
+    """
+
+    def __init__(self, pool, pooled_conn, cursor):
+        self.pool = pool
+        self.pooled_conn = pooled_conn
+        self.cursor = cursor
+
+    @property
+    def connection(self):
+        return self.pooled_conn.conn
+
+    def execute(self, query, args=None):
+        self.pool.count_query()
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(query, args)
+        finally:
+            self.pool.tracer.record(query, time.perf_counter() - start, self.cursor.rowcount)
+
+    def executemany(self, query, args):
+        self.pool.count_query()
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(query, args)
+        finally:
+            self.pool.tracer.record(query, time.perf_counter() - start, self.cursor.rowcount)
+
+    def close(self):
+        if self.pooled_conn is not None:
+            try:
+                self.cursor.close()
+            except:
+                pass
+            self.pool.release(self.pooled_conn)
+            self.pooled_conn = None
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Don't leak the connection if someone forgot to close the cursor
+        self.close()
+
+
+class PooledConnection:
+    def __init__(self, conn, partition, overflow=False):
+        self.conn = conn
+        self.partition = partition
+        self.overflow = overflow
+        self.last_used = time.time()
+
+
+class ConnectionPool:
+    """
+    Pool of MySQL connections.
+
+    The pool has two partitions with their own capacity: 'reactor', for
+    queries run on the reactor thread, and 'background', for everything
+    run in other threads. A connection is checked out for one unit of work
+    (see cursor()) and is only pinged if it has been idle for more than
+    `idle_check' seconds.
+
+    The reactor thread never waits for a connection. If all of its
+    connections are in use, a temporary overflow connection is opened.
+    Background threads wait up to `max_wait' seconds before doing the same.
+    """
+
+    def __init__(self, connect_args, reactor_size=2, background_size=4, idle_check=60, max_wait=10):
+        self.connect_args = connect_args
+        self.capacity = {'reactor': reactor_size, 'background': background_size}
+        self.idle_check = idle_check
+        self.max_wait = max_wait
+
+        self.cond = threading.Condition()
+        self.idle = {'reactor': [], 'background': []}
+        self.num_open = {'reactor': 0, 'background': 0}
+
+        # The pool is created by the thread that runs the reactor
+        self.reactor_thread = threading.current_thread()
+
+        self.num_checkouts = 0
+        self.num_queries = 0
+        self.num_overflow = 0
+        self.num_pings = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+        self.tracer = QueryTracer()
+
+        # Open one connection right away, so connection errors show up at startup
+        self.release(self.checkout('reactor'))
+
+    @classmethod
+    def from_config(cls, sql_config, **options):
+        connect_args = {
+                'unix_socket': sql_config['unix_socket'],
+                'user': sql_config['user'],
+                'passwd': sql_config['passwd'],
+                'db': sql_config['db'],
+                'charset': 'utf8mb4',
+                'autocommit': True,
+                }
+
+        for key in ('reactor_size', 'background_size', 'idle_check'):
+            if key in sql_config:
+                options[key] = int(sql_config[key])
+
+        return cls(connect_args, **options)
+
+    def _connect(self):
+        return pymysql.connect(**self.connect_args)
+
+    def checkout(self, partition=None):
+        if partition is None:
+            partition = 'reactor' if threading.current_thread() is self.reactor_thread else 'background'
+
+        start = time.time()
+        pooled_conn = None
+        overflow = False
+        with self.cond:
+            while True:
+                if len(self.idle[partition]) > 0:
+                    pooled_conn = self.idle[partition].pop()
+                    break
+
+                if self.num_open[partition] < self.capacity[partition]:
+                    self.num_open[partition] += 1
+                    break
+
+                remaining = start + self.max_wait - time.time()
+                if partition == 'reactor' or remaining <= 0:
+                    overflow = True
+                    self.num_overflow += 1
+                    break
+
+                self.cond.wait(remaining)
+
+            wait = time.time() - start
+            self.num_checkouts += 1
+            self.total_wait += wait
+            self.max_wait_seen = max(self.max_wait_seen, wait)
+
+        if pooled_conn is None:
+            if overflow:
+                log.warning('No free database connections in the {0} partition, opening an overflow connection'.format(partition))
+            try:
+                pooled_conn = PooledConnection(self._connect(), partition, overflow)
+            except:
+                if not overflow:
+                    with self.cond:
+                        self.num_open[partition] -= 1
+                        self.cond.notify()
+                raise
+        elif time.time() - pooled_conn.last_used > self.idle_check:
+            with self.cond:
+                self.num_pings += 1
+            pooled_conn.conn.ping(reconnect=True)
+
+        return pooled_conn
+
+    def release(self, pooled_conn):
+        pooled_conn.last_used = time.time()
+        if pooled_conn.overflow or not pooled_conn.conn.open:
+            try:
+                pooled_conn.conn.close()
+            except:
+                pass
+
+            if not pooled_conn.overflow:
+                with self.cond:
+                    self.num_open[pooled_conn.partition] -= 1
+                    self.cond.notify()
+            return
+
+        with self.cond:
+            self.idle[pooled_conn.partition].append(pooled_conn)
+            self.cond.notify()
+
+    def count_query(self):
+        # Not locked, an off-by-one under contention is fine for a statistic
+        self.num_queries += 1
+
+    def get_cursor(self, cursor_class=None, partition=None):
+        """ Returns a cursor that must be closed to return its connection to the pool """
+        pooled_conn = self.checkout(partition)
+        try:
+            cursor = pooled_conn.conn.cursor(cursor_class)
+        except:
+            self.release(pooled_conn)
+            raise
+        return PoolCursor(self, pooled_conn, cursor)
+
+    @contextlib.contextmanager
+    def cursor(self, cursor_class=None, transaction=False, partition=None):
+        """
+        Check out a connection for one unit of work.
+        With transaction=True, the work is committed at the end of the
+        block, or rolled back if an exception is raised.
+        """
+        cursor = self.get_cursor(cursor_class, partition)
+        try:
+            if transaction:
+                cursor.connection.begin()
+            yield cursor
+            if transaction:
+                cursor.connection.commit()
+        except:
+            if transaction:
+                try:
+                    cursor.connection.rollback()
+                except:
+                    log.exception('Caught exception while rolling back')
+            raise
+        finally:
+            cursor.close()
+
+    @contextlib.contextmanager
+    def connection(self, partition=None):
+        """ Check out a raw pymysql connection, for code that manages its own cursors """
+        pooled_conn = self.checkout(partition)
+        try:
+            yield pooled_conn.conn
+        finally:
+            self.release(pooled_conn)
+
+    def stats(self):
+        with self.cond:
+            data = collections.OrderedDict()
+            for partition in ('reactor', 'background'):
+                data[partition] = 'open={0} idle={1} capacity={2}'.format(self.num_open[partition], len(self.idle[partition]), self.capacity[partition])
+            avg_wait = self.total_wait / self.num_checkouts if self.num_checkouts > 0 else 0
+            data['checkouts'] = self.num_checkouts
+            data['queries'] = self.num_queries
+            data['overflow'] = self.num_overflow
+            data['pings'] = self.num_pings
+            data['avg_wait'] = '{0:.1f}ms'.format(avg_wait * 1000)
+            data['max_wait'] = '{0:.1f}ms'.format(self.max_wait_seen * 1000)
+            return data
@@ -1,10 +1,11 @@
 import math
 import re
 import json
-import pymysql
 import logging
 import collections
 
+import pymysql
+
 from tbutil import time_limit, TimeoutException
 
 log = logging.getLogger('tyggbot')
@@ -61,20 +62,20 @@ class Dispatch:
         if num_lines <= 0:
             tyggbot.say(tyggbot.phrases['nl_0'].format(**phrase_data))
         else:
-            cursor = tyggbot.get_dictcursor()
-            cursor.execute('SELECT COUNT(*) as `pos` FROM `tb_user` WHERE `num_lines`>%s', (num_lines, ))
-            row = cursor.fetchone()
+            with tyggbot.db.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute('SELECT COUNT(*) as `pos` FROM `tb_user` WHERE `num_lines`>%s', (num_lines, ))
+                row = cursor.fetchone()
             if row:
                 phrase_data['nl_pos'] = row['pos'] + 1
                 tyggbot.say(tyggbot.phrases['nl_pos'].format(**phrase_data))
 
     def query(tyggbot, source, message, event, args):
-        if Dispatch.wolfram is None:
+        if tyggbot.wolfram is None:
             return False
 
         try:
             log.debug('Querying wolfram "{0}"'.format(message))
-            res = Dispatch.wolfram.query(message)
+            res = tyggbot.wolfram.query(message)
 
             x = 0
             for pod in res.pods:
@@ -176,16 +177,16 @@ class Dispatch:
                         tyggbot.whisper(source.username, 'That banphrase is already active (id {0})'.format(filter.id))
                         return False
 
-            tyggbot.sqlconn.ping()
-            cursor = tyggbot.sqlconn.cursor()
-
             action = json.dumps({'type': 'func', 'cb': 'timeout_source'})
             extra_args = json.dumps({'time': 300, 'notify': 1})
 
-            cursor.execute('INSERT INTO `tb_filters` (`name`, `type`, `action`, `extra_args`, `filter`) VALUES (%s, %s, %s, %s, %s)',
-                    ('Banphrase', 'banphrase', action, extra_args, message.lower()))
+            with tyggbot.db.cursor() as cursor:
+                tyggbot.invalidate_snapshot()
+                cursor.execute('INSERT INTO `tb_filters` (`name`, `type`, `action`, `extra_args`, `filter`) VALUES (%s, %s, %s, %s, %s)',
+                        ('Banphrase', 'banphrase', action, extra_args, message.lower()))
+                filter_id = cursor.lastrowid
 
-            tyggbot.whisper(source.username, 'Successfully added your banphrase (id {0})'.format(cursor.lastrowid))
+            tyggbot.whisper(source.username, 'Successfully added your banphrase (id {0})'.format(filter_id))
 
             tyggbot.sync_to()
             tyggbot._load_filters()
@@ -235,17 +236,17 @@ class Dispatch:
             else:
                 data['action'] = json.dumps({'type': 'say', 'message': response})
 
-            tyggbot.sqlconn.ping()
-            cursor = tyggbot.sqlconn.cursor()
-
-            if update_id is False:
-                query = 'INSERT INTO `tb_commands` (`level`, `command`, `action`, `description`, `delay_all`, `delay_user`) VALUES (' + ', '.join(['%s'] * len(data)) + ')'
-                cursor.execute(query, (data['level'], data['command'], data['action'], data['description'], data['delay_all'], data['delay_user']))
-                tyggbot.whisper(source.username, 'Successfully added your command (id {0})'.format(cursor.lastrowid))
-            else:
-                query = 'UPDATE `tb_commands` SET `action`=%s WHERE `id`=%s'
-                cursor.execute(query, (data['action'], update_id))
-                tyggbot.whisper(source.username, 'Updated an already existing command! (id {0})'.format(update_id))
+            with tyggbot.db.cursor() as cursor:
+                if update_id is False:
+                    query = 'INSERT INTO `tb_commands` (`level`, `command`, `action`, `description`, `delay_all`, `delay_user`) VALUES (' + ', '.join(['%s'] * len(data)) + ')'
+                    tyggbot.invalidate_snapshot()
+                    cursor.execute(query, (data['level'], data['command'], data['action'], data['description'], data['delay_all'], data['delay_user']))
+                    tyggbot.whisper(source.username, 'Successfully added your command (id {0})'.format(cursor.lastrowid))
+                else:
+                    query = 'UPDATE `tb_commands` SET `action`=%s WHERE `id`=%s'
+                    tyggbot.invalidate_snapshot()
+                    cursor.execute(query, (data['action'], update_id))
+                    tyggbot.whisper(source.username, 'Updated an already existing command! (id {0})'.format(update_id))
 
             tyggbot.sync_to()
             tyggbot._load_commands()
@@ -286,17 +287,17 @@ class Dispatch:
                     'delay_user': 30,
                     }
 
-            tyggbot.sqlconn.ping()
-            cursor = tyggbot.sqlconn.cursor()
-
-            if update_id is False:
-                query = 'INSERT INTO `tb_commands` (`level`, `command`, `action`, `description`, `delay_all`, `delay_user`) VALUES (' + ', '.join(['%s'] * len(data)) + ')'
-                cursor.execute(query, (data['level'], data['command'], data['action'], data['description'], data['delay_all'], data['delay_user']))
-                tyggbot.whisper(source.username, 'Successfully added your command (id {0})'.format(cursor.lastrowid))
-            else:
-                query = 'UPDATE `tb_commands` SET `action`=%s WHERE `id`=%s'
-                cursor.execute(query, (data['action'], update_id))
-                tyggbot.whisper(source.username, 'Updated an already existing command! (id {0})'.format(update_id))
+            with tyggbot.db.cursor() as cursor:
+                if update_id is False:
+                    query = 'INSERT INTO `tb_commands` (`level`, `command`, `action`, `description`, `delay_all`, `delay_user`) VALUES (' + ', '.join(['%s'] * len(data)) + ')'
+                    tyggbot.invalidate_snapshot()
+                    cursor.execute(query, (data['level'], data['command'], data['action'], data['description'], data['delay_all'], data['delay_user']))
+                    tyggbot.whisper(source.username, 'Successfully added your command (id {0})'.format(cursor.lastrowid))
+                else:
+                    query = 'UPDATE `tb_commands` SET `action`=%s WHERE `id`=%s'
+                    tyggbot.invalidate_snapshot()
+                    cursor.execute(query, (data['action'], update_id))
+                    tyggbot.whisper(source.username, 'Updated an already existing command! (id {0})'.format(update_id))
 
             tyggbot.sync_to()
             tyggbot._load_commands()
@@ -305,13 +306,13 @@ class Dispatch:
         if message and len(message) > 0:
             banphrase_id = int(message)
 
-            tyggbot.sqlconn.ping()
-            cursor = tyggbot.sqlconn.cursor()
+            with tyggbot.db.cursor() as cursor:
+                tyggbot.invalidate_snapshot()
+                cursor.execute('DELETE FROM `tb_filters` WHERE `type`=%s AND `id`=%s',
+                        ('banphrase', banphrase_id))
+                num_removed = cursor.rowcount
 
-            cursor.execute('DELETE FROM `tb_filters` WHERE `type`=%s AND `id`=%s',
-                    ('banphrase', banphrase_id))
-
-            if cursor.rowcount >= 1:
+            if num_removed >= 1:
                 tyggbot.whisper(source.username, 'Successfully removed banphrase with id {0}'.format(banphrase_id))
                 log.debug('{0}, successfully removed banphrase with id {1}'.format(source.username, banphrase_id))
                 tyggbot.sync_to()
@@ -330,73 +331,73 @@ class Dispatch:
 
     def add_alias(tyggbot, source, message, event, args):
         if message and len(message) > 0:
-            tyggbot.sqlconn.ping()
-            cursor = tyggbot.sqlconn.cursor(pymysql.cursors.DictCursor)
-            parts = message.split(' ')
-            if len(parts) < 2:
-                tyggbot.whisper(source.username, "Usage: !add alias existingalias newalias")
-                return
-
-            if parts[0] not in tyggbot.commands:
-                tyggbot.whisper(source.username, 'No command called "{0}" found'.format(parts[0]))
-                return
+            with tyggbot.db.cursor(pymysql.cursors.DictCursor) as cursor:
+                parts = message.split(' ')
+                if len(parts) < 2:
+                    tyggbot.whisper(source.username, "Usage: !add alias existingalias newalias")
+                    return
 
-            new_aliases = parts[1].split('|')
-            for alias in new_aliases:
-                if alias in tyggbot.commands:
-                    tyggbot.whisper(source.username, 'Alias {0} is already used by a command'.format(alias))
+                if parts[0] not in tyggbot.commands:
+                    tyggbot.whisper(source.username, 'No command called "{0}" found'.format(parts[0]))
                     return
-                tyggbot.commands[alias] = tyggbot.commands[parts[0]]
 
-            commid = tyggbot.commands[parts[0]].id
-            cursor.execute("SELECT * FROM `tb_commands` WHERE `id`=%s", (commid))
-            for row in cursor:
-                names = row['command']
-                names += '|' + parts[1]
+                new_aliases = parts[1].split('|')
+                for alias in new_aliases:
+                    if alias in tyggbot.commands:
+                        tyggbot.whisper(source.username, 'Alias {0} is already used by a command'.format(alias))
+                        return
+                    tyggbot.commands[alias] = tyggbot.commands[parts[0]]
+
+                commid = tyggbot.commands[parts[0]].id
+                cursor.execute("SELECT * FROM `tb_commands` WHERE `id`=%s", (commid))
+                for row in cursor:
+                    names = row['command']
+                    names += '|' + parts[1]
 
-            cursor.execute("UPDATE `tb_commands` SET `command`=%s WHERE `id`=%s", (names, commid))
+                tyggbot.invalidate_snapshot()
+                cursor.execute("UPDATE `tb_commands` SET `command`=%s WHERE `id`=%s", (names, commid))
 
-            tyggbot.whisper(source.username, 'Successfully added the aliases {0} to {1}'.format(', '.join(new_aliases), parts[0]))
+                tyggbot.whisper(source.username, 'Successfully added the aliases {0} to {1}'.format(', '.join(new_aliases), parts[0]))
         else:
             tyggbot.whisper(source.username, "Usage: !add alias existingalias newalias")
 
     def remove_alias(tyggbot, source, message, event, args):
         if message and len(message) > 0:
-            tyggbot.sqlconn.ping()
-            cursor = tyggbot.sqlconn.cursor(pymysql.cursors.DictCursor)
-            parts = message.split(' ')
-            if len(parts) > 1:
-                tyggbot.whisper(source.username, "Usage: !remove alias existingalias")
-                return
-
-            parts = message.split('|')
-            num_removed = 0
-            commands_not_found = []
-            for alias in parts:
-                if alias not in tyggbot.commands:
-                    commands_not_found.append(alias)
-                    continue
-
-                commid = tyggbot.commands[alias].id
-                cursor.execute("SELECT * FROM `tb_commands` WHERE `id`=%s", (commid))
-                for row in cursor:
-                    names = row['command']
-
-                namelist = names.split('|')
-                namelist.remove(alias)
-                if len(namelist) == 0:
-                    tyggbot.whisper(source.username, "{0} is the only remaining alias for this command and can't be removed.".format(alias))
+            with tyggbot.db.cursor(pymysql.cursors.DictCursor) as cursor:
+                parts = message.split(' ')
+                if len(parts) > 1:
+                    tyggbot.whisper(source.username, "Usage: !remove alias existingalias")
                     return
 
-                num_removed += 1
-                names = '|'.join(namelist)
-                cursor.execute("UPDATE `tb_commands` SET `command`=%s WHERE `id`=%s", (names, commid))
-                del tyggbot.commands[alias]
-
-            whisper_str = 'Successfully removed {0} aliases.'.format(num_removed)
-            if len(commands_not_found) > 0:
-                whisper_str += ' ({0} not found)'.format(', '.join(commands_not_found))
-            tyggbot.whisper(source.username, whisper_str)
+                parts = message.split('|')
+                num_removed = 0
+                commands_not_found = []
+                for alias in parts:
+                    if alias not in tyggbot.commands:
+                        commands_not_found.append(alias)
+                        continue
+
+                    commid = tyggbot.commands[alias].id
+                    cursor.execute("SELECT * FROM `tb_commands` WHERE `id`=%s", (commid))
+                    for row in cursor:
+                        names = row['command']
+
+                    namelist = names.split('|')
+                    namelist.remove(alias)
+                    if len(namelist) == 0:
+                        tyggbot.whisper(source.username, "{0} is the only remaining alias for this command and can't be removed.".format(alias))
+                        return
+
+                    num_removed += 1
+                    names = '|'.join(namelist)
+                    tyggbot.invalidate_snapshot()
+                    cursor.execute("UPDATE `tb_commands` SET `command`=%s WHERE `id`=%s", (names, commid))
+                    del tyggbot.commands[alias]
+
+                whisper_str = 'Successfully removed {0} aliases.'.format(num_removed)
+                if len(commands_not_found) > 0:
+                    whisper_str += ' ({0} not found)'.format(', '.join(commands_not_found))
+                tyggbot.whisper(source.username, whisper_str)
         else:
             tyggbot.whisper(source.username, "Usage: !remove alias existingalias")
 
@@ -426,12 +427,12 @@ class Dispatch:
                             tyggbot.whisper(source.username, 'That command is not a normal command, it cannot be removed by you.')
                             return False
 
-            tyggbot.sqlconn.ping()
-            cursor = tyggbot.sqlconn.cursor()
-
-            cursor.execute('DELETE FROM `tb_commands` WHERE `id`=%s', (id))
+            with tyggbot.db.cursor() as cursor:
+                tyggbot.invalidate_snapshot()
+                cursor.execute('DELETE FROM `tb_commands` WHERE `id`=%s', (id))
+                num_removed = cursor.rowcount
 
-            if cursor.rowcount >= 1:
+            if num_removed >= 1:
                 tyggbot.whisper(source.username, 'Successfully removed command with id {0}'.format(id))
                 tyggbot.sync_to()
                 tyggbot._load_commands()
@@ -540,6 +541,19 @@ class Dispatch:
         else:
             tyggbot.whisper(source.username, 'Usage: !debug user USERNAME')
 
+    def debug_stats(tyggbot, source, message, event, args):
+        if message and len(message) > 0:
+            name = message.split(' ')[0].strip().lower()
+            if name not in tyggbot.stats_cb:
+                tyggbot.whisper(source.username, 'No stats called {0} found.'.format(name))
+                return False
+
+            data = tyggbot.stats_cb[name]()
+
+            tyggbot.whisper(source.username, ', '.join(['%s=%s' % (key, value) for (key, value) in data.items()]))
+        else:
+            tyggbot.whisper(source.username, 'Usage: !debug stats ({0})'.format('|'.join(sorted(tyggbot.stats_cb))))
+
     def level(tyggbot, source, message, event, args):
         if message:
             msg_args = message.split(' ')
@@ -580,11 +594,11 @@ class Dispatch:
 
     def top3(tyggbot, source, message, event, args):
         tyggbot.sync_to()
-        cursor = tyggbot.sqlconn.cursor(pymysql.cursors.DictCursor)
-        cursor.execute('SELECT `username`, `num_lines` FROM `tb_user` ORDER BY `num_lines` DESC LIMIT 3')
         users = []
-        for messager in cursor:
-            users.append('{0} ({1})'.format(messager['username'], messager['num_lines']))
+        with tyggbot.db.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute('SELECT `username`, `num_lines` FROM `tb_user` ORDER BY `num_lines` DESC LIMIT 3')
+            for messager in cursor:
+                users.append('{0} ({1})'.format(messager['username'], messager['num_lines']))
 
         tyggbot.say('Top 3: {0}'.format(', '.join(users)))
 
@@ -689,16 +703,18 @@ class Dispatch:
             else:
                 tyggbot.ignores.append(message)
                 tyggbot.say('Now ignoring {0}'.format(message))
-                cursor = tyggbot.get_cursor()
-                cursor.execute('INSERT INTO `tb_ignores` (username) VALUES (%s)', (message))
+                with tyggbot.db.cursor() as cursor:
+                    tyggbot.invalidate_snapshot()
+                    cursor.execute('INSERT INTO `tb_ignores` (username) VALUES (%s)', (message))
 
     def unignore(tyggbot, source, message, event, args):
         if message and len(message) > 1:
             message = message.lower()
             if message in tyggbot.ignores:
                 tyggbot.ignores.remove(message)
-                cursor = tyggbot.get_cursor()
-                cursor.execute('DELETE FROM `tb_ignores` WHERE username=%s', (message))
+                with tyggbot.db.cursor() as cursor:
+                    tyggbot.invalidate_snapshot()
+                    cursor.execute('DELETE FROM `tb_ignores` WHERE username=%s', (message))
                 tyggbot.say('No longer ignoring {0}'.format(message))
             else:
                 tyggbot.say('I\'m not ignoring {0} DansGame'.format(message))
@@ -1,47 +1,151 @@
 import logging
+import concurrent.futures
+import codecs
+import json
+import sys
+import re
 
-from apiwrappers import APIBase
+import httpclient
 
 log = logging.getLogger('tyggbot')
 
 
+chatters_token_re = re.compile(r'"((?:[^"\\]|\\.)*)"|[\[\]]')
+
+
+def parse_chatters(chunks):
+    """
+    Parses a TMI chatters document from an iterable of byte chunks.
+
+    Instead of loading the whole JSON document, we scan it for string
+    tokens and keep every string that's inside a list, i.e. the user
+    names in chatters.moderators, chatters.viewers etc.
+    Returns a frozenset of interned user names.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chatters = set()
+    buf = ''
+    depth = 0
+
+    for chunk in chunks:
+        buf += decoder.decode(chunk)
+        end = 0
+        for match in chatters_token_re.finditer(buf):
+            token = match.group(0)
+            if token == '[':
+                depth += 1
+            elif token == ']':
+                depth -= 1
+            elif depth > 0:
+                name = match.group(1)
+                if '\\' in name:
+                    name = json.loads(token)
+                chatters.add(sys.intern(name))
+            end = match.end()
+
+        # Only keep the part of the buffer that might be the start of a string
+        buf = buf[end:]
+        if '"' not in buf:
+            buf = ''
+
+    return frozenset(chatters)
+
+
 def get_chatters(channel):
+    """
+    Returns a frozenset of the users currently in chat,
+    or None if the chatters could not be fetched.
+    """
     url = 'http://tmi.twitch.tv/group/user/{0}/chatters'.format(channel)
 
     try:
-        chatters_data = APIBase._get_json(url)
-        chatters = chatters_data['chatters']
+        r = httpclient.get(url, stream=True)
+        try:
+            if r.status_code >= 400:
+                log.error('Got status code {0} while trying to get chatters for channel {1}'.format(r.status_code, channel))
+                return None
 
-        return chatters['moderators'] + chatters['staff'] + chatters['admins'] + chatters['global_mods'] + chatters['viewers']
-    except KeyError:
-        log.exception('Caught exception while trying to get chatters for channel {0}'.format(channel))
+            return parse_chatters(r.iter_content(chunk_size=16 * 1024))
+        finally:
+            r.close()
     except Exception:
         log.exception('Uncaught exception in get_chatters')
 
-    return []
+    return None
+
 
+def get_subscribers_page(twitchapi, channel, offset, limit=100, direction='asc'):
+    data = twitchapi.get(['channels', channel, 'subscriptions'], {'limit': limit, 'offset': offset, 'direction': direction})
+    if not data or 'subscriptions' not in data:
+        raise ValueError('No subscription data returned for offset {0}'.format(offset))
 
-def get_subscribers(twitchapi, channel):
+    return data
+
+
+def get_subscribers(twitchapi, channel, max_workers=8):
     """
     Returns a list of subscribers
+
+    The first page tells us how many subscribers there are, the rest of the
+    pages are then fetched concurrently by up to `max_workers' threads.
+    An empty list is returned if any of the pages could not be fetched.
+    """
+    limit = 100
+    subscribers = []
+
+    try:
+        data = get_subscribers_page(twitchapi, channel, 0, limit)
+        pages = [data]
+
+        offsets = range(limit, data['_total'], limit)
+        if len(offsets) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(offsets))) as executor:
+                pages += executor.map(lambda offset: get_subscribers_page(twitchapi, channel, offset, limit), offsets)
+    except:
+        log.exception('Caught an exception while trying to get subscribers')
+        return []
+
+    # Subscriptions that are added or removed while we're fetching shift the
+    # pages around, so the same subscriber might show up on two pages
+    seen = set()
+    for page in pages:
+        for sub in page['subscriptions']:
+            name = sub['user']['name']
+            if name not in seen:
+                seen.add(name)
+                subscribers.append(name)
+
+    return subscribers
+
+
+def get_new_subscribers(twitchapi, channel, known_subscribers):
+    """
+    Returns a list of subscribers that are not in `known_subscribers'
+
+    Subscriptions are fetched newest first, and we stop at the first
+    subscriber we already know about. This does not notice subscribers
+    who have stopped subscribing, so a full get_subscribers is still
+    needed every now and then.
     """
     limit = 100
     offset = 0
     subscribers = []
 
     try:
-        data = twitchapi.get(['channels', channel, 'subscriptions'], {'limit': limit, 'offset': offset})
-        while len(data['subscriptions']) > 0:
+        while True:
+            data = get_subscribers_page(twitchapi, channel, offset, limit, direction='desc')
             for sub in data['subscriptions']:
-                subscribers.append(sub['user']['name'])
+                name = sub['user']['name']
+                if name in known_subscribers:
+                    return subscribers
+                subscribers.append(name)
 
-            if data['_total'] < limit + offset:
+            if len(data['subscriptions']) < limit:
                 break
 
             offset += limit
-            data = twitchapi.get(['channels', channel, 'subscriptions'], {'limit': limit, 'offset': offset})
     except:
-        log.exception('Caught an exception while trying to get subscribers')
+        log.exception('Caught an exception while trying to get new subscribers')
         return []
 
     return subscribers
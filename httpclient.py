@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+import collections
+import urllib.parse
+import http.cookiejar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger('tyggbot')
+
+
+class HostStats:
+    def __init__(self):
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __str__(self):
+        avg_time = self.total_time / self.num_requests if self.num_requests > 0 else 0
+        return 'n={0} err={1} retries={2} avg={3:.0f}ms max={4:.0f}ms'.format(self.num_requests, self.num_errors, self.num_retries, avg_time * 1000, self.max_time * 1000)
+
+
+class HTTPClient:
+    """
+    Shared HTTP client used for all outbound HTTP requests.
+
+    Connections are kept alive and pooled per host, every request has a
+    connect and read timeout, and failed requests are retried with an
+    exponential backoff.
+
+    Clients that fetch arbitrary third-party pages should be created with
+    accept_cookies=False, so cookies are neither stored nor sent.
+    """
+
+    default_timeout = (3, 10)  # (connect timeout, read timeout) in seconds
+    default_retries = 2
+    backoff_factor = 0.5
+    retry_statuses = (500, 502, 503, 504)
+    max_hosts = 256  # Number of hosts we keep connection pools and stats for
+
+    def __init__(self, accept_cookies=True):
+        self.session = requests.Session()
+        if not accept_cookies:
+            # No domain is allowed, so every cookie is rejected
+            self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=self.max_hosts, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.lock = threading.Lock()
+        self.host_stats = collections.OrderedDict()
+
+    def _record(self, host, elapsed, error=False, retry=False):
+        with self.lock:
+            stats = self.host_stats.get(host)
+            if stats is None:
+                stats = HostStats()
+                self.host_stats[host] = stats
+                if len(self.host_stats) > self.max_hosts:
+                    self.host_stats.popitem(last=False)
+            else:
+                self.host_stats.move_to_end(host)
+
+            stats.num_requests += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            if error:
+                stats.num_errors += 1
+            if retry:
+                stats.num_retries += 1
+
+    def request(self, method, url, timeout=None, retries=None, **kwargs):
+        """
+        Send a request and return the requests.Response.
+        Connection errors, timeouts and 5xx responses are retried up to
+        `retries' times. The last exception is raised if all attempts fail.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        if retries is None:
+            retries = self.default_retries
+
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        attempt = 0
+
+        while True:
+            start = time.time()
+            try:
+                r = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._record(host, time.time() - start, error=True, retry=attempt > 0)
+                if attempt >= retries:
+                    raise
+            else:
+                self._record(host, time.time() - start, error=r.status_code >= 500, retry=attempt > 0)
+                if r.status_code not in self.retry_statuses or attempt >= retries:
+                    return r
+                r.close()
+
+            attempt += 1
+            delay = self.backoff_factor * 2 ** (attempt - 1)
+            log.debug('Retrying {0} {1} in {2:.1f} seconds'.format(method, url, delay))
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """ Returns the stats of the 10 hosts we've sent the most requests to """
+        with self.lock:
+            hosts = sorted(self.host_stats.items(), key=lambda h: h[1].num_requests, reverse=True)[:10]
+            return collections.OrderedDict((host, str(stats)) for host, stats in hosts)
+
+
+client = HTTPClient()
+
+
+def get(url, **kwargs):
+    return client.get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return client.head(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return client.post(url, **kwargs)
@@ -0,0 +1,96 @@
+import importlib.abc
+import resource
+import time
+import sys
+
+
+class TimedLoader(importlib.abc.Loader):
+    """ Wraps a module loader, and times how long it takes to execute the module """
+
+    def __init__(self, loader, profiler, name):
+        self.loader = loader
+        self.profiler = profiler
+        self.name = name
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.profiler.enter(self.name)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.leave(self.name)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class ImportProfiler(importlib.abc.MetaPathFinder):
+    """
+    Measures how long each module takes to import.
+
+    Self time is the time spent running the module itself, cumulative
+    time also includes the modules it imported.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.finding = set()
+        self.results = []  # (name, self time, cumulative time)
+        self.start_time = 0.0
+        self.start_rss = 0
+
+    def start(self):
+        self.start_time = time.time()
+        self.start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        sys.meta_path.insert(0, self)
+
+    def stop(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname in self.finding:
+            return None
+
+        # Let the other finders find the module, and wrap its loader
+        self.finding.add(fullname)
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self.finding.discard(fullname)
+
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+
+        spec.loader = TimedLoader(spec.loader, self, fullname)
+        return spec
+
+    def enter(self, name):
+        # [name, start time, time spent in imports of other modules]
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    def leave(self, name):
+        name, start, children_time = self.stack.pop()
+        cumulative_time = time.perf_counter() - start
+        self.results.append((name, cumulative_time - children_time, cumulative_time))
+        if len(self.stack) > 0:
+            self.stack[-1][2] += cumulative_time
+
+    def report(self, log, limit=30):
+        total_time = sum(self_time for name, self_time, cumulative_time in self.results)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        log.info('Imported {0} modules in {1:.0f}ms, max RSS {2:.1f}MB (+{3:.1f}MB since the profiler started)'.format(
+            len(self.results), total_time * 1000, rss / 1024, (rss - self.start_rss) / 1024))
+        log.info('{0:>10} {1:>10}  module'.format('self', 'cumulative'))
+        for name, self_time, cumulative_time in sorted(self.results, key=lambda result: result[2], reverse=True)[:limit]:
+            log.info('{0:>8.1f}ms {1:>8.1f}ms  {2}'.format(self_time * 1000, cumulative_time * 1000, name))
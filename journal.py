@@ -0,0 +1,202 @@
+import threading
+import collections
+import json
+import time
+import os
+
+import logging
+
+log = logging.getLogger('tyggbot')
+
+
+class Journal:
+    """
+    Append-only journal of counter increments (lines, points, minutes in
+    chat, emote counts and command/filter uses) that haven't been synced
+    to the database yet.
+
+    Increments are added up in memory, and written to the current journal
+    file by a background thread every `commit_interval' seconds, followed
+    by a single fsync (group commit).
+
+    The journal is split into numbered files (generations). Before the
+    bot syncs to the database, the journal is rotated to a new file, and
+    the generation of the file that was closed is stored in the same
+    transaction as the sync. Files up to that generation are deleted once
+    the sync is done, and on startup only newer files are replayed, so no
+    increment is applied twice.
+    """
+
+    def __init__(self, path, commit_interval=1.0):
+        self.path = path
+        self.commit_interval = commit_interval
+
+        os.makedirs(self.path, exist_ok=True)
+        existing = self.list_generations()
+        self.generation = max(existing) + 1 if len(existing) > 0 else 1
+        self.file = open(self.filename(self.generation), 'a')
+
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.write_lock = threading.Lock()
+        self.running = True
+
+        self.num_records = 0
+        self.num_commits = 0
+        self.num_lines = 0
+        self.total_commit_time = 0.0
+        self.max_commit_time = 0.0
+
+        self.thread = threading.Thread(target=self._run, name='JournalWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, journal_config, base_path):
+        path = cls.path_from_config(journal_config, base_path)
+        commit_interval = float(journal_config.get('commit_interval', 1.0))
+        return cls(path, commit_interval)
+
+    @staticmethod
+    def path_from_config(journal_config, base_path):
+        path = journal_config.get('path', 'journal')
+        if not os.path.isabs(path):
+            path = os.path.join(base_path, path)
+        return path
+
+    def filename(self, generation):
+        return os.path.join(self.path, 'journal.{0}'.format(generation))
+
+    def list_generations(self):
+        generations = []
+        for filename in os.listdir(self.path):
+            if filename.startswith('journal.'):
+                try:
+                    generations.append(int(filename[8:]))
+                except ValueError:
+                    pass
+
+        return sorted(generations)
+
+    def record(self, kind, key, field, delta):
+        """ Add `delta' to the counter `field' of the object identified by `kind' and `key' """
+        with self.lock:
+            record_key = (kind, key, field)
+            self.pending[record_key] = self.pending.get(record_key, 0) + delta
+            self.num_records += 1
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.running:
+                    self.cond.wait(self.commit_interval)
+                running = self.running
+
+            try:
+                self.commit()
+            except:
+                log.exception('Unable to write to the journal')
+
+            if not running:
+                break
+
+    def commit(self):
+        """ Write all pending increments to the journal file, and fsync it """
+        with self.write_lock:
+            self._commit()
+
+    def _commit(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            pending = self.pending
+            self.pending = collections.OrderedDict()
+
+        start = time.time()
+        data = ''.join(json.dumps([kind, key, field, delta]) + '\n' for (kind, key, field), delta in pending.items() if delta != 0)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        commit_time = time.time() - start
+        self.num_commits += 1
+        self.num_lines += len(pending)
+        self.total_commit_time += commit_time
+        self.max_commit_time = max(self.max_commit_time, commit_time)
+
+    def rotate(self):
+        """
+        Commit pending increments and start writing to a new journal file.
+        Returns the generation of the file that was closed, which covers
+        every increment recorded so far.
+        """
+        with self.write_lock:
+            self._commit()
+            self.file.close()
+            generation = self.generation
+            self.generation += 1
+            self.file = open(self.filename(self.generation), 'a')
+
+        return generation
+
+    def mark_synced(self, cursor, generation):
+        """ Store the generation covered by a sync. Run this in the same transaction as the sync! """
+        cursor.execute('INSERT INTO `tb_idata` (`id`, `value`, `type`) VALUES(%s, %s, %s) ON DUPLICATE KEY UPDATE value=%s',
+                ('journal_generation', generation, 'value', generation))
+
+    def truncate(self, generation):
+        """ Delete the journal files up to and including `generation' """
+        for old_generation in self.list_generations():
+            if old_generation <= generation:
+                try:
+                    os.remove(self.filename(old_generation))
+                except OSError:
+                    log.exception('Unable to remove old journal file')
+
+    def replay(self, synced_generation, apply):
+        """
+        Call apply(kind, key, field, delta) for every increment in journal
+        files newer than `synced_generation', i.e. increments that never
+        made it to the database. Returns the number of increments replayed.
+        """
+        num_replayed = 0
+        for generation in self.list_generations():
+            if generation <= synced_generation or generation >= self.generation:
+                continue
+
+            with open(self.filename(generation), 'r') as file:
+                for line in file:
+                    try:
+                        kind, key, field, delta = json.loads(line)
+                    except ValueError:
+                        # The bot probably crashed in the middle of a write
+                        log.warning('Skipping broken line in journal file {0}: {1}'.format(generation, line.strip()))
+                        continue
+
+                    try:
+                        apply(kind, key, field, delta)
+                        num_replayed += 1
+                    except:
+                        log.exception('Unable to replay journal line {0}'.format(line.strip()))
+
+        return num_replayed
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        self.file.close()
+
+    def stats(self):
+        avg_commit_time = self.total_commit_time / self.num_commits if self.num_commits > 0 else 0
+        return collections.OrderedDict([
+            ('generation', self.generation),
+            ('pending', len(self.pending)),
+            ('records', self.num_records),
+            ('lines', self.num_lines),
+            ('commits', self.num_commits),
+            ('avg_commit', '{0:.1f}ms'.format(avg_commit_time * 1000)),
+            ('max_commit', '{0:.1f}ms'.format(self.max_commit_time * 1000)),
+            ])
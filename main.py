@@ -14,35 +14,55 @@ os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 log = logging.getLogger('tyggbot')
 
+"""
+--profile-imports has to be handled before anything else is imported,
+so all imports are included in the profile.
+"""
+import_profiler = None
+if __name__ == "__main__" and '--profile-imports' in sys.argv:
+    from importprofiler import ImportProfiler
+    import_profiler = ImportProfiler()
+    import_profiler.start()
+
 from tyggbot import TyggBot
+from bothost import BotHost
 
 
 def run(args):
     from tbutil import load_config
-    config = load_config(args.config)
+    configs = []
+    for config_path in args.config:
+        config = load_config(config_path)
 
-    if 'main' not in config:
-        log.error('Missing section [main] in config')
-        sys.exit(0)
+        if 'main' not in config:
+            log.error('Missing section [main] in config {0}'.format(config_path))
+            sys.exit(0)
 
-    if 'sql' not in config:
-        log.error('Missing section [sql] in config')
-        sys.exit(0)
+        if 'sql' not in config:
+            log.error('Missing section [sql] in config {0}'.format(config_path))
+            sys.exit(0)
+
+        configs.append(config)
+
+    host = BotHost(configs, args)
 
-    tyggbot = TyggBot(config, args)
+    if import_profiler:
+        # Optional integrations are imported when the bot is created, so they are included as well
+        import_profiler.stop()
+        import_profiler.report(log)
 
-    tyggbot.connect()
+    host.connect()
 
     def on_sigterm(signal, frame):
-        tyggbot.quit()
+        host.quit()
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, on_sigterm)
 
     try:
-        tyggbot.start()
+        host.start()
     except KeyboardInterrupt:
-        tyggbot.quit()
+        host.quit()
         pass
 
 
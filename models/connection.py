@@ -1,7 +1,10 @@
 import irc
 from irc.client import InvalidCharacters, MessageTooLong, ServerNotConnectedError
+import concurrent.futures
+import collections
 import socket
 import random
+import time
 
 import logging
 
@@ -41,11 +44,77 @@ class CustomServerConnection(irc.client.ServerConnection):
             self.disconnect("Connection reset by peer.")
 
 
+class Connector:
+    """
+    Opens connections in a bounded pool of threads, so several connections
+    can do their DNS lookup, TCP handshake and login at the same time.
+
+    A failed attempt is retried after an exponentially growing delay
+    (base_delay, 2 * base_delay, ... up to max_delay seconds, with jitter).
+    Retries are scheduled on the timers, so they don't take up a thread
+    while they wait.
+    """
+
+    def __init__(self, timers, max_parallel=8, base_delay=1, max_delay=120):
+        self.timers = timers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel)
+
+        self.num_attempts = 0
+        self.num_connected = 0
+        self.num_failed = 0
+        self.total_connect_time = 0.0
+        self.max_connect_time = 0.0
+
+    def connect(self, open_connection, on_connected=None, description='connection', attempt=0):
+        """
+        Run open_connection() in the pool until it doesn't raise an exception,
+        then call on_connected() (from the pool thread).
+        """
+        self.executor.submit(self._connect, open_connection, on_connected, description, attempt)
+
+    def _connect(self, open_connection, on_connected, description, attempt):
+        self.num_attempts += 1
+        start = time.time()
+        try:
+            open_connection()
+        except:
+            self.num_failed += 1
+            delay = min(self.base_delay * 2 ** attempt, self.max_delay)
+            delay = random.uniform(delay / 2, delay)
+            log.exception('Unable to open {0}, retrying in {1:.1f} seconds'.format(description, delay))
+            self.timers.execute_delayed(delay, self.connect, (open_connection, on_connected, description, attempt + 1))
+            return
+
+        connect_time = time.time() - start
+        self.num_connected += 1
+        self.total_connect_time += connect_time
+        self.max_connect_time = max(self.max_connect_time, connect_time)
+        log.debug('Opened {0} in {1:.0f}ms'.format(description, connect_time * 1000))
+
+        if on_connected:
+            try:
+                on_connected()
+            except:
+                log.exception('Unhandled exception after opening {0}'.format(description))
+
+    def stats(self):
+        avg_connect_time = self.total_connect_time / self.num_connected if self.num_connected > 0 else 0
+        return collections.OrderedDict([
+            ('attempts', self.num_attempts),
+            ('connected', self.num_connected),
+            ('failed', self.num_failed),
+            ('avg_connect', '{0:.0f}ms'.format(avg_connect_time * 1000)),
+            ('max_connect', '{0:.0f}ms'.format(self.max_connect_time * 1000)),
+            ])
+
+
 class Connection:
     def __init__(self, conn):
         self.conn = conn
         self.num_msgs_sent = 0
-        self.in_channel = False
+        self.channels = set()  # channels this connection has joined
 
         return
 
@@ -54,37 +123,37 @@ class Connection:
 
 
 class ConnectionManager:
-    def __init__(self, reactor, tyggbot, message_limit):
+    def __init__(self, reactor, host, message_limit):
         self.backup_conns_number = 2
 
         self.reactor = reactor
-        self.tyggbot = tyggbot
+        self.host = host
         self.message_limit = message_limit
 
         self.connlist = []
+        self.servers_list = []
+        self.num_connecting = 0  # connections that are being opened by the connector
+        self.welcomed = False
 
         self.maintenance_lock = False
 
     def start(self):
         log.debug("Starting connection manager")
         try:
-            for i in range(0, self.backup_conns_number + 1):
-                newconn = self.make_new_connection()
-                self.connlist.append(newconn)
-
-            self.get_main_conn()
+            # Fetch the list of chat servers once before we connect.
+            # After this, the list is refreshed in the background so
+            # reconnecting never has to wait for the Twitch API.
+            self.update_servers_list()
+            self.host.execute_every(10 * 60, self.host.action_queue.add, (self.update_servers_list, [], {}, 'low'))
 
-            if self.tyggbot.phrases['welcome']:
-                phrase_data = {
-                    'nickname': self.tyggbot.nickname,
-                    'version': self.tyggbot.version,
-                     }
-
-            self.tyggbot.say(self.tyggbot.phrases['welcome'].format(**phrase_data))
+            # The connections are opened at the same time, and are added to connlist once they're up
+            for i in range(0, self.backup_conns_number + 1):
+                self.make_new_connection()
 
-            self.reactor.execute_every(4, self.run_maintenance)
+            self.host.execute_every(4, self.run_maintenance)
             return True
         except:
+            log.exception('Unable to start the connection manager')
             return False
 
     def run_maintenance(self):
@@ -110,11 +179,10 @@ class ConnectionManager:
             tmp.append(connection)
 
         self.connlist = tmp  # replace the old list with the newly constructed one
-        need_more = self.backup_conns_number - clean_conns_count
+        need_more = self.backup_conns_number - clean_conns_count - self.num_connecting
 
         for i in range(0, need_more):  # add as many fresh connections as needed
-            newconn = self.make_new_connection()
-            self.connlist.append(newconn)
+            self.make_new_connection()
 
         self.get_main_conn()
         self.maintenance_lock = False
@@ -122,47 +190,73 @@ class ConnectionManager:
     def get_main_conn(self):
         for connection in self.connlist:
             if connection.conn.is_connected():
-                if not connection.in_channel:
-                    if irc.client.is_channel(self.tyggbot.channel):
-                        connection.conn.join(self.tyggbot.channel)
-                        log.debug("Joined channel")
-                        connection.in_channel = True
+                for channel in self.host.bots:
+                    if channel not in connection.channels and irc.client.is_channel(channel):
+                        connection.conn.join(channel)
+                        log.debug("Joined channel {0}".format(channel))
+                        connection.channels.add(channel)
 
                 return connection.conn
 
-        log.error("No connection with is_connected() found in ConnectionManager")
-        self.run_maintenance()
-        return self.get_main_conn()
+        if self.num_connecting == 0:
+            log.error("No connection with is_connected() found in ConnectionManager")
+            self.run_maintenance()
+
+        return None
+
+    def update_servers_list(self):
+        """
+        Refresh the cached list of chat servers.
+        This does a blocking HTTP request, so outside of start() it should
+        only be run from the action queue.
+        """
+        log.debug('Refreshing list of IRC servers')
+        try:
+            data = self.host.twitchapi.get(['channels', self.host.streamer, 'chat_properties'])
+        except:
+            log.exception('Caught exception while fetching IRC servers')
+            return
+
+        if data and len(data.get('chat_servers', [])) > 0:
+            self.servers_list = data['chat_servers']
+        else:
+            log.error("No proper data returned when fetching IRC servers")
 
     def make_new_connection(self):
+        """ Start opening a new connection. It's added to connlist from the main thread once it's up. """
         log.debug("Creating a new IRC connection...")
-        log.debug('Fetching random IRC server...')
-        data = self.tyggbot.twitchapi.get(['channels', self.tyggbot.streamer, 'chat_properties'])
-        if data and len(data['chat_servers']) > 0:
-            server = random.choice(data['chat_servers'])
-            ip, port = server.split(':')
-            port = int(port)
+        if len(self.servers_list) == 0:
+            log.error("No IRC servers available to connect to")
+            return
 
-            log.debug('Fetched {0}:{1}'.format(ip, port))
+        newconn = CustomServerConnection(self.reactor)
+        with self.reactor.mutex:
+            self.reactor.connections.append(newconn)
 
-            try:
-                newconn = CustomServerConnection(self.reactor)
-                with self.reactor.mutex:
-                    self.reactor.connections.append(newconn)
-                newconn.connect(ip, port, self.tyggbot.nickname, self.tyggbot.password, self.tyggbot.nickname)
-                log.debug('Connecting to IRC server...')
-                newconn.cap('REQ', 'twitch.tv/membership')
-                newconn.cap('REQ', 'twitch.tv/commands')
-                newconn.cap('REQ', 'twitch.tv/tags')
-
-                connection = Connection(newconn)
-                return connection
-            except irc.client.ServerConnectionError:
-                return
+        self.num_connecting += 1
+        self.host.connector.connect(lambda: self.open_connection(newconn),
+                lambda: self.host.mainthread_queue.add(self.on_connected, args=[newconn]),
+                'IRC connection')
 
-        else:
-            log.error("No proper data returned when fetching IRC servers")
-            return None
+    def open_connection(self, newconn):
+        """ Connect and log in. This is run by the connector, so it may block. """
+        server = random.choice(self.servers_list)
+        ip, port = server.split(':')
+        port = int(port)
+
+        log.debug('Connecting to IRC server {0}:{1}...'.format(ip, port))
+        newconn.connect(ip, port, self.host.nickname, self.host.password, self.host.nickname)
+        newconn.cap('REQ', 'twitch.tv/membership')
+        newconn.cap('REQ', 'twitch.tv/commands')
+        newconn.cap('REQ', 'twitch.tv/tags')
+
+    def on_connected(self, newconn):
+        self.num_connecting -= 1
+        self.connlist.append(Connection(newconn))
+
+        if not self.welcomed and self.get_main_conn() is not None:
+            self.welcomed = True
+            self.host.on_chat_connected()
 
     def on_disconnect(self, chatconn):
         self.run_maintenance()
@@ -170,12 +264,16 @@ class ConnectionManager:
 
     def privmsg(self, channel, message):
         i = 0
-        while((not self.connlist[i].conn.is_connected()) or self.connlist[i].num_msgs_sent >= self.message_limit):
+        while i < len(self.connlist) and ((not self.connlist[i].conn.is_connected()) or self.connlist[i].num_msgs_sent >= self.message_limit):
             i += 1  # find a usable connection
 
+        if i >= len(self.connlist):
+            log.warning('No usable IRC connection to send a message with')
+            return
+
         self.connlist[i].num_msgs_sent += 1
         self.connlist[i].conn.privmsg(channel, message)
-        self.reactor.execute_delayed(31, self.connlist[i].reduce_msgs_sent)
+        self.host.execute_delayed(31, self.connlist[i].reduce_msgs_sent)
 
         if self.connlist[i].num_msgs_sent >= self.message_limit:
             self.run_maintenance()
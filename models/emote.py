@@ -16,6 +16,7 @@ class Emote:
         self.count = 0
         self.needs_sync = False
         self.regex = None
+        self.journal = None
 
     @classmethod
     def load(cls, cursor, emote_id):
@@ -40,14 +41,30 @@ class Emote:
 
         return emote
 
-    def add(self, count, reactor):
+    @property
+    def journal_key(self):
+        # New emotes get their code from the message, so it's needed to insert them after a replay
+        return (self.emote_id, self.code) if self.emote_id else 'custom_' + self.code
+
+    def get_row(self):
+        return {
+                'id': self.id,
+                'emote_id': self.emote_id,
+                'code': self.code,
+                'count': self.count,
+                'tm_record': self.tm_record,
+                }
+
+    def add(self, count, timers):
         self.count += count
+        if self.journal is not None:
+            self.journal.record('emote', self.journal_key, 'count', count)
         self.tm += count
         self.needs_sync = True
         if self.tm > self.tm_record:
             self.tm_record = self.tm
 
-        reactor.execute_delayed(60, self.reduce, (count, ))
+        timers.execute_delayed(60, self.reduce, (count, ))
 
     def reduce(self, count):
         self.tm -= count
@@ -63,41 +80,44 @@ class Emote:
 
 
 class EmoteManager(UserDict):
-    def __init__(self, sqlconn):
+    def __init__(self, db, journal=None):
         UserDict.__init__(self)
-        self.sqlconn = sqlconn
+        self.db = db
+        self.journal = journal
         self.custom_data = []
 
-    def get_cursor(self):
-        self.sqlconn.ping()
-        return self.sqlconn.cursor(pymysql.cursors.DictCursor)
+    def sync(self, cursor=None):
+        if cursor is None:
+            with self.db.cursor(transaction=True) as cursor:
+                return self.sync(cursor)
 
-    def get_normal_cursor(self):
-        self.sqlconn.ping()
-        return self.sqlconn.cursor()
-
-    def sync(self):
-        self.sqlconn.autocommit(False)
-        cursor = self.get_normal_cursor()
         for emote in [emote for k, emote in self.data.items() if emote.needs_sync]:
             emote.sync(cursor)
 
-        cursor.close()
-        self.sqlconn.autocommit(True)
-
-    def load(self):
+    def load(self, rows=None):
         self.data = {}
         self.custom_data = []
-        cursor = self.get_cursor()
 
-        cursor.execute('SELECT * FROM `tb_emote`')
-        for row in cursor:
+        if rows is None:
+            with self.db.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute('SELECT * FROM `tb_emote`')
+                rows = cursor.fetchall()
+
+        for row in rows:
             emote = Emote.load_from_row(row)
             self.add_to_data(emote)
 
-        cursor.close()
+    def all(self):
+        """ Returns every emote once """
+        emotes = {}
+        for emote in self.data.values():
+            emotes[id(emote)] = emote
+        for emote in self.custom_data:
+            emotes[id(emote)] = emote
+        return list(emotes.values())
 
     def add_to_data(self, emote):
+        emote.journal = self.journal
         if emote.emote_id:
             self.data[emote.emote_id] = emote
             if emote.code:
@@ -116,7 +136,7 @@ class EmoteManager(UserDict):
                 return None
 
             log.info('Adding new emote with ID {0}'.format(value))
-            emote = Emote.load(self.get_cursor(), value)
+            emote = Emote.load(None, value)
             self.add_to_data(emote)
 
         return self.data[key]
@@ -1,13 +1,19 @@
-from bs4 import BeautifulSoup
 from apiwrappers import SafeBrowsingAPI
+from html.parser import HTMLParser
 
-import sys
 import re
 import requests
+import httpclient
 import logging
 import pymysql
 import time
 import urllib.parse
+import threading
+import itertools
+import collections
+import queue
+import codecs
+import concurrent.futures
 
 log = logging.getLogger('tyggbot')
 
@@ -47,6 +53,30 @@ def is_same_url(x, y):
     return parsed_x.netloc == parsed_y.netloc and parsed_x.path.strip('/') == parsed_y.path.strip('/') and parsed_x.query == parsed_y.query
 
 
+# Used when no public suffix list is configured. Any two-letter TLD is also accepted as a country code TLD.
+default_tlds = set(['aero', 'asia', 'biz', 'cat', 'com', 'coop', 'edu', 'gov', 'info', 'int', 'jobs', 'mil', 'mobi', 'museum', 'name', 'net', 'org', 'pro', 'tel', 'travel'])
+
+
+def load_tlds(path):
+    """ Returns the set of top-level domains in a public suffix list (https://publicsuffix.org/list/) """
+    tlds = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('//'):
+                continue
+
+            tld = line.split('.')[-1].lstrip('!*').lower()
+            if len(tld) > 0:
+                tlds.add(tld)
+                try:
+                    tlds.add(tld.encode('idna').decode('ascii'))
+                except UnicodeError:
+                    pass
+
+    return tlds
+
+
 class Url:
     def __init__(self, url):
         self.url = url
@@ -54,62 +84,446 @@ class Url:
 
 
 class LinkCheckerCache:
-    def __init__(self):
-        self.cache = {}
-        return
+    """ Size-bounded LRU cache of link verdicts and redirect targets.
+
+    cache[url] = True means url is safe, False means the link is bad.
+    Safe and bad verdicts expire after safe_ttl and bad_ttl seconds.
+    """
+    def __init__(self, max_size=10000, safe_ttl=300, bad_ttl=3600, redirect_ttl=3600):
+        self.max_size = max_size
+        self.safe_ttl = safe_ttl
+        self.bad_ttl = bad_ttl
+        self.redirect_ttl = redirect_ttl
+
+        self.cache = collections.OrderedDict()  # cache[key] = (safe, expires)
+        self.redirects = collections.OrderedDict()  # redirects[key] = (redirected url, expires)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.redirect_hits = 0
+        self.redirect_misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _key(self, url):
+        return url.strip('/').lower()
+
+    def _get(self, data, key):
+        """ Returns the value stored for key, or None if it's not there or has expired. """
+        entry = data.get(key)
+        if entry is None:
+            return None
+
+        value, expires = entry
+        if expires <= time.time():
+            del data[key]
+            self.expirations += 1
+            return None
+
+        data.move_to_end(key)
+        return value
+
+    def _set(self, data, key, value, ttl):
+        now = time.time()
+        data[key] = (value, now + ttl)
+        data.move_to_end(key)
+
+        # Drop expired entries from the least recently used end, then make room
+        for old_key, (old_value, expires) in list(itertools.islice(data.items(), 8)):
+            if expires > now:
+                break
+            del data[old_key]
+            self.expirations += 1
+
+        while len(data) > self.max_size:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, url):
+        """ Returns True or False if we have a verdict for url, otherwise None. """
+        with self.lock:
+            safe = self._get(self.cache, self._key(url))
+            if safe is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return safe
+
+    def get_redirect(self, url):
+        """ Returns the URL that url last redirected to, or None if we don't know. """
+        with self.lock:
+            redirected_url = self._get(self.redirects, self._key(url))
+            if redirected_url is None:
+                self.redirect_misses += 1
+            else:
+                self.redirect_hits += 1
+            return redirected_url
+
+    def set_redirect(self, url, redirected_url):
+        with self.lock:
+            self._set(self.redirects, self._key(url), redirected_url, self.redirect_ttl)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            redirect_lookups = self.redirect_hits + self.redirect_misses
+            data = collections.OrderedDict()
+            data['size'] = len(self.cache)
+            data['hits'] = self.hits
+            data['misses'] = self.misses
+            data['hit_rate'] = '{0:.1%}'.format(self.hits / lookups if lookups > 0 else 0)
+            data['redirects'] = len(self.redirects)
+            data['redirect_hit_rate'] = '{0:.1%}'.format(self.redirect_hits / redirect_lookups if redirect_lookups > 0 else 0)
+            data['evictions'] = self.evictions
+            data['expirations'] = self.expirations
+            return data
+
+    def dump(self):
+        """ Returns all verdicts and redirects that haven't expired, with their expiry times """
+        with self.lock:
+            now = time.time()
+            return {
+                    'cache': [(key, value, expires) for key, (value, expires) in self.cache.items() if expires > now],
+                    'redirects': [(key, value, expires) for key, (value, expires) in self.redirects.items() if expires > now],
+                    }
+
+    def restore(self, data):
+        """ Restore verdicts and redirects from dump() """
+        with self.lock:
+            now = time.time()
+            for name, entries in (('cache', self.cache), ('redirects', self.redirects)):
+                for key, value, expires in data[name]:
+                    if expires > now:
+                        entries[key] = (value, expires)
+                while len(entries) > self.max_size:
+                    entries.popitem(last=False)
 
     def __getitem__(self, url):
-        return self.cache[url.strip('/').lower()]
+        safe = self.get(url)
+        if safe is None:
+            raise KeyError(url)
+        return safe
 
     def __setitem__(self, url, safe):
-        self.cache[url.strip('/').lower()] = safe
+        with self.lock:
+            self._set(self.cache, self._key(url), safe, self.safe_ttl if safe else self.bad_ttl)
 
     def __contains__(self, url):
-        return url.strip('/').lower() in self.cache
+        with self.lock:
+            return self._get(self.cache, self._key(url)) is not None
 
     def __delitem__(self, url):
-        del self.cache[url.strip('/').lower()]
+        with self.lock:
+            del self.cache[self._key(url)]
+
+
+class LinkCheckerList:
+    """ In-memory copy of a link blacklist or whitelist.
+
+    Entries are stored in a trie keyed on the reversed labels of their domain,
+    so looking up test.pajlada.se walks se -> pajlada -> test and only has to
+    look at the paths stored on those nodes.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, domain, path, level=1):
+        domain = domain.lower()
+        if domain.startswith('www.'):
+            domain = domain[4:]
+
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+
+        # The empty string can never be a domain label, so we use it to store the paths
+        node.setdefault('', []).append((path.lower(), level))
+
+    def find(self, domain, path, min_level=None):
+        """ Returns True if the given domain and path is a subdomain and subpath
+        of any entry in the list, otherwise return False.
+        If min_level is set, entries with a lower level than min_level are ignored. """
+        labels = domain.split('.')
+        if len(labels) < 2:
+            return False
+
+        node = self.root
+        depth = 0
+        for label in reversed(labels):
+            if label not in node:
+                return False
+
+            node = node[label]
+            depth += 1
+
+            # Single-label entries (i.e. only a TLD) are never matched
+            if depth < 2 or '' not in node:
+                continue
+
+            for entry_path, entry_level in node['']:
+                if is_subpath(path, entry_path):
+                    if min_level is None or entry_level >= min_level:
+                        return True
+
+        return False
+
+
+class LinkCheckerHrefExtractor(HTMLParser):
+    """ Incrementally extracts links to external sites from an HTML page.
+
+    Chunks of the page are passed to feed() as they are downloaded, and feed()
+    returns the links to other sites that were found in that chunk.
+    """
+    def __init__(self, netloc, encoding=None, max_links=100):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.netloc = netloc
+        self.max_links = max_links
+        self.num_links = 0
+        self.new_links = []
+
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+        except LookupError:
+            self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    @property
+    def done(self):
+        """ True once we've found as many links as we're willing to check. """
+        return self.num_links >= self.max_links
+
+    def feed(self, chunk):
+        if self.done:
+            return []
+
+        HTMLParser.feed(self, self.decoder.decode(chunk))
+        links = self.new_links
+        self.new_links = []
+        return links
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a' or self.done:
+            return
+
+        for name, value in attrs:
+            if name != 'href' or value is None:
+                continue
+
+            if value.startswith('//'):
+                value = 'http:' + value
+            elif not (value.startswith('http://') or value.startswith('https://')):
+                continue
+
+            url = Url(value)
+            if is_subdomain(url.parsed.netloc, self.netloc):
+                # Internal link
+                continue
+
+            self.new_links.append(url)
+            self.num_links += 1
+
+
+class LinkCheckerJob:
+    """ A pending check of a single URL.
+
+    The job is passed to LinkChecker.check_url as its action, so when the URL
+    turns out to be bad, the actions of everyone who posted it are run.
+    """
+    def __init__(self, url, key, level):
+        self.url = url
+        self.key = key
+        self.domain = urllib.parse.urlparse(url).netloc.lower()
+        self.level = level
+        self.state = 'queued'  # queued, deferred, running or done
+        self.actions = []
+        self.bad = False
+        self.lock = threading.Lock()
+
+    def add_action(self, action):
+        with self.lock:
+            if not self.bad:
+                self.actions.append(action)
+                return
+
+        # The link has already been found to be bad
+        action.run()
+
+    def run(self):
+        with self.lock:
+            self.bad = True
+            actions = self.actions
+            self.actions = []
+
+        for action in actions:
+            action.run()
+
+
+class LinkCheckerQueue:
+    """ Runs link checks on a pool of worker threads.
+
+    Identical URLs that are queued while a check of them is already pending
+    are merged into the pending check.
+    Links from users with a lower level are checked first, and no more than
+    max_per_domain checks of the same domain are run at the same time.
+    """
+    def __init__(self, check_url, num_workers=4, max_per_domain=2):
+        self.check_url = check_url
+        self.max_per_domain = max_per_domain
+
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.jobs = {}  # jobs[key] = LinkCheckerJob, for every job that is not done yet
+        self.num_running = {}  # num_running[domain] = number of checks currently running for that domain
+        self.deferred = {}  # deferred[domain] = deque of jobs waiting for a free slot for that domain
+
+        for i in range(0, num_workers):
+            t = threading.Thread(target=self._worker, name='LinkCheckerWorker-{0}'.format(i))
+            t.daemon = True
+            t.start()
+
+    def add(self, url, action, level=100):
+        key = url.strip('/').lower()
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None:
+                job = LinkCheckerJob(url, key, level)
+                self.jobs[key] = job
+                self._put(job)
+            elif job.state == 'queued' and level < job.level:
+                # Someone with a lower level posted the same link, bump the job.
+                # The old queue entry is skipped by the workers.
+                job.level = level
+                self._put(job)
+
+        job.add_action(action)
+
+    def _put(self, job):
+        self.queue.put((job.level, next(self.counter), job))
+
+    def _worker(self):
+        while True:
+            level, i, job = self.queue.get()
+
+            with self.lock:
+                if job.state != 'queued' or level != job.level:
+                    continue
+
+                if self.num_running.get(job.domain, 0) >= self.max_per_domain:
+                    job.state = 'deferred'
+                    self.deferred.setdefault(job.domain, collections.deque()).append(job)
+                    continue
+
+                job.state = 'running'
+                self.num_running[job.domain] = self.num_running.get(job.domain, 0) + 1
+
+            try:
+                self.check_url(job.url, job)
+            finally:
+                self._finish(job)
+
+    def _finish(self, job):
+        with self.lock:
+            job.state = 'done'
+            del self.jobs[job.key]
+
+            self.num_running[job.domain] -= 1
+            if self.num_running[job.domain] == 0:
+                del self.num_running[job.domain]
+
+            deferred = self.deferred.get(job.domain)
+            if deferred:
+                next_job = deferred.popleft()
+                if len(deferred) == 0:
+                    del self.deferred[job.domain]
+                next_job.state = 'queued'
+                self._put(next_job)
 
 
 class LinkChecker:
-    def __init__(self, bot, run_later):
+    def __init__(self, bot):
         if 'safebrowsingapi' in bot.config['main']:
-            self.safeBrowsingAPI = SafeBrowsingAPI(bot.config['main']['safebrowsingapi'], bot.nickname, bot.version)
+            self.safeBrowsingAPI = SafeBrowsingAPI(bot.config['main']['safebrowsingapi'], bot.nickname, bot.version,
+                    base_url=bot.config['main'].get('safebrowsingapi_url', None),
+                    prefix_file=bot.config['main'].get('safebrowsing_prefixes', None))
         else:
             self.safeBrowsingAPI = None
 
-        try:
-            self.sqlconn = pymysql.connect(unix_socket=bot.config['sql']['unix_socket'], user=bot.config['sql']['user'], passwd=bot.config['sql']['passwd'], charset='utf8')
-            self.sqlconn.select_db(bot.config['sql']['db'])
-        except pymysql.err.OperationalError as e:
-            error_code, error_message = e.args
-            if error_code == 1045:
-                log.error('Access denied to database with user \'{0}\'. Review your config file.'.format(bot.config['sql']['user']))
-            elif error_code == 1044:
-                log.error('Access denied to database \'{0}\' with user \'{1}\'. Make sure the database \'{0}\' exists and user \'{1}\' has full access to it.'.format(bot.config['sql']['db'], bot.config['sql']['user']))
-            else:
-                log.error(e)
-            sys.exit(1)
+        self.db = bot.db
 
-        self.sqlconn.autocommit(True)
+        # The pages we check are arbitrary third-party sites, so they get their own client that never keeps cookies
+        self.http = httpclient.HTTPClient(accept_cookies=False)
 
-        self.regex = re.compile(r'((http:\/\/)|\b)(\w|\.)*\.(((aero|asia|biz|cat|com|coop|edu|gov|info|int|jobs|mil|mobi|museum|name|net|org|pro|tel|travel|[a-zA-Z]{2})\/\S*)|((aero|asia|biz|cat|com|coop|edu|gov|info|int|jobs|mil|mobi|museum|name|net|org|pro|tel|travel|[a-zA-Z]{2}))\b)', re.IGNORECASE)
-        self.run_later = run_later
-        self.cache = LinkCheckerCache()  # cache[url] = True means url is safe, False means the link is bad
+        # Only tokens that contain a dot are matched against url_regex, and the TLD is then looked up in self.tlds
+        self.url_regex = re.compile(r'(https?://)?((?:[\w-]+\.)+[\w-]+)(/\S*)?', re.IGNORECASE)
+        self.tlds = default_tlds
+        self.allow_any_cctld = True
+        if 'linkchecker' in bot.config and 'public_suffix_list' in bot.config['linkchecker']:
+            try:
+                self.tlds = load_tlds(bot.config['linkchecker']['public_suffix_list'])
+                self.allow_any_cctld = False
+                log.debug('LinkChecker: Loaded {0} TLDs from the public suffix list'.format(len(self.tlds)))
+            except OSError:
+                log.exception('LinkChecker: Unable to load the public suffix list')
+        cache_size = 10000
+        safe_ttl = 300
+        bad_ttl = 3600
+        if 'linkchecker' in bot.config:
+            cache_size = int(bot.config['linkchecker'].get('cache_size', cache_size))
+            safe_ttl = int(bot.config['linkchecker'].get('safe_ttl', safe_ttl))
+            bad_ttl = int(bot.config['linkchecker'].get('bad_ttl', bad_ttl))
+
+        self.cache = LinkCheckerCache(cache_size, safe_ttl, bad_ttl)  # cache[url] = True means url is safe, False means the link is bad
+
+        self.blacklist = LinkCheckerList()
+        self.whitelist = LinkCheckerList()
+        self.load_lists()
+
+        num_workers = 4
+        max_per_domain = 2
+        self.max_sublinks = 100
+        self.max_sublinks_in_flight = 8  # per page
+        self.sublink_budget = 10  # seconds per page
+        sublink_workers = 16
+        if 'linkchecker' in bot.config:
+            num_workers = int(bot.config['linkchecker'].get('num_workers', num_workers))
+            max_per_domain = int(bot.config['linkchecker'].get('max_per_domain', max_per_domain))
+            self.max_sublinks = int(bot.config['linkchecker'].get('max_sublinks', self.max_sublinks))
+            self.max_sublinks_in_flight = int(bot.config['linkchecker'].get('max_sublinks_in_flight', self.max_sublinks_in_flight))
+            self.sublink_budget = int(bot.config['linkchecker'].get('sublink_budget', self.sublink_budget))
+            sublink_workers = int(bot.config['linkchecker'].get('sublink_workers', sublink_workers))
+
+        # Shared by all link checks, so the total number of sublink requests is bounded
+        self.sublink_executor = concurrent.futures.ThreadPoolExecutor(max_workers=sublink_workers)
+
+        self.queue = LinkCheckerQueue(self.check_url, num_workers, max_per_domain)
         return
 
-    def delete_from_cache(self, url):
-        if url in self.cache:
-            log.debug("LinkChecker: Removing url {0} from cache".format(url))
-            del self.cache[url]
+    def queue_url(self, url, action, level=100):
+        """ Queue up a check on the given URL. action is run if the URL is bad, usually on one of the worker threads. """
+        self.queue.add(url, action, level)
 
-    def cache_url(self, url, safe):
-        if url in self.cache and self.cache[url] == safe:
-            return
+    def load_lists(self):
+        """ (Re)load the blacklist and whitelist from the database. """
+        blacklist = LinkCheckerList()
+        whitelist = LinkCheckerList()
 
+        with self.db.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute("SELECT * FROM `tb_link_blacklist`")
+            for row in cursor:
+                blacklist.add(row['domain'], row['path'], row['level'])
+
+            cursor.execute("SELECT * FROM `tb_link_whitelist`")
+            for row in cursor:
+                whitelist.add(row['domain'], row['path'])
+
+        self.blacklist = blacklist
+        self.whitelist = whitelist
+        log.debug("LinkChecker: Loaded link blacklist and whitelist")
+
+    def cache_url(self, url, safe):
         log.debug("LinkChecker: Caching url {0}".format(url))
         self.cache[url] = safe
-        self.run_later(20, self.delete_from_cache, (url, ))
 
     def counteract_bad_url(self, url, action=None, want_to_cache=True, want_to_blacklist=True):
         log.debug("LinkChecker: BAD URL FOUND {0}".format(url.url))
@@ -128,8 +542,6 @@ class LinkChecker:
         if parsed_url is None:
             parsed_url = urllib.parse.urlparse(url)
 
-        self.sqlconn.ping()
-        cursor = self.sqlconn.cursor()
         domain = parsed_url.netloc
         path = parsed_url.path
 
@@ -140,7 +552,10 @@ class LinkChecker:
         if path == '':
             path = '/'
 
-        cursor.execute("DELETE FROM `tb_link_" + list_type + "` WHERE `domain`=%s AND `path`=%s", (domain, path))
+        with self.db.cursor() as cursor:
+            cursor.execute("DELETE FROM `tb_link_" + list_type + "` WHERE `domain`=%s AND `path`=%s", (domain, path))
+
+        self.load_lists()
 
     def blacklist_url(self, url, parsed_url=None, level=1):
         if not (url.lower().startswith('http://') or url.lower().startswith('https://')):
@@ -152,8 +567,6 @@ class LinkChecker:
         if self.is_blacklisted(url, parsed_url):
             return
 
-        self.sqlconn.ping()
-        cursor = self.sqlconn.cursor()
         domain = parsed_url.netloc.lower()
         path = parsed_url.path.lower()
 
@@ -164,7 +577,10 @@ class LinkChecker:
         if path == '':
             path = '/'
 
-        cursor.execute("INSERT INTO `tb_link_blacklist` VALUES(%s, %s, %s)", (domain, path, level))
+        with self.db.cursor() as cursor:
+            cursor.execute("INSERT INTO `tb_link_blacklist` VALUES(%s, %s, %s)", (domain, path, level))
+
+        self.blacklist.add(domain, path, level)
 
     def whitelist_url(self, url, parsed_url=None):
         if not (url.lower().startswith('http://') or url.lower().startswith('https://')):
@@ -174,8 +590,6 @@ class LinkChecker:
         if self.is_whitelisted(url, parsed_url):
             return
 
-        self.sqlconn.ping()
-        cursor = self.sqlconn.cursor()
         domain = parsed_url.netloc.lower()
         path = parsed_url.path.lower()
 
@@ -186,11 +600,12 @@ class LinkChecker:
         if path == '':
             path = '/'
 
-        cursor.execute("INSERT INTO `tb_link_whitelist` VALUES(%s, %s)", (domain, path))
+        with self.db.cursor() as cursor:
+            cursor.execute("INSERT INTO `tb_link_whitelist` VALUES(%s, %s)", (domain, path))
+
+        self.whitelist.add(domain, path)
 
     def is_blacklisted(self, url, parsed_url=None, sublink=False):
-        self.sqlconn.ping()
-        cursor = self.sqlconn.cursor(pymysql.cursors.DictCursor)
         if parsed_url is None:
             parsed_url = urllib.parse.urlparse(url)
         domain = parsed_url.netloc.lower()
@@ -198,25 +613,10 @@ class LinkChecker:
         if path == '':
             path = '/'
 
-        domain_split = domain.split('.')
-        if len(domain_split) < 2:
-            return False
-
-        domain_tail = domain_split[-2] + '.' + domain_split[-1]
-        cursor.execute("SELECT * FROM `tb_link_blacklist` WHERE `domain` LIKE %s OR `domain`=%s", ('%' + domain_tail, domain))
-        for row in cursor:
-            if is_subdomain(domain, row['domain']):
-                if is_subpath(path, row['path']):
-                    if not sublink:
-                        return True
-                    elif row['level'] >= 1:  # if it's a sublink, but the blacklisting level is 0, we don't consider it blacklisted
-                        return True
-
-        return False
+        # if it's a sublink, but the blacklisting level is 0, we don't consider it blacklisted
+        return self.blacklist.find(domain, path, min_level=1 if sublink else None)
 
     def is_whitelisted(self, url, parsed_url=None):
-        self.sqlconn.ping()
-        cursor = self.sqlconn.cursor(pymysql.cursors.DictCursor)
         if parsed_url is None:
             parsed_url = urllib.parse.urlparse(url)
         domain = parsed_url.netloc.lower()
@@ -224,18 +624,7 @@ class LinkChecker:
         if path == '':
             path = '/'
 
-        domain_split = domain.split('.')
-        if len(domain_split) < 2:
-            return
-
-        domain_tail = domain_split[-2] + '.' + domain_split[-1]
-        cursor.execute("SELECT * FROM `tb_link_whitelist` WHERE `domain` LIKE %s OR `domain`=%s", ('%' + domain_tail, domain))
-        for row in cursor:
-            if is_subdomain(domain, row['domain']):
-                if is_subpath(path, row['path']):
-                    return True
-
-        return False
+        return self.whitelist.find(domain, path)
 
     def basic_check(self, url, action, sublink=False):
         """
@@ -244,9 +633,10 @@ class LinkChecker:
         -1 = Link is bad
         0 = Link needs further analysis
         """
-        if url.url in self.cache:
+        safe = self.cache.get(url.url)
+        if safe is not None:
             log.debug("LinkChecker: Url {0} found in cache".format(url.url))
-            if not self.cache[url.url]:  # link is bad
+            if not safe:  # link is bad
                 self.counteract_bad_url(url, action, False, False)
                 return -1
             return 1
@@ -275,16 +665,22 @@ class LinkChecker:
             log.exception("LinkChecker unhanled exception while _check_url")
 
     def _check_url(self, url, action):
-        self.sqlconn.ping()
         log.debug("LinkChecker: Checking url {0}".format(url.url))
 
         if self.basic_check(url, action):
             return
 
+        # If we know where this link redirected to last time, we might not need to send a HEAD request at all
+        redirected = self.cache.get_redirect(url.url)
+        if redirected is not None:
+            log.debug("LinkChecker: Url {0} redirects to {1} (cached)".format(url.url, redirected))
+            if self.basic_check(Url(redirected), action):
+                return
+
         connection_timeout = 2
         read_timeout = 1
         try:
-            r = requests.head(url.url, allow_redirects=True, timeout=connection_timeout)
+            r = self.http.head(url.url, allow_redirects=True, timeout=connection_timeout, retries=0)
         except:
             self.cache_url(url.url, True)
             return
@@ -298,6 +694,7 @@ class LinkChecker:
 
         redirected_url = Url(r.url)
         if not is_same_url(url, redirected_url):
+            self.cache.set_redirect(url.url, redirected_url.url)
             if self.basic_check(redirected_url, action):
                 return
 
@@ -313,20 +710,50 @@ class LinkChecker:
         maximum_size = 1024 * 1024 * 10  # 10 MB
         receive_timeout = 3
 
-        html = ''
+        original_url = url
+        original_redirected_url = redirected_url
+
         try:
-            response = requests.get(url=url.url, stream=True, timeout=(connection_timeout, read_timeout))
+            response = self.http.get(url.url, stream=True, timeout=(connection_timeout, read_timeout), retries=0)
+        except requests.exceptions.ConnectTimeout:
+            log.error('Connection timed out while checking {0}'.format(url.url))
+            self.cache_url(url.url, True)
+            return
+        except requests.exceptions.ReadTimeout:
+            log.error('Reading timed out while checking {0}'.format(url.url))
+            self.cache_url(url.url, True)
+            return
+        except:
+            log.exception('Unhandled exception')
+            return
 
+        # Sublinks are checked concurrently as soon as they show up in the page.
+        # The first bad sublink cancels the remaining checks and stops the download.
+        cancelled = threading.Event()
+        pending = set()
+        checked = set()
+        deadline = time.time() + self.sublink_budget
+        bad = None
+
+        try:
             content_length = response.headers.get('Content-Length')
-            if content_length and int(response.headers.get('Content-Length')) > maximum_size:
+            if content_length and int(content_length) > maximum_size:
                 log.error('This file is too big!')
                 return
 
+            extractor = LinkCheckerHrefExtractor(original_url.parsed.netloc, response.encoding, self.max_sublinks)
+            chunks = response.iter_content(1024)
             size = 0
-            start = time.time()
+            download_time = 0
 
-            for chunk in response.iter_content(1024):
-                if time.time() - start > receive_timeout:
+            while not extractor.done and bad is None:
+                start = time.time()
+                chunk = next(chunks, None)
+                download_time += time.time() - start
+                if chunk is None:
+                    break
+
+                if download_time > receive_timeout:
                     log.error('The site took too long to load')
                     return
 
@@ -334,12 +761,31 @@ class LinkChecker:
                 if size > maximum_size:
                     log.error('This file is too big! (fake header)')
                     return
-                html += str(chunk)
 
-        except requests.exceptions.ConnectTimeout:
-            log.error('Connection timed out while checking {0}'.format(url.url))
-            self.cache_url(url.url, True)
-            return
+                for sublink in extractor.feed(chunk):
+                    domain = sublink.parsed.netloc.lower()
+                    if domain.startswith('www.'):
+                        domain = domain[4:]
+                    key = (domain, sublink.parsed.path.strip('/').lower())
+                    if key in checked:
+                        continue
+                    checked.add(key)
+
+                    while len(pending) >= self.max_sublinks_in_flight and bad is None and time.time() < deadline:
+                        bad = self._wait_for_sublinks(pending, deadline)
+
+                    if bad is not None:
+                        break
+
+                    if time.time() >= deadline:
+                        log.error('Ran out of time while checking the links on {0}'.format(original_url.url))
+                        return
+
+                    pending.add(self.sublink_executor.submit(self._check_sublink, sublink, cancelled, connection_timeout))
+
+            while len(pending) > 0 and bad is None and time.time() < deadline:
+                bad = self._wait_for_sublinks(pending, deadline)
+
         except requests.exceptions.ReadTimeout:
             log.error('Reading timed out while checking {0}'.format(url.url))
             self.cache_url(url.url, True)
@@ -347,80 +793,109 @@ class LinkChecker:
         except:
             log.exception('Unhandled exception')
             return
+        finally:
+            cancelled.set()
+            for future in pending:
+                future.cancel()
+            response.close()
+
+        if bad is not None:
+            reason, bad_url, bad_redirected_url = bad
+            if reason == 'safebrowsing':
+                log.debug("Evil sublink {0} by google API".format(bad_url.url))
+                self.counteract_bad_url(original_url, action)
+                self.counteract_bad_url(original_redirected_url)
+                self.counteract_bad_url(bad_url)
+                self.counteract_bad_url(bad_redirected_url)
+            else:
+                if action:
+                    action.run()
+                self.counteract_bad_url(bad_url)
+                self.counteract_bad_url(original_url, want_to_blacklist=False)
+                self.counteract_bad_url(original_redirected_url, want_to_blacklist=False)
+            return
 
-        try:
-            soup = BeautifulSoup(html, 'html.parser')
-        except:
+        if len(pending) > 0:
+            log.error('Ran out of time while checking the links on {0}'.format(original_url.url))
             return
 
-        original_url = url
-        original_redirected_url = redirected_url
-        urls = []
-        for link in soup.find_all('a'):  # get a list of links to external sites
-            url = link.get('href')
-            if url is None:
-                continue
-            if url.startswith('//'):
-                urls.append('http:' + url)
-            elif url.startswith('http://') or url.startswith('https://'):
-                urls.append(url)
+        # if we got here, the site is clean for our standards
+        self.cache_url(original_url.url, True)
+        self.cache_url(original_redirected_url.url, True)
+        return
 
-        for url in urls:  # check if the site links to anything dangerous
-            url = Url(url)
+    def _wait_for_sublinks(self, pending, deadline):
+        """ Wait until at least one of the pending sublink checks is done, or we run out of time.
+        Finished checks are removed from pending. Returns the result of a bad sublink if one was found. """
+        done, not_done = concurrent.futures.wait(pending, timeout=max(0, deadline - time.time()), return_when=concurrent.futures.FIRST_COMPLETED)
+        pending.difference_update(done)
 
-            if is_subdomain(url.parsed.netloc, original_url.parsed.netloc):
-                # log.debug("Skipping because internal link")
-                continue
+        for future in done:
+            if not future.cancelled() and future.result() is not None:
+                return future.result()
+
+        return None
+
+    def _check_sublink(self, url, cancelled, connection_timeout):
+        """ Check a link found on the page we're checking. This is run in the sublink executor.
+        Returns None if the link looks fine, otherwise a tuple (reason, url, redirected_url). """
+        try:
+            if cancelled.is_set():
+                return None
 
             log.debug("Checking sublink {0}".format(url.url))
-            res = self.basic_check(url, action, sublink=True)
+            res = self.basic_check(url, None, sublink=True)
             if res == -1:
-                self.counteract_bad_url(url)
-                self.counteract_bad_url(original_url, want_to_blacklist=False)
-                self.counteract_bad_url(original_redirected_url, want_to_blacklist=False)
-                return
+                return ('listed', url, None)
             elif res == 1:
-                continue
+                return None
+
+            if cancelled.is_set():
+                return None
 
             try:
-                r = requests.head(url.url, allow_redirects=True, timeout=connection_timeout)
+                r = self.http.head(url.url, allow_redirects=True, timeout=connection_timeout, retries=0)
             except:
-                continue
+                return None
 
             redirected_url = Url(r.url)
             if not is_same_url(url, redirected_url):
-                res = self.basic_check(redirected_url, action, sublink=True)
+                res = self.basic_check(redirected_url, None, sublink=True)
                 if res == -1:
-                    self.counteract_bad_url(url)
-                    self.counteract_bad_url(original_url, want_to_blacklist=False)
-                    self.counteract_bad_url(original_redirected_url, want_to_blacklist=False)
-                    return
+                    return ('listed', url, redirected_url)
                 elif res == 1:
-                    continue
+                    return None
 
-            if self.safeBrowsingAPI:
+            if self.safeBrowsingAPI and not cancelled.is_set():
                 if self.safeBrowsingAPI.check_url(redirected_url.url):  # harmful url detected
-                    log.debug("Evil sublink {0} by google API".format(url))
-                    self.counteract_bad_url(original_url, action)
-                    self.counteract_bad_url(original_redirected_url)
-                    self.counteract_bad_url(url)
-                    self.counteract_bad_url(redirected_url)
-                    return
+                    return ('safebrowsing', url, redirected_url)
+        except:
+            log.exception('Unhandled exception while checking sublink {0}'.format(url.url))
 
-        # if we got here, the site is clean for our standards
-        self.cache_url(original_url.url, True)
-        self.cache_url(original_redirected_url.url, True)
-        return
+        return None
+
+    def is_tld(self, tld):
+        tld = tld.lower()
+        return tld in self.tlds or (self.allow_any_cctld and len(tld) == 2 and tld.isalpha())
 
     def find_urls_in_message(self, msg_raw):
-        _urls = self.regex.finditer(msg_raw)
-        urls = []
-        for i in _urls:
-            url = i.group(0)
-            if not (url.startswith('http://') or url.startswith('https://')):
-                url = 'http://' + url
-            if not(url[-1].isalpha() or url[-1].isnumeric() or url[-1] == '/'):
-                url = url[:-1]
-            urls.append(url)
-
-        return set(urls)
+        if '.' not in msg_raw:
+            return set()
+
+        urls = set()
+        for token in msg_raw.split():
+            if '.' not in token:
+                continue
+
+            # A token can contain several dotted strings (e.g. "1.5,example.com"), so check every match
+            for match in self.url_regex.finditer(token):
+                scheme, domain, path = match.groups()
+                if not self.is_tld(domain.rsplit('.', 1)[1]):
+                    continue
+
+                url = (scheme or 'http://') + domain + (path or '')
+                if not(url[-1].isalpha() or url[-1].isnumeric() or url[-1] == '/'):
+                    url = url[:-1]
+                urls.add(url)
+
+        return urls
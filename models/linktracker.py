@@ -1,58 +1,44 @@
 import logging
 import datetime
-import pymysql
+import hashlib
 from urllib.parse import urlsplit
 
 log = logging.getLogger('tyggbot')
 
 
 class LinkTrackerLink:
-    @classmethod
-    def load(cls, cursor, url):
-        link = cls()
-
-        cursor.execute('SELECT * FROM `tb_link_data` WHERE `url`=%s', [url])
-        row = cursor.fetchone()
-        if row:
-            # We found a link matching this URL in the database!
-            link.id = row['id']
-            link.url = row['url']
-            link.times_linked = row['times_linked']
-            link.first_linked = row['first_linked']
-            link.last_linked = row['last_linked']
-            link.needs_sync = False
-        else:
-            # No link was found with this URL, create a new one!
-            link.id = -1
-            link.url = url
-            link.times_linked = 0
-            link.first_linked = datetime.datetime.now()
-            link.last_linked = datetime.datetime.now()
-            link.needs_sync = False
-
-        return link
+    def __init__(self, url):
+        self.url = url
+        self.url_hash = hashlib.md5(url.encode('utf-8')).hexdigest()
+        self.times_linked = 0
+        self.first_linked = datetime.datetime.now()
+        self.last_linked = self.first_linked
 
     def increment(self):
         self.times_linked += 1
         self.last_linked = datetime.datetime.now()
-        self.needs_sync = True
-
-    def sync(self, cursor):
-        _first_linked = self.first_linked.strftime('%Y-%m-%d %H:%M:%S')
-        _last_linked = self.last_linked.strftime('%Y-%m-%d %H:%M:%S')
-        if self.id == -1:
-            cursor.execute('INSERT INTO `tb_link_data` (`url`, `times_linked`, `first_linked`, `last_linked`) VALUES (%s, %s, %s, %s)',
-                    [self.url, self.times_linked, _first_linked, _last_linked])
-            self.id = cursor.lastrowid
-        else:
-            cursor.execute('UPDATE `tb_link_data` SET `times_linked`=%s, `last_linked`=%s WHERE `id`=%s',
-                    [self.times_linked, _last_linked, self.id])
+
+    def merge(self, other):
+        self.times_linked += other.times_linked
+        self.first_linked = min(self.first_linked, other.first_linked)
+        self.last_linked = max(self.last_linked, other.last_linked)
+
+    def get_row(self):
+        return (self.url_hash, self.url, self.times_linked,
+                self.first_linked.strftime('%Y-%m-%d %H:%M:%S'),
+                self.last_linked.strftime('%Y-%m-%d %H:%M:%S'))
 
 
 class LinkTracker:
-    def __init__(self, sqlconn):
-        self.sqlconn = sqlconn
-        self.links = {}
+    """
+    Keeps track of how many times links are posted in chat.
+
+    Links are only counted in memory when they're posted, and are written
+    to the database in one batch when sync() is called.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.links = {}  # Links that have been posted since the last sync
 
     def add(self, url):
         url_data = urlsplit(url)
@@ -73,14 +59,29 @@ class LinkTracker:
 
         url = netloc + path + query
         if url not in self.links:
-            self.links[url] = LinkTrackerLink.load(self.sqlconn.cursor(pymysql.cursors.DictCursor), url)
+            self.links[url] = LinkTrackerLink(url)
 
         self.links[url].increment()
 
-    def sync(self):
-        self.sqlconn.autocommit(False)
-        cursor = self.sqlconn.cursor()
-        for link in [link for k, link in self.links.items() if link.needs_sync]:
-            link.sync(cursor)
-        cursor.close()
-        self.sqlconn.autocommit(True)
+    def sync(self, cursor=None):
+        if len(self.links) == 0:
+            return
+
+        if cursor is None:
+            with self.db.cursor(transaction=True) as cursor:
+                return self.sync(cursor)
+
+        links = self.links
+        self.links = {}
+
+        try:
+            cursor.executemany('INSERT INTO `tb_link_data` (`url_hash`, `url`, `times_linked`, `first_linked`, `last_linked`) VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE `times_linked`=`times_linked`+VALUES(`times_linked`), `last_linked`=VALUES(`last_linked`)',
+                    [link.get_row() for link in links.values()])
+        except:
+            log.exception('Caught exception while syncing link data')
+
+            # Put the links back, so they're synced the next time around
+            for url, link in links.items():
+                if url in self.links:
+                    link.merge(self.links[url])
+                self.links[url] = link
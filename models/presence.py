@@ -0,0 +1,94 @@
+import time
+
+import logging
+
+log = logging.getLogger('tyggbot')
+
+
+class PresenceManager:
+    """
+    Keeps track of which users are in chat, and since when.
+
+    The set is updated from the JOIN/PART/NAMES messages we get from the
+    IRC server (twitch.tv/membership). Twitch only sends these in batches,
+    and not at all for regular users in big channels, so the chatters list
+    from TMI is still used every now and then to reconcile the set.
+    All methods are meant to be run from the main thread.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.present = {}  # present[username] = time the user joined
+        self.to_preload = set()
+        self.last_accrual = time.time()
+
+    def __contains__(self, username):
+        return username in self.present
+
+    def __len__(self):
+        return len(self.present)
+
+    def join(self, username):
+        username = username.lower()
+        if username not in self.present:
+            self.present[username] = time.time()
+            if username not in self.users.data:
+                self.to_preload.add(username)
+
+    def part(self, username):
+        self.present.pop(username.lower(), None)
+
+    def names(self, usernames):
+        """ Handle a NAMES reply, which lists users already in chat """
+        for username in usernames:
+            self.join(username.lstrip('@+'))
+
+    def reconcile(self, chatters, fetched_at):
+        """
+        Reconcile the presence set with a chatters snapshot that was
+        fetched at `fetched_at'. Users who joined after the snapshot was
+        fetched are kept even if they're not in the snapshot.
+        """
+        num_joined = 0
+        for username in chatters:
+            if username not in self.present:
+                self.join(username)
+                num_joined += 1
+
+        left = [username for username, joined_at in self.present.items() if joined_at < fetched_at and username not in chatters]
+        for username in left:
+            del self.present[username]
+
+        log.debug('Presence reconciled: {0} missing joins, {1} missing parts, {2} users present'.format(num_joined, len(left), len(self.present)))
+
+    def preload(self):
+        """ Load users who have joined the chat, before they write their first message """
+        if len(self.to_preload) == 0:
+            return
+
+        usernames = self.to_preload
+        self.to_preload = set()
+        self.users.preload(usernames)
+
+    def accrue(self, is_online):
+        """
+        Credit minutes in chat (and points, if the stream is online) to
+        every user in chat, based on how long they have been present since
+        the last time this was run.
+        """
+        now = time.time()
+        interval = now - self.last_accrual
+        self.last_accrual = now
+
+        self.users.preload(self.present.keys())
+
+        for username, joined_at in self.present.items():
+            minutes = int(min(interval, now - joined_at) / 60 + 0.5)
+            if minutes <= 0:
+                continue
+
+            user = self.users[username]
+            user.add_minutes_in_chat(minutes, is_online)
+
+            points = 1 if is_online else 0
+            user.touch(points * (5 if user.subscriber else 1))
@@ -10,6 +10,7 @@ class User:
     def __init__(self):
         self.needs_sync = False
         self.ban_immune = False
+        self.journal = None
 
     def remove_ban_immunity(self):
         self.ban_immune = False
@@ -34,17 +35,7 @@ class User:
         row = cursor.fetchone()
         if row:
             # We found a user in the database!
-            user.id = row['id']
-            user.username = row['username']
-            user.username_raw = row['username_raw']
-            user.level = row['level']
-            user.num_lines = row['num_lines']
-            user.subscriber = row['subscriber'] == 1
-            user.points = row['points']
-            user.last_seen = row['last_seen']
-            user.last_active = row['last_active']
-            user.minutes_in_chat_online = row['minutes_in_chat_online']
-            user.minutes_in_chat_offline = row['minutes_in_chat_offline']
+            user.load_row(row)
         else:
             # No user was found with this username, create a new one!
             user.id = -1  # An ID of -1 means it will be inserted on sync
@@ -62,9 +53,42 @@ class User:
 
         return user
 
+    def get_row(self):
+        return {
+                'id': self.id,
+                'username': self.username,
+                'username_raw': self.username_raw,
+                'level': self.level,
+                'num_lines': self.num_lines,
+                'subscriber': 1 if self.subscriber else 0,
+                'points': self.points,
+                'last_seen': self.last_seen,
+                'last_active': self.last_active,
+                'minutes_in_chat_online': self.minutes_in_chat_online,
+                'minutes_in_chat_offline': self.minutes_in_chat_offline,
+                }
+
+    def load_row(self, row):
+        self.id = row['id']
+        self.username = row['username']
+        self.username_raw = row['username_raw']
+        self.level = row['level']
+        self.num_lines = row['num_lines']
+        self.subscriber = row['subscriber'] == 1
+        self.points = row['points']
+        self.last_seen = row['last_seen']
+        self.last_active = row['last_active']
+        self.minutes_in_chat_online = row['minutes_in_chat_online']
+        self.minutes_in_chat_offline = row['minutes_in_chat_offline']
+
+    def journal_increment(self, field, delta):
+        if self.journal is not None:
+            self.journal.record('user', self.username, field, delta)
+
     def spend(self, points_to_spend):
         if points_to_spend <= self.points:
             self.points -= points_to_spend
+            self.journal_increment('points', -points_to_spend)
             self.needs_sync = True
             return True
 
@@ -85,7 +109,18 @@ class User:
 
     def touch(self, add_points=0):
         self.last_seen = datetime.datetime.now()
-        self.points += add_points
+        if add_points != 0:
+            self.points += add_points
+            self.journal_increment('points', add_points)
+        self.needs_sync = True
+
+    def add_minutes_in_chat(self, minutes, is_online):
+        if is_online:
+            self.minutes_in_chat_online += minutes
+            self.journal_increment('minutes_in_chat_online', minutes)
+        else:
+            self.minutes_in_chat_offline += minutes
+            self.journal_increment('minutes_in_chat_offline', minutes)
         self.needs_sync = True
 
     def wrote_message(self, add_line=True):
@@ -93,30 +128,54 @@ class User:
         self.last_seen = datetime.datetime.now()
         if add_line:
             self.num_lines += 1
+            self.journal_increment('num_lines', 1)
         self.needs_sync = True
 
 
 class UserManager(UserDict):
-    def __init__(self, sqlconn):
+    def __init__(self, db, journal=None):
         UserDict.__init__(self)
-        self.sqlconn = sqlconn
-
-    def get_cursor(self):
-        self.sqlconn.ping()
-        return self.sqlconn.cursor(pymysql.cursors.DictCursor)
+        self.db = db
+        self.journal = journal
 
-    def get_normal_cursor(self):
-        self.sqlconn.ping()
-        return self.sqlconn.cursor()
+    def sync(self, cursor=None):
+        if cursor is None:
+            with self.db.cursor(transaction=True) as cursor:
+                return self.sync(cursor)
 
-    def sync(self):
-        self.sqlconn.autocommit(False)
-        cursor = self.get_normal_cursor()
         for user in [user for k, user in self.data.items() if user.needs_sync]:
             user.sync(cursor)
 
-        cursor.close()
-        self.sqlconn.autocommit(True)
+    def preload(self, usernames, batch_size=500):
+        """
+        Load the given users from the database in batches,
+        so accessing them later doesn't need one query per user.
+        Users that aren't in the database are not created.
+        """
+        usernames = [username.lower() for username in usernames if username.lower() not in self.data]
+        if len(usernames) == 0:
+            return
+
+        with self.db.cursor(pymysql.cursors.DictCursor) as cursor:
+            for i in range(0, len(usernames), batch_size):
+                batch = usernames[i:i + batch_size]
+                cursor.execute('SELECT * FROM `tb_user` WHERE `username` IN ({0})'.format(', '.join(['%s'] * len(batch))), batch)
+                self.load_rows(cursor)
+
+    def load_rows(self, rows):
+        """ Add users from database rows, unless they are already loaded """
+        for row in rows:
+            if row['username'] not in self.data:
+                user = User()
+                user.load_row(row)
+                user.journal = self.journal
+                self.data[row['username']] = user
+
+    def get_hot_rows(self, max_users):
+        """ Returns the rows of the `max_users' users seen most recently """
+        users = [user for user in self.data.values() if user.id != -1 and user.last_seen]
+        users.sort(key=lambda user: user.last_seen, reverse=True)
+        return [user.get_row() for user in users[:max_users]]
 
     def find(self, username):
         user = self[username]
@@ -127,6 +186,8 @@ class UserManager(UserDict):
 
     def __getitem__(self, key):
         if key not in self.data:
-            self.data[key] = User.load(self.get_cursor(), key)
+            with self.db.cursor(pymysql.cursors.DictCursor) as cursor:
+                self.data[key] = User.load(cursor, key)
+            self.data[key].journal = self.journal
 
         return self.data[key]
@@ -1,8 +1,9 @@
 import random
-import requests
+import httpclient
 from queue import Queue
 import threading
 import json
+import time
 import pymysql
 
 import logging
@@ -23,21 +24,34 @@ class WhisperConnection:
         self.name = name
         self.oauth = oauth
 
+        self.connecting = False  # being opened by the connector
+        self.ready = False  # logged in (the server has sent its welcome message)
+
     def reduce_msgs_sent(self):
         self.num_msgs_sent -= 1
 
+    def is_usable(self, message_limit):
+        return self.ready and self.conn.is_connected() and self.num_msgs_sent < message_limit
+
 
 class WhisperConnectionManager:
-    def __init__(self, reactor, tyggbot, target, message_limit, time_interval, num_of_conns=30):
+    def __init__(self, reactor, host, target, message_limit, time_interval, num_of_conns=30):
         self.reactor = reactor
-        self.tyggbot = tyggbot
+        self.host = host
         self.message_limit = message_limit
         self.time_interval = time_interval
         self.num_of_conns = num_of_conns
 
         self.connlist = []
+        self.servers_list = []
         self.whispers = Queue()
 
+        # Guards connlist and the state of its connections, and wakes up
+        # the whisper sender when a connection becomes usable
+        self.cond = threading.Condition()
+
+        self.start_time = 0.0
+
         self.maintenance_lock = False
 
     def __contains__(self, connection):
@@ -46,49 +60,57 @@ class WhisperConnectionManager:
     def start(self, accounts=[]):
         log.debug("Starting connection manager")
         try:
+            self.start_time = time.time()
+
             # Update available group servers.
             # This will also be run at an interval to make sure it's up to date
             self.update_servers_list()
-            self.reactor.execute_every(3600, self.update_servers_list)
+            self.host.execute_every(3600, self.host.action_queue.add, (self.update_servers_list, [], {}, 'low'))
 
             # Run the maintenance function every 4 seconds.
             # The maintenance function is responsible for reconnecting lost connections.
-            self.reactor.execute_every(4, self.run_maintenance)
+            self.host.execute_every(4, self.run_maintenance)
 
             # Fetch additional whisper accounts from the database
-            self.tyggbot.sqlconn.ping()
-            cursor = self.tyggbot.sqlconn.cursor(pymysql.cursors.DictCursor)
-            cursor.execute("SELECT `username`, `oauth` FROM `tb_whisper_account` WHERE `enabled`=1 ORDER BY RAND() LIMIT %s", self.num_of_conns)
-            for row in cursor:
-                accounts.append(row)
-
-            # Start the connections.
-            t = threading.Thread(target=self.start_connections, args=[accounts])
+            with self.host.db.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute("SELECT `username`, `oauth` FROM `tb_whisper_account` WHERE `enabled`=1 ORDER BY RAND() LIMIT %s", self.num_of_conns)
+                for row in cursor:
+                    accounts.append(row)
+
+            # Start sending whispers right away, every connection is used as soon as it's logged in
+            t = threading.Thread(target=self.whisper_sender)
             t.daemon = True
             t.start()
 
+            # Open all the connections at the same time
+            for account in accounts:
+                self.make_new_connection(account['username'], account['oauth'])
+
             return True
         except:
             log.exception("WhisperConnectionManager: Unhandled exception")
             return False
 
-    def start_connections(self, accounts):
-        for account in accounts:
-            newconn = self.make_new_connection(account['username'], account['oauth'])
-            self.connlist.append(newconn)
-
-        t = threading.Thread(target=self.whisper_sender)  # start a loop sending whispers in a thread
-        t.daemon = True
-        t.start()
-
     def quit(self):
         for connection in self.connlist:
-            connection.conn.quit('bye')
+            if connection.conn.is_connected():
+                connection.conn.quit('bye')
 
     def update_servers_list(self):
-            log.debug("Refreshing list of whisper servers")
-            servers_list = json.loads(requests.get("http://tmi.twitch.tv/servers?cluster=group").text)
-            self.servers_list = servers_list['servers']
+        """
+        Refresh the cached list of group servers.
+        This does a blocking HTTP request, so outside of start() it should
+        only be run from the action queue.
+        """
+        log.debug("Refreshing list of whisper servers")
+        try:
+            servers_list = json.loads(httpclient.get("http://tmi.twitch.tv/servers?cluster=group").text)
+            if len(servers_list['servers']) > 0:
+                self.servers_list = servers_list['servers']
+        except:
+            if len(self.servers_list) == 0:
+                raise
+            log.exception("Caught exception while refreshing whisper servers, keeping the old list")
 
     def whisper_sender(self):
         while True:
@@ -96,28 +118,39 @@ class WhisperConnectionManager:
             username = whisp.target
             message = whisp.message
 
-            i = 0
-            while((not self.connlist[i].conn.is_connected()) or self.connlist[i].num_msgs_sent >= self.message_limit):
-                i += 1  # find a usable connection
-                if i >= len(self.connlist):
-                    i = 0
+            connection = self.get_usable_connection()
 
             log.debug('Sending whisper: {0} {1}'.format(username, message))
-            self.connlist[i].conn.privmsg('#jtv', '/w {0} {1}'.format(username, message))
-            self.connlist[i].num_msgs_sent += 1
-            self.connlist[i].conn.execute_delayed(self.time_interval, self.connlist[i].reduce_msgs_sent)
+            connection.conn.privmsg('#jtv', '/w {0} {1}'.format(username, message))
+            self.host.execute_delayed(self.time_interval, self.reduce_msgs_sent, (connection, ))
+
+    def get_usable_connection(self):
+        """ Wait until a connection is logged in and below the rate limit, and reserve a message on it """
+        with self.cond:
+            while True:
+                for connection in self.connlist:
+                    if connection.is_usable(self.message_limit):
+                        connection.num_msgs_sent += 1
+                        return connection
+
+                # Woken up by on_welcome and reduce_msgs_sent, the timeout covers connections that come back some other way
+                self.cond.wait(1)
+
+    def reduce_msgs_sent(self, connection):
+        with self.cond:
+            connection.reduce_msgs_sent()
+            self.cond.notify()
 
     def run_maintenance(self):
         if self.maintenance_lock:
             return
-        
+
         self.maintenance_lock = True
-        for connection in self.connlist:
-            if not connection.conn.is_connected():
-                connection.conn.close()
-                self.connlist.remove(connection)
-                newconn = self.make_new_connection(connection.name, connection.oauth)
-                self.connlist.append(newconn)
+        with self.cond:
+            lost_connections = [connection for connection in self.connlist if not connection.connecting and not connection.conn.is_connected()]
+
+        for connection in lost_connections:
+            self.connect(connection)
 
         self.maintenance_lock = False
 
@@ -129,19 +162,55 @@ class WhisperConnectionManager:
         log.error("No connection with is_connected() found in WhisperConnectionManager")
 
     def make_new_connection(self, name, oauth):
+        connection = WhisperConnection(self.reactor.server(), name, oauth)
+
+        # Add the connection before it's opened, so its welcome message is recognized in the dispatcher
+        with self.cond:
+            self.connlist.append(connection)
+
+        self.connect(connection)
+        return connection
+
+    def connect(self, connection):
+        """ (Re)open a connection with the connector. It's used for whispers once on_welcome is called for it. """
+        with self.cond:
+            connection.connecting = True
+            connection.ready = False
+
+        self.host.connector.connect(lambda: self.open_connection(connection),
+                lambda: self.on_connected(connection),
+                'whisper connection for {0}'.format(connection.name))
+
+    def open_connection(self, connection):
+        """ Connect and log in. This is run by the connector, so it may block. """
         server = random.choice(self.servers_list)
         ip, port = server.split(':')
         port = int(port)
         log.debug("Whispers: Connection to server {0}".format(server))
 
-        newconn = self.reactor.server().connect(ip, port, name, oauth, name)
-        newconn.cap('REQ', 'twitch.tv/commands')
-        return WhisperConnection(newconn, name, oauth)
+        connection.conn.connect(ip, port, connection.name, connection.oauth, connection.name)
+        connection.conn.cap('REQ', 'twitch.tv/commands')
+
+    def on_connected(self, connection):
+        with self.cond:
+            connection.connecting = False
+
+    def on_welcome(self, conn):
+        with self.cond:
+            for connection in self.connlist:
+                if connection.conn is conn:
+                    connection.ready = True
+                    self.cond.notify()
+
+            num_ready = len([connection for connection in self.connlist if connection.ready])
+
+        if num_ready == 1 or num_ready == len(self.connlist):
+            log.debug('{0}/{1} whisper connections ready after {2:.1f}s'.format(num_ready, len(self.connlist), time.time() - self.start_time))
 
     def on_disconnect(self, conn):
-        conn.reconnect()
-        conn.cap('REQ', 'twitch.tv/commands')
-        return
+        for connection in self.connlist:
+            if connection.conn is conn and not connection.connecting:
+                self.connect(connection)
 
     def whisper(self, target, message):
         if not target:
@@ -0,0 +1,133 @@
+import threading
+import collections
+import re
+
+import logging
+
+log = logging.getLogger('tyggbot')
+
+
+class QueryTemplateStats:
+    __slots__ = ('count', 'total_time', 'max_time', 'rows', 'samples', 'threads')
+
+    def __init__(self, num_samples):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.samples = collections.deque(maxlen=num_samples)
+        self.threads = collections.Counter()
+
+    def percentile(self, p):
+        if len(self.samples) == 0:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[int(round(p * (len(samples) - 1)))]
+
+
+class QueryTracer:
+    """
+    Collects latency statistics for every query template run through the
+    storage cursors.
+
+    Queries are normalized to their template (literals and placeholders
+    become ?, lists of placeholders are collapsed), so queries that only
+    differ in their arguments are counted together. Percentiles are
+    calculated from the latest `num_samples' latencies of each template.
+    """
+
+    string_re = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+    number_re = re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?(?![\w`])')
+    placeholder_re = re.compile(r'%s|\?')
+    list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+    whitespace_re = re.compile(r'\s+')
+
+    # Limit the memory used by queries that are built with literals in them
+    max_templates = 1000
+
+    def __init__(self, num_samples=512):
+        self.num_samples = num_samples
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.normalized = {}
+        self.num_dropped = 0
+
+    def normalize(self, query):
+        template = self.normalized.get(query)
+        if template is not None:
+            return template
+
+        template = self.string_re.sub('?', query)
+        template = self.number_re.sub('?', template)
+        template = self.placeholder_re.sub('?', template)
+        template = self.list_re.sub('(?+)', template)
+        template = self.whitespace_re.sub(' ', template).strip()
+
+        if len(self.normalized) >= self.max_templates * 4:
+            self.normalized = {}
+        self.normalized[query] = template
+        return template
+
+    def record(self, query, duration, rows):
+        """ Record one run of `query'. Returns the template, so rows fetched later can be added with add_rows """
+        template = self.normalize(query)
+        thread_name = threading.current_thread().name
+        with self.lock:
+            data = self.templates.get(template)
+            if data is None:
+                if len(self.templates) >= self.max_templates:
+                    self.num_dropped += 1
+                    return template
+                data = QueryTemplateStats(self.num_samples)
+                self.templates[template] = data
+
+            data.count += 1
+            data.total_time += duration
+            data.max_time = max(data.max_time, duration)
+            data.rows += max(rows, 0)
+            data.samples.append(duration)
+            data.threads[thread_name] += 1
+
+        return template
+
+    def add_rows(self, template, rows):
+        with self.lock:
+            data = self.templates.get(template)
+            if data is not None:
+                data.rows += rows
+
+    def top(self, limit=5):
+        """ Returns a list of (template, summary) tuples for the templates with the highest total time """
+        with self.lock:
+            items = sorted(self.templates.items(), key=lambda item: item[1].total_time, reverse=True)[:limit]
+            return [(template, self.summarize(data)) for template, data in items]
+
+    def summarize(self, data):
+        thread_name = data.threads.most_common(1)[0][0]
+        return 'n={0} total={1:.1f}ms p50={2:.2f}ms p95={3:.2f}ms p99={4:.2f}ms max={5:.2f}ms rows={6} top_thread={7} threads={8}'.format(
+                data.count,
+                data.total_time * 1000,
+                data.percentile(0.50) * 1000,
+                data.percentile(0.95) * 1000,
+                data.percentile(0.99) * 1000,
+                data.max_time * 1000,
+                data.rows,
+                thread_name, len(data.threads))
+
+    def stats(self):
+        data = collections.OrderedDict()
+        data['templates'] = len(self.templates)
+        data['dropped'] = self.num_dropped
+        for template, summary in self.top(3):
+            # Whispers are short, so only the start of the template is shown
+            data[template[:60]] = summary
+        return data
+
+    def log_summary(self, limit=10):
+        top = self.top(limit)
+        if len(top) == 0:
+            return
+
+        log.info('Slowest query templates by total time ({0} templates tracked):'.format(len(self.templates)))
+        for template, summary in top:
+            log.info('  {0} :: {1}'.format(summary, template))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import logging
+import ast
+import os
+
+import pymysql
+
+log = logging.getLogger('tyggbot')
+
+# Every query template the bot runs, with example arguments.
+# Queries marked with full_scan_ok are expected to read the whole table,
+# either because they load everything at startup or because the table is tiny.
+# Plain INSERTs never scan anything, so they are left out.
+# The queries in TyggBot.load_queries and the snapshot fingerprint are added by all_queries, and
+# check_queries fails if the source has a query that isn't listed here.
+queries = [
+        # kvidata.py
+        {'query': "SELECT `value` FROM `tb_idata` WHERE `id`=%s", 'args': ('br_wins', )},
+        {'query': "SELECT `id` as `key`, `value` FROM `tb_idata` WHERE `type`=%s", 'args': ('nl', ), 'full_scan_ok': True},
+        {'query': "UPDATE `tb_idata` SET `value`=`value`+1 WHERE `id`=%s", 'args': ('br_wins', )},
+        {'query': "UPDATE `tb_idata` SET `value`=`value`-1 WHERE `id`=%s", 'args': ('br_wins', )},
+        {'query': "UPDATE `tb_idata` SET `value`=%s WHERE `id`=%s", 'args': (1, 'stream_status')},
+        {'query': "INSERT INTO `tb_idata` (`id`, `value`, `type`) VALUES(%s, %s, %s) ON DUPLICATE KEY UPDATE value=%s", 'args': ('active_subs', 1, 'value', 1)},
+
+        # snapshot.py
+        {'query': "UPDATE `tb_idata` SET `value`=0 WHERE `id`=%s", 'args': ('snapshot_stamp', )},
+
+        # models/user.py
+        {'query': "SELECT * FROM `tb_user` WHERE `username`=%s", 'args': ('pajlada', )},
+        {'query': "SELECT * FROM `tb_user` WHERE `username` IN (%s, %s)", 'args': ('pajlada', 'tyggbar')},
+        {'query': "UPDATE `tb_user` SET `level`=%s, `num_lines`=%s, `subscriber`=%s, `points`=%s, `last_seen`=%s, `last_active`=%s, `minutes_in_chat_online`=%s, `minutes_in_chat_offline`=%s, `username_raw`=%s WHERE `id`=%s",
+            'args': (100, 1, 0, 0, None, None, 0, 0, 'pajlada', 1)},
+
+        # dispatch.py
+        {'query': "SELECT COUNT(*) as `pos` FROM `tb_user` WHERE `num_lines`>%s", 'args': (1000, )},
+        {'query': "SELECT `username`, `num_lines` FROM `tb_user` ORDER BY `num_lines` DESC LIMIT 3", 'args': ()},
+        {'query': "SELECT * FROM `tb_commands` WHERE `id`=%s", 'args': (1, )},
+        {'query': "UPDATE `tb_commands` SET `command`=%s WHERE `id`=%s", 'args': ('ping|pong', 1)},
+        {'query': "UPDATE `tb_commands` SET `action`=%s WHERE `id`=%s", 'args': ('{}', 1)},
+        {'query': "DELETE FROM `tb_commands` WHERE `id`=%s", 'args': (1, )},
+        {'query': "DELETE FROM `tb_filters` WHERE `type`=%s AND `id`=%s", 'args': ('banphrase', 1)},
+        {'query': "DELETE FROM `tb_ignores` WHERE username=%s", 'args': ('pajlada', )},
+
+        # command.py
+        {'query': "UPDATE `tb_commands` SET `num_uses`=%s WHERE `id`=%s", 'args': (1, 1)},
+        {'query': "UPDATE `tb_filters` SET `num_uses`=%s WHERE `id`=%s", 'args': (1, 1)},
+
+        # models/emote.py
+        {'query': "SELECT * FROM `tb_emote`", 'args': (), 'full_scan_ok': True},
+        {'query': "UPDATE `tb_emote` SET `tm_record`=%s, `count`=%s WHERE `id`=%s", 'args': (1, 1, 1)},
+
+        # models/linktracker.py
+        {'query': "INSERT INTO `tb_link_data` (`url_hash`, `url`, `times_linked`, `first_linked`, `last_linked`) VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE `times_linked`=`times_linked`+VALUES(`times_linked`), `last_linked`=VALUES(`last_linked`)",
+            'args': ('0' * 40, 'http://example.com', 1, None, None)},
+
+        # models/linkchecker.py
+        {'query': "SELECT * FROM `tb_link_blacklist`", 'args': (), 'full_scan_ok': True},
+        {'query': "SELECT * FROM `tb_link_whitelist`", 'args': (), 'full_scan_ok': True},
+        {'query': "DELETE FROM `tb_link_blacklist` WHERE `domain`=%s AND `path`=%s", 'args': ('example.com', '/')},
+        {'query': "DELETE FROM `tb_link_whitelist` WHERE `domain`=%s AND `path`=%s", 'args': ('example.com', '/')},
+
+        # models/whisperconnection.py
+        {'query': "SELECT `username`, `oauth` FROM `tb_whisper_account` WHERE `enabled`=1 ORDER BY RAND() LIMIT %s", 'args': (30, ), 'full_scan_ok': True},
+
+        # scripts/database.py
+        {'query': "SELECT `value` FROM `tb_settings` WHERE `setting`='db_version'", 'args': ()},
+        {'query': "UPDATE `tb_settings` SET `value`=%s WHERE `setting`='db_version'", 'args': (17, )},
+
+        # scripts/update_emotes.py
+        {'query': "INSERT INTO `tb_emote` (`code`, `emote_id`) VALUES(%s, %s) ON DUPLICATE KEY UPDATE `code`=%s", 'args': ('Kappa', 25, 'Kappa')},
+        ]
+
+
+def all_queries():
+    """ The queries above, the tables the bot loads in full at startup, and the snapshot fingerprint """
+    from tyggbot import TyggBot
+    from snapshot import Snapshot
+    return (queries + [{'query': query, 'args': (), 'full_scan_ok': True} for query in TyggBot.load_queries.values()] +
+            [{'query': Snapshot.fingerprint_query.format(table), 'args': (), 'full_scan_ok': True} for table in TyggBot.snapshot_tables])
+
+
+def normalize_query(query):
+    return ' '.join(query.split())
+
+
+def find_queries_in_source(base_path):
+    """
+    Returns (filename, line number, query) for every query in the bot's source
+    that could read a table, i.e. every constant string passed to execute()
+    or executemany() that is a SELECT, UPDATE, DELETE or upsert.
+    Queries that are built at runtime can't be found, so list those by hand.
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(base_path):
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+        for filename in filenames:
+            if not filename.endswith('.py'):
+                continue
+
+            path = os.path.join(dirpath, filename)
+            with open(path, 'r', encoding='utf-8') as file:
+                try:
+                    tree = ast.parse(file.read(), path)
+                except SyntaxError:
+                    log.warning('Unable to parse {0}'.format(path))
+                    continue
+
+            for node in ast.walk(tree):
+                if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute) or node.func.attr not in ('execute', 'executemany'):
+                    continue
+                if len(node.args) == 0 or not isinstance(node.args[0], ast.Constant) or not isinstance(node.args[0].value, str):
+                    continue
+
+                query = normalize_query(node.args[0].value)
+                keyword = query.split(' ', 1)[0].upper()
+                if keyword in ('SELECT', 'UPDATE', 'DELETE') or (keyword == 'INSERT' and 'ON DUPLICATE KEY' in query.upper()):
+                    found.append((os.path.relpath(path, base_path), node.lineno, query))
+
+    return found
+
+
+def find_full_scans(db, query, args):
+    """ Returns a list of the tables the query would read in full """
+    tables = []
+    with db.cursor(pymysql.cursors.DictCursor) as cursor:
+        if db.dialect == 'sqlite':
+            # Translate first, upserts are only recognized at the start of the query
+            cursor.execute('EXPLAIN QUERY PLAN ' + db.translate(query), args)
+            for row in cursor.fetchall():
+                # e.g. "SCAN tb_user" for a full scan, or "SCAN tb_user USING INDEX tb_user_num_lines"
+                detail = row['detail']
+                if detail.startswith('SCAN ') and ' USING ' not in detail:
+                    tables.append(detail.split()[1])
+        else:
+            cursor.execute('EXPLAIN ' + query, args)
+            for row in cursor.fetchall():
+                # A full scan where no index could have been used.
+                # Tiny tables might be scanned even with a usable index, we don't count those.
+                if row['type'] == 'ALL' and row['possible_keys'] is None:
+                    tables.append(row['table'])
+
+    return tables
+
+
+def check_queries(db):
+    """ Run EXPLAIN on all queries, and return the number of unexpected full scans and unlisted queries """
+    num_bad = 0
+    listed = set(normalize_query(data['query']) for data in all_queries())
+    for filename, line, query in find_queries_in_source(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))):
+        if query not in listed:
+            log.error('Query in {0}:{1} is not in the list of queries to check: {2}'.format(filename, line, query))
+            num_bad += 1
+
+    for data in all_queries():
+        try:
+            tables = find_full_scans(db, data['query'], data['args'])
+        except:
+            log.exception('Unable to explain query: {0}'.format(data['query']))
+            num_bad += 1
+            continue
+
+        if len(tables) > 0:
+            if data.get('full_scan_ok', False):
+                log.debug('Expected full scan of {0}: {1}'.format(', '.join(tables), data['query']))
+            else:
+                log.error('Full scan of {0}: {1}'.format(', '.join(tables), data['query']))
+                num_bad += 1
+
+    return num_bad
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append('../')
+    from tbutil import load_config, init_logging
+    init_logging('tyggbot')
+    import argparse
+    parser = argparse.ArgumentParser(description='Check the query plan of every query the bot runs, and report queries that read whole tables.')
+    parser.add_argument('--config', '-c',
+                        required=True,
+                        help='Specify which config file to use '
+                                '(default: config.ini)')
+
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    from storage import create_storage
+    db = create_storage(config['sql'])
+
+    num_bad = check_queries(db)
+    if num_bad > 0:
+        log.error('{0} queries need to be looked at'.format(num_bad))
+        sys.exit(1)
+
+    log.info('All {0} queries are OK'.format(len(all_queries())))
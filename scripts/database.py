@@ -2,106 +2,195 @@ import logging
 
 log = logging.getLogger('tyggbot')
 
+latest_db_version = 17
 
-def update_database(sqlconn):
+
+def update_database(db):
     """
     This function will handle all database changes
 
+    db is a storage object from storage.py. Every version has a list of
+    queries for each of the SQL dialects we support, so MySQL and SQLite
+    databases are always on the same version.
+
     TODO: Also let it create all tables if none exist.
     """
-    cursor = sqlconn.cursor()
+    if db.dialect == 'sqlite':
+        get_queries = sqlite_queries
+    else:
+        get_queries = mysql_queries
 
-    try:
-        cursor.execute("SELECT `value` FROM `tb_settings` WHERE `setting`='db_version'")
-    except:
-        pass
-    log.info(cursor)
+    with db.cursor() as cursor:
+        row = None
+        try:
+            cursor.execute("SELECT `value` FROM `tb_settings` WHERE `setting`='db_version'")
+            row = cursor.fetchone()
+        except:
+            pass
 
-    latest_db_version = 15
-    version = 0
+        if row:
+            version = int(row[0])
+        else:
+            # No db version specified
+            version = -1
 
-    if cursor.rowcount > 0:
-        version = int(cursor.fetchone()[0])
-    else:
-        # No db version specified
-        version = -1
-
-    while version < latest_db_version:
-        version += 1
-        queries = []
-
-        if version == 0:
-            # Create `tb_commands` table
-            queries.append("CREATE TABLE IF NOT EXISTS `tb_commands` ( `id` int(11) NOT NULL, `level` int(11) NOT NULL DEFAULT '100' COMMENT 'authentication level required. 100 = user, 1000 = admin', `action` text COLLATE utf8_unicode_ci NOT NULL COMMENT 'the action to be performed if the command is executed', `extra_args` text COLLATE utf8_unicode_ci, `command` text COLLATE utf8_unicode_ci NOT NULL COMMENT 'excluding the !', `description` text COLLATE utf8_unicode_ci, `delay_all` int(11) NOT NULL DEFAULT '5' COMMENT 'The minimum amount of time (in seconds) to wait before executing this command again.', `delay_user` int(11) NOT NULL DEFAULT '15' COMMENT 'The minimum amount of time (in seconds) to wait before responding to this command to the same user.', `enabled` tinyint(1) NOT NULL DEFAULT '1', `num_uses` int(11) NOT NULL DEFAULT '0', `created` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP, `last_updated` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
-
-            # Create `tb_filters` table
-            queries.append("CREATE TABLE IF NOT EXISTS `tb_filters` ( `id` int(11) NOT NULL, `name` varchar(128) COLLATE utf8_unicode_ci NOT NULL DEFAULT 'Filter Name', `type` varchar(64) COLLATE utf8_unicode_ci NOT NULL DEFAULT 'regex', `action` text COLLATE utf8_unicode_ci NOT NULL, `extra_args` text COLLATE utf8_unicode_ci, `filter` text COLLATE utf8_unicode_ci NOT NULL, `source` text COLLATE utf8_unicode_ci, `enabled` tinyint(1) NOT NULL DEFAULT '1', `num_uses` int(11) NOT NULL DEFAULT '0') ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
-
-            # Create `tb_idata` table
-            queries.append("CREATE TABLE IF NOT EXISTS `tb_idata` ( `id` varchar(64) COLLATE utf8_unicode_ci NOT NULL, `value` int(11) NOT NULL, `type` set('value','nl','emote_stats') COLLATE utf8_unicode_ci NOT NULL DEFAULT 'value') ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
-
-            # Create `tb_ignored` table
-            queries.append("CREATE TABLE IF NOT EXISTS `tb_ignores` ( `id` int(11) NOT NULL, `username` varchar(128) COLLATE utf8_unicode_ci NOT NULL) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
-
-            # Create `tb_settings` table
-            queries.append("CREATE TABLE IF NOT EXISTS `tb_settings` ( `id` int(11) NOT NULL, `setting` varchar(128) COLLATE utf8_unicode_ci NOT NULL, `value` text COLLATE utf8_unicode_ci NOT NULL, `type` set('int','string','list','bool') COLLATE utf8_unicode_ci NOT NULL) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
-
-            # Create `tb_user` table
-            queries.append("CREATE TABLE IF NOT EXISTS `tb_user` ( `id` int(11) NOT NULL, `username` varchar(128) COLLATE utf8_unicode_ci NOT NULL, `username_raw` varchar(128) COLLATE utf8_unicode_ci DEFAULT NULL COMMENT 'Raw username, if they ever let us fetch the \"case-specific\" username from the IRC connection.', `level` int(11) NOT NULL DEFAULT '100' COMMENT 'Access level, this determines what commands the user can access. 100 = User. 250 = Regular, 500 = Moderator, 1000 = Admin, 2000 = Super admin', `num_lines` int(11) NOT NULL DEFAULT '0' COMMENT 'Number of lines the user has written in chat.') ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
-
-            # Add primary keys to tables
-            queries.append("ALTER TABLE `tb_commands` ADD PRIMARY KEY (`id`);")
-            queries.append("ALTER TABLE `tb_filters` ADD PRIMARY KEY (`id`);")
-            queries.append("ALTER TABLE `tb_idata` ADD PRIMARY KEY (`id`);")
-            queries.append("ALTER TABLE `tb_ignores` ADD PRIMARY KEY (`id`), ADD UNIQUE KEY `username` (`username`);")
-            queries.append("ALTER TABLE `tb_settings` ADD PRIMARY KEY (`id`), ADD UNIQUE KEY `setting` (`setting`);")
-            queries.append("ALTER TABLE `tb_user` ADD PRIMARY KEY (`id`), ADD KEY `username` (`username`);")
-
-            # Set auto-increment values
-            queries.append("ALTER TABLE `tb_commands` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
-            queries.append("ALTER TABLE `tb_filters` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
-            queries.append("ALTER TABLE `tb_ignores` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
-            queries.append("ALTER TABLE `tb_settings` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
-            queries.append("ALTER TABLE `tb_user` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
-
-            # Insert db_version into tb_settings
-            queries.append("INSERT INTO `tb_settings` (`setting`, `value`, `type`) VALUES ('db_version', 0, 'int')")
-        elif version == 1:
-            queries.append("ALTER TABLE `tb_user` ADD `subscriber` BOOLEAN NOT NULL DEFAULT FALSE COMMENT 'Keeps track of whether the user is a subscriber or not. This is only updated when the user actually types in chat, so the information might be outdated if the person stops typing in chat.' ;")
-        elif version == 2:
-            queries.append("CREATE TABLE `tb_emote` ( `id` INT NOT NULL AUTO_INCREMENT , `code` VARCHAR(64) NOT NULL COMMENT 'All regexes for emotes are escaped. so if the emote code is (ditto) the regex will be \\(ditto\\)' , `deque` TEXT NULL DEFAULT NULL COMMENT 'Dump of the emote deque, so the state can be saved properly' , `pm_record` INT NOT NULL DEFAULT '0' , `tm_record` INT NOT NULL DEFAULT '0' , `count` INT NOT NULL DEFAULT '0', PRIMARY KEY (`id`) ) ENGINE = InnoDB;")
-        elif version == 3:
-            queries.append("CREATE TABLE `tb_motd` ( `id` INT NOT NULL AUTO_INCREMENT , `message` VARCHAR(400) NOT NULL , `enabled` BOOLEAN NOT NULL DEFAULT TRUE , PRIMARY KEY (`id`) ) ENGINE = InnoDB;")
-        elif version == 4:
-            queries.append("ALTER TABLE `tb_user` ADD `points` INT NOT NULL DEFAULT '0' AFTER `level`;")
-        elif version == 5:
-            queries.append("ALTER TABLE `tb_user` ADD `last_seen` DATETIME NULL DEFAULT NULL , ADD `last_active` DATETIME NULL DEFAULT NULL ;")
-        elif version == 6:
-            queries.append("ALTER TABLE `tb_user` ADD `minutes_in_chat_online` INT NOT NULL DEFAULT '0' , ADD `minutes_in_chat_offline` INT NOT NULL DEFAULT '0' ;")
-        elif version == 7:
-            queries.append("ALTER TABLE `tb_commands` ADD `cost` INT NOT NULL DEFAULT '0' AFTER `num_uses`;")
-        elif version == 8:
-            queries.append("ALTER TABLE `tb_commands` ADD `can_execute_with_whisper` BOOLEAN NOT NULL DEFAULT FALSE COMMENT 'Decides whether the command can be used through whispers or not.' AFTER `cost`;")
-        elif version == 9:
-            queries.append("CREATE TABLE `tb_whisper_account` ( `username` VARCHAR(128) NOT NULL , `oauth` VARCHAR(128) NOT NULL , `enabled` BOOLEAN NOT NULL DEFAULT TRUE , PRIMARY KEY (`username`) ) ENGINE = InnoDB;")
-        elif version == 10:
-            queries.append("ALTER TABLE `tb_emote` ADD `emote_id` INT NULL DEFAULT NULL AFTER `id`, ADD UNIQUE (`emote_id`) ;")
-        elif version == 11:
-            queries.append("ALTER TABLE `tb_emote` ADD `emote_hash` VARCHAR(32) NULL DEFAULT NULL COMMENT 'Used for BTTV Emotes.' AFTER `emote_id`;")
-        elif version == 12:
-            queries.append("ALTER TABLE `tb_emote` DROP `deque`, DROP `pm_record`;")
-        elif version == 13:
-            queries.append("CREATE TABLE `tb_link_data` ( `id` INT NOT NULL AUTO_INCREMENT , `url` TEXT NOT NULL , `times_linked` INT NOT NULL DEFAULT '0' , `first_linked` DATETIME NOT NULL , `last_linked` DATETIME NOT NULL , PRIMARY KEY (`id`) ) ENGINE = InnoDB COMMENT = 'Stores statistics about links that are posted in the twitch chat.';")
-        elif version == 14:
-            queries.append("CREATE TABLE `tb_link_blacklist` ( `domain` VARCHAR(256) NOT NULL , `path` TEXT NOT NULL ) ENGINE = InnoDB COMMENT = 'Stores a list of blacklisted links.';")
-            queries.append("CREATE TABLE `tb_link_whitelist` ( `domain` VARCHAR(256) NOT NULL , `path` TEXT NOT NULL ) ENGINE = InnoDB COMMENT = 'Stores a list of whitelisted links.';")
-        elif version == 15:
-            queries.append("ALTER TABLE `tb_link_blacklist` ADD COLUMN level int(11) DEFAULT 1;")
-
-        for query in queries:
-            cursor.execute(query)
-
-        log.info('Updating db version to {0}'.format(version))
-        cursor.execute("UPDATE `tb_settings` SET `value`=%s WHERE `setting`='db_version'", (version))
+        while version < latest_db_version:
+            version += 1
+
+            for query in get_queries(version):
+                cursor.execute(query)
+
+            log.info('Updating db version to {0}'.format(version))
+            cursor.execute("UPDATE `tb_settings` SET `value`=%s WHERE `setting`='db_version'", (version))
 
     log.info('db version: {0}'.format(version))
+
+
+def mysql_queries(version):
+    queries = []
+
+    if version == 0:
+        # Create `tb_commands` table
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_commands` ( `id` int(11) NOT NULL, `level` int(11) NOT NULL DEFAULT '100' COMMENT 'authentication level required. 100 = user, 1000 = admin', `action` text COLLATE utf8_unicode_ci NOT NULL COMMENT 'the action to be performed if the command is executed', `extra_args` text COLLATE utf8_unicode_ci, `command` text COLLATE utf8_unicode_ci NOT NULL COMMENT 'excluding the !', `description` text COLLATE utf8_unicode_ci, `delay_all` int(11) NOT NULL DEFAULT '5' COMMENT 'The minimum amount of time (in seconds) to wait before executing this command again.', `delay_user` int(11) NOT NULL DEFAULT '15' COMMENT 'The minimum amount of time (in seconds) to wait before responding to this command to the same user.', `enabled` tinyint(1) NOT NULL DEFAULT '1', `num_uses` int(11) NOT NULL DEFAULT '0', `created` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP, `last_updated` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
+
+        # Create `tb_filters` table
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_filters` ( `id` int(11) NOT NULL, `name` varchar(128) COLLATE utf8_unicode_ci NOT NULL DEFAULT 'Filter Name', `type` varchar(64) COLLATE utf8_unicode_ci NOT NULL DEFAULT 'regex', `action` text COLLATE utf8_unicode_ci NOT NULL, `extra_args` text COLLATE utf8_unicode_ci, `filter` text COLLATE utf8_unicode_ci NOT NULL, `source` text COLLATE utf8_unicode_ci, `enabled` tinyint(1) NOT NULL DEFAULT '1', `num_uses` int(11) NOT NULL DEFAULT '0') ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
+
+        # Create `tb_idata` table
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_idata` ( `id` varchar(64) COLLATE utf8_unicode_ci NOT NULL, `value` int(11) NOT NULL, `type` set('value','nl','emote_stats') COLLATE utf8_unicode_ci NOT NULL DEFAULT 'value') ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
+
+        # Create `tb_ignored` table
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_ignores` ( `id` int(11) NOT NULL, `username` varchar(128) COLLATE utf8_unicode_ci NOT NULL) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
+
+        # Create `tb_settings` table
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_settings` ( `id` int(11) NOT NULL, `setting` varchar(128) COLLATE utf8_unicode_ci NOT NULL, `value` text COLLATE utf8_unicode_ci NOT NULL, `type` set('int','string','list','bool') COLLATE utf8_unicode_ci NOT NULL) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
+
+        # Create `tb_user` table
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_user` ( `id` int(11) NOT NULL, `username` varchar(128) COLLATE utf8_unicode_ci NOT NULL, `username_raw` varchar(128) COLLATE utf8_unicode_ci DEFAULT NULL COMMENT 'Raw username, if they ever let us fetch the \"case-specific\" username from the IRC connection.', `level` int(11) NOT NULL DEFAULT '100' COMMENT 'Access level, this determines what commands the user can access. 100 = User. 250 = Regular, 500 = Moderator, 1000 = Admin, 2000 = Super admin', `num_lines` int(11) NOT NULL DEFAULT '0' COMMENT 'Number of lines the user has written in chat.') ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;")
+
+        # Add primary keys to tables
+        queries.append("ALTER TABLE `tb_commands` ADD PRIMARY KEY (`id`);")
+        queries.append("ALTER TABLE `tb_filters` ADD PRIMARY KEY (`id`);")
+        queries.append("ALTER TABLE `tb_idata` ADD PRIMARY KEY (`id`);")
+        queries.append("ALTER TABLE `tb_ignores` ADD PRIMARY KEY (`id`), ADD UNIQUE KEY `username` (`username`);")
+        queries.append("ALTER TABLE `tb_settings` ADD PRIMARY KEY (`id`), ADD UNIQUE KEY `setting` (`setting`);")
+        queries.append("ALTER TABLE `tb_user` ADD PRIMARY KEY (`id`), ADD KEY `username` (`username`);")
+
+        # Set auto-increment values
+        queries.append("ALTER TABLE `tb_commands` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
+        queries.append("ALTER TABLE `tb_filters` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
+        queries.append("ALTER TABLE `tb_ignores` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
+        queries.append("ALTER TABLE `tb_settings` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
+        queries.append("ALTER TABLE `tb_user` MODIFY `id` int(11) NOT NULL AUTO_INCREMENT;")
+
+        # Insert db_version into tb_settings
+        queries.append("INSERT INTO `tb_settings` (`setting`, `value`, `type`) VALUES ('db_version', 0, 'int')")
+    elif version == 1:
+        queries.append("ALTER TABLE `tb_user` ADD `subscriber` BOOLEAN NOT NULL DEFAULT FALSE COMMENT 'Keeps track of whether the user is a subscriber or not. This is only updated when the user actually types in chat, so the information might be outdated if the person stops typing in chat.' ;")
+    elif version == 2:
+        queries.append("CREATE TABLE `tb_emote` ( `id` INT NOT NULL AUTO_INCREMENT , `code` VARCHAR(64) NOT NULL COMMENT 'All regexes for emotes are escaped. so if the emote code is (ditto) the regex will be \\(ditto\\)' , `deque` TEXT NULL DEFAULT NULL COMMENT 'Dump of the emote deque, so the state can be saved properly' , `pm_record` INT NOT NULL DEFAULT '0' , `tm_record` INT NOT NULL DEFAULT '0' , `count` INT NOT NULL DEFAULT '0', PRIMARY KEY (`id`) ) ENGINE = InnoDB;")
+    elif version == 3:
+        queries.append("CREATE TABLE `tb_motd` ( `id` INT NOT NULL AUTO_INCREMENT , `message` VARCHAR(400) NOT NULL , `enabled` BOOLEAN NOT NULL DEFAULT TRUE , PRIMARY KEY (`id`) ) ENGINE = InnoDB;")
+    elif version == 4:
+        queries.append("ALTER TABLE `tb_user` ADD `points` INT NOT NULL DEFAULT '0' AFTER `level`;")
+    elif version == 5:
+        queries.append("ALTER TABLE `tb_user` ADD `last_seen` DATETIME NULL DEFAULT NULL , ADD `last_active` DATETIME NULL DEFAULT NULL ;")
+    elif version == 6:
+        queries.append("ALTER TABLE `tb_user` ADD `minutes_in_chat_online` INT NOT NULL DEFAULT '0' , ADD `minutes_in_chat_offline` INT NOT NULL DEFAULT '0' ;")
+    elif version == 7:
+        queries.append("ALTER TABLE `tb_commands` ADD `cost` INT NOT NULL DEFAULT '0' AFTER `num_uses`;")
+    elif version == 8:
+        queries.append("ALTER TABLE `tb_commands` ADD `can_execute_with_whisper` BOOLEAN NOT NULL DEFAULT FALSE COMMENT 'Decides whether the command can be used through whispers or not.' AFTER `cost`;")
+    elif version == 9:
+        queries.append("CREATE TABLE `tb_whisper_account` ( `username` VARCHAR(128) NOT NULL , `oauth` VARCHAR(128) NOT NULL , `enabled` BOOLEAN NOT NULL DEFAULT TRUE , PRIMARY KEY (`username`) ) ENGINE = InnoDB;")
+    elif version == 10:
+        queries.append("ALTER TABLE `tb_emote` ADD `emote_id` INT NULL DEFAULT NULL AFTER `id`, ADD UNIQUE (`emote_id`) ;")
+    elif version == 11:
+        queries.append("ALTER TABLE `tb_emote` ADD `emote_hash` VARCHAR(32) NULL DEFAULT NULL COMMENT 'Used for BTTV Emotes.' AFTER `emote_id`;")
+    elif version == 12:
+        queries.append("ALTER TABLE `tb_emote` DROP `deque`, DROP `pm_record`;")
+    elif version == 13:
+        queries.append("CREATE TABLE `tb_link_data` ( `id` INT NOT NULL AUTO_INCREMENT , `url` TEXT NOT NULL , `times_linked` INT NOT NULL DEFAULT '0' , `first_linked` DATETIME NOT NULL , `last_linked` DATETIME NOT NULL , PRIMARY KEY (`id`) ) ENGINE = InnoDB COMMENT = 'Stores statistics about links that are posted in the twitch chat.';")
+    elif version == 14:
+        queries.append("CREATE TABLE `tb_link_blacklist` ( `domain` VARCHAR(256) NOT NULL , `path` TEXT NOT NULL ) ENGINE = InnoDB COMMENT = 'Stores a list of blacklisted links.';")
+        queries.append("CREATE TABLE `tb_link_whitelist` ( `domain` VARCHAR(256) NOT NULL , `path` TEXT NOT NULL ) ENGINE = InnoDB COMMENT = 'Stores a list of whitelisted links.';")
+    elif version == 15:
+        queries.append("ALTER TABLE `tb_link_blacklist` ADD COLUMN level int(11) DEFAULT 1;")
+    elif version == 16:
+        # Add an indexed hash of the url, so link data can be upserted without scanning the table
+        queries.append("ALTER TABLE `tb_link_data` ADD `url_hash` CHAR(32) NULL DEFAULT NULL COMMENT 'MD5 hash of the url' AFTER `id`;")
+        queries.append("UPDATE `tb_link_data` SET `url_hash`=MD5(CONVERT(`url` USING utf8mb4));")
+        # Merge any duplicate rows before adding the unique key
+        queries.append("UPDATE `tb_link_data` `t` JOIN (SELECT MIN(`id`) AS `id`, SUM(`times_linked`) AS `times_linked`, MIN(`first_linked`) AS `first_linked`, MAX(`last_linked`) AS `last_linked` FROM `tb_link_data` GROUP BY `url_hash` HAVING COUNT(*) > 1) `d` ON `t`.`id`=`d`.`id` SET `t`.`times_linked`=`d`.`times_linked`, `t`.`first_linked`=`d`.`first_linked`, `t`.`last_linked`=`d`.`last_linked`;")
+        queries.append("DELETE `t1` FROM `tb_link_data` `t1` JOIN `tb_link_data` `t2` ON `t1`.`url_hash`=`t2`.`url_hash` AND `t1`.`id`>`t2`.`id`;")
+        queries.append("ALTER TABLE `tb_link_data` MODIFY `url_hash` CHAR(32) NOT NULL COMMENT 'MD5 hash of the url', ADD UNIQUE KEY `url_hash` (`url_hash`);")
+    elif version == 17:
+        # nl_pos counts the users with more lines than you, and top3 sorts by num_lines
+        queries.append("ALTER TABLE `tb_user` ADD KEY `num_lines` (`num_lines`);")
+        # Link list entries are removed by domain and path. path is TEXT, so only a prefix of it can be indexed
+        queries.append("ALTER TABLE `tb_link_blacklist` ADD KEY `domain_path` (`domain`(128), `path`(128));")
+        queries.append("ALTER TABLE `tb_link_whitelist` ADD KEY `domain_path` (`domain`(128), `path`(128));")
+
+    return queries
+
+
+def sqlite_queries(version):
+    queries = []
+
+    if version == 0:
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_commands` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `level` INTEGER NOT NULL DEFAULT 100, `action` TEXT NOT NULL, `extra_args` TEXT, `command` TEXT NOT NULL, `description` TEXT, `delay_all` INTEGER NOT NULL DEFAULT 5, `delay_user` INTEGER NOT NULL DEFAULT 15, `enabled` INTEGER NOT NULL DEFAULT 1, `num_uses` INTEGER NOT NULL DEFAULT 0, `created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP, `last_updated` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP);")
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_filters` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` VARCHAR(128) NOT NULL DEFAULT 'Filter Name', `type` VARCHAR(64) NOT NULL DEFAULT 'regex', `action` TEXT NOT NULL, `extra_args` TEXT, `filter` TEXT NOT NULL, `source` TEXT, `enabled` INTEGER NOT NULL DEFAULT 1, `num_uses` INTEGER NOT NULL DEFAULT 0);")
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_idata` ( `id` VARCHAR(64) NOT NULL PRIMARY KEY, `value` INTEGER NOT NULL, `type` VARCHAR(16) NOT NULL DEFAULT 'value');")
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_ignores` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `username` VARCHAR(128) NOT NULL UNIQUE);")
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_settings` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `setting` VARCHAR(128) NOT NULL UNIQUE, `value` TEXT NOT NULL, `type` VARCHAR(16) NOT NULL);")
+        queries.append("CREATE TABLE IF NOT EXISTS `tb_user` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `username` VARCHAR(128) NOT NULL, `username_raw` VARCHAR(128) DEFAULT NULL, `level` INTEGER NOT NULL DEFAULT 100, `num_lines` INTEGER NOT NULL DEFAULT 0);")
+        queries.append("CREATE INDEX IF NOT EXISTS `tb_user_username` ON `tb_user` (`username`);")
+        queries.append("INSERT INTO `tb_settings` (`setting`, `value`, `type`) VALUES ('db_version', 0, 'int')")
+    elif version == 1:
+        queries.append("ALTER TABLE `tb_user` ADD `subscriber` INTEGER NOT NULL DEFAULT 0;")
+    elif version == 2:
+        queries.append("CREATE TABLE `tb_emote` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `code` VARCHAR(64) NOT NULL, `deque` TEXT NULL DEFAULT NULL, `pm_record` INTEGER NOT NULL DEFAULT 0, `tm_record` INTEGER NOT NULL DEFAULT 0, `count` INTEGER NOT NULL DEFAULT 0);")
+    elif version == 3:
+        queries.append("CREATE TABLE `tb_motd` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `message` VARCHAR(400) NOT NULL, `enabled` INTEGER NOT NULL DEFAULT 1);")
+    elif version == 4:
+        queries.append("ALTER TABLE `tb_user` ADD `points` INTEGER NOT NULL DEFAULT 0;")
+    elif version == 5:
+        queries.append("ALTER TABLE `tb_user` ADD `last_seen` DATETIME NULL DEFAULT NULL;")
+        queries.append("ALTER TABLE `tb_user` ADD `last_active` DATETIME NULL DEFAULT NULL;")
+    elif version == 6:
+        queries.append("ALTER TABLE `tb_user` ADD `minutes_in_chat_online` INTEGER NOT NULL DEFAULT 0;")
+        queries.append("ALTER TABLE `tb_user` ADD `minutes_in_chat_offline` INTEGER NOT NULL DEFAULT 0;")
+    elif version == 7:
+        queries.append("ALTER TABLE `tb_commands` ADD `cost` INTEGER NOT NULL DEFAULT 0;")
+    elif version == 8:
+        queries.append("ALTER TABLE `tb_commands` ADD `can_execute_with_whisper` INTEGER NOT NULL DEFAULT 0;")
+    elif version == 9:
+        queries.append("CREATE TABLE `tb_whisper_account` ( `username` VARCHAR(128) NOT NULL PRIMARY KEY, `oauth` VARCHAR(128) NOT NULL, `enabled` INTEGER NOT NULL DEFAULT 1);")
+    elif version == 10:
+        queries.append("ALTER TABLE `tb_emote` ADD `emote_id` INTEGER NULL DEFAULT NULL;")
+        queries.append("CREATE UNIQUE INDEX `tb_emote_emote_id` ON `tb_emote` (`emote_id`);")
+    elif version == 11:
+        queries.append("ALTER TABLE `tb_emote` ADD `emote_hash` VARCHAR(32) NULL DEFAULT NULL;")
+    elif version == 12:
+        queries.append("ALTER TABLE `tb_emote` DROP COLUMN `deque`;")
+        queries.append("ALTER TABLE `tb_emote` DROP COLUMN `pm_record`;")
+    elif version == 13:
+        queries.append("CREATE TABLE `tb_link_data` ( `id` INTEGER PRIMARY KEY AUTOINCREMENT, `url` TEXT NOT NULL, `times_linked` INTEGER NOT NULL DEFAULT 0, `first_linked` DATETIME NOT NULL, `last_linked` DATETIME NOT NULL);")
+    elif version == 14:
+        queries.append("CREATE TABLE `tb_link_blacklist` ( `domain` VARCHAR(256) NOT NULL, `path` TEXT NOT NULL);")
+        queries.append("CREATE TABLE `tb_link_whitelist` ( `domain` VARCHAR(256) NOT NULL, `path` TEXT NOT NULL);")
+    elif version == 15:
+        queries.append("ALTER TABLE `tb_link_blacklist` ADD COLUMN `level` INTEGER DEFAULT 1;")
+    elif version == 16:
+        # MD5 is provided by SQLiteStorage
+        queries.append("ALTER TABLE `tb_link_data` ADD `url_hash` CHAR(32) NULL DEFAULT NULL;")
+        queries.append("UPDATE `tb_link_data` SET `url_hash`=MD5(`url`);")
+        queries.append("UPDATE `tb_link_data` SET `times_linked`=(SELECT SUM(`t`.`times_linked`) FROM `tb_link_data` `t` WHERE `t`.`url_hash`=`tb_link_data`.`url_hash`), `first_linked`=(SELECT MIN(`t`.`first_linked`) FROM `tb_link_data` `t` WHERE `t`.`url_hash`=`tb_link_data`.`url_hash`), `last_linked`=(SELECT MAX(`t`.`last_linked`) FROM `tb_link_data` `t` WHERE `t`.`url_hash`=`tb_link_data`.`url_hash`) WHERE `id` IN (SELECT MIN(`id`) FROM `tb_link_data` GROUP BY `url_hash` HAVING COUNT(*) > 1);")
+        queries.append("DELETE FROM `tb_link_data` WHERE `id` NOT IN (SELECT MIN(`id`) FROM `tb_link_data` GROUP BY `url_hash`);")
+        queries.append("CREATE UNIQUE INDEX `tb_link_data_url_hash` ON `tb_link_data` (`url_hash`);")
+    elif version == 17:
+        queries.append("CREATE INDEX `tb_user_num_lines` ON `tb_user` (`num_lines`);")
+        queries.append("CREATE INDEX `tb_link_blacklist_domain_path` ON `tb_link_blacklist` (`domain`, `path`);")
+        queries.append("CREATE INDEX `tb_link_whitelist_domain_path` ON `tb_link_whitelist` (`domain`, `path`);")
+
+    return queries
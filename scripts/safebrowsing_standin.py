@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+A local stand-in for the Safe Browsing Lookup API, for testing.
+
+Start it with a file containing one bad URL per line, and point the bot at it
+by setting safebrowsingapi_url = http://127.0.0.1:8123/ in the [main] section
+of the config.
+"""
+
+import logging
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger('tyggbot')
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    bad_urls = set()
+
+    def is_bad(self, url):
+        return url.strip().strip('/').lower() in self.bad_urls
+
+    def respond(self, status, body=''):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        if 'url' not in query:
+            return self.respond(400)
+
+        if self.is_bad(query['url'][0]):
+            self.respond(200, 'malware')
+        else:
+            self.respond(204)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        lines = body.splitlines()
+        try:
+            urls = lines[1:int(lines[0]) + 1]
+        except (IndexError, ValueError):
+            return self.respond(400)
+
+        verdicts = ['malware' if self.is_bad(url) else 'ok' for url in urls]
+        if 'malware' in verdicts:
+            self.respond(200, '\n'.join(verdicts))
+        else:
+            self.respond(204)
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append('../')
+    from tbutil import init_logging
+    init_logging('tyggbot')
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bad_urls',
+                        help='File with one bad URL per line')
+    parser.add_argument('--port', '-p',
+                        type=int,
+                        default=8123,
+                        help='Port to listen on (default: 8123)')
+
+    args = parser.parse_args()
+
+    with open(args.bad_urls, 'r') as f:
+        StandinHandler.bad_urls = set(line.strip().strip('/').lower() for line in f if len(line.strip()) > 0)
+
+    log.info('Serving {0} bad urls on port {1}'.format(len(StandinHandler.bad_urls), args.port))
+    HTTPServer(('127.0.0.1', args.port), StandinHandler).serve_forever()
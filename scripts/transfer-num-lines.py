@@ -2,22 +2,22 @@
 
 import sys, os
 import configparser
-import pymysql
 
 sys.path.insert(0, os.path.dirname(os.path.realpath(__file__ + '/../')))
 os.chdir(os.path.dirname(os.path.realpath(__file__ + '/../')))
 
 from models.user import User, UserManager
 from kvidata import KVIData
+from storage import create_storage
 
 config = configparser.ConfigParser()
 
 config.read('config.ini')
 
-sqlconn = pymysql.connect(unix_socket=config['sql']['unix_socket'], user=config['sql']['user'], passwd=config['sql']['passwd'], db=config['sql']['db'], charset='utf8')
-kvi = KVIData(sqlconn)
+db = create_storage(config['sql'])
+kvi = KVIData(db)
 
-users = UserManager(sqlconn)
+users = UserManager(db)
 
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
@@ -62,6 +62,7 @@ if __name__ == "__main__":
     from tbutil import load_config, init_logging
     init_logging('tyggbot')
     from apiwrappers import APIBase
+    from snapshot import Snapshot
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', '-c',
@@ -76,6 +77,9 @@ if __name__ == "__main__":
 
     cursor = sqlconn.cursor()
 
+    # The emotes are stored in the bot's snapshot, make sure it's not loaded on the next start
+    Snapshot.invalidate(cursor)
+
     refresh_emotes(cursor)
 
     sqlconn.commit()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import logging
+import json
+import base64
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import httpclient
+
+log = logging.getLogger('tyggbot')
+
+threat_types = [
+        'MALWARE',
+        'SOCIAL_ENGINEERING',
+        'UNWANTED_SOFTWARE',
+        ]
+
+
+def fetch_prefixes(apikey, client_id, client_version, base_url='https://safebrowsing.googleapis.com/v4/'):
+    """
+    Fetch a full update of the Safe Browsing URL lists and return a set of all hash prefixes.
+    """
+    data = {
+            'client': {
+                'clientId': client_id,
+                'clientVersion': client_version,
+                },
+            'listUpdateRequests': [],
+            }
+
+    for threat_type in threat_types:
+        data['listUpdateRequests'].append({
+            'threatType': threat_type,
+            'platformType': 'ANY_PLATFORM',
+            'threatEntryType': 'URL',
+            'state': '',  # An empty state gives us a full update
+            'constraints': {'supportedCompressions': ['RAW']},
+            })
+
+    r = httpclient.post(base_url + 'threatListUpdates:fetch', params={'key': apikey}, data=json.dumps(data), timeout=(5, 60))
+    r.raise_for_status()
+
+    prefixes = set()
+    for list_update in r.json().get('listUpdateResponses', []):
+        for addition in list_update.get('additions', []):
+            raw_hashes = addition['rawHashes']
+            prefix_size = raw_hashes['prefixSize']
+            hashes = base64.b64decode(raw_hashes['rawHashes'])
+            for i in range(0, len(hashes), prefix_size):
+                prefixes.add(hashes[i:i + prefix_size])
+
+    return prefixes
+
+
+def write_prefixes(path, prefixes):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for prefix in sorted(prefixes):
+            f.write(prefix.hex() + '\n')
+
+    # Replace the file atomically, so the bot never reads a half-written list
+    os.replace(tmp_path, path)
+
+if __name__ == "__main__":
+    from tbutil import load_config, init_logging
+    init_logging('tyggbot')
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', '-c',
+                        required=True,
+                        help='Specify which config file to use '
+                                '(default: config.ini)')
+
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    if 'safebrowsing_prefixes' not in config['main']:
+        log.error('Missing safebrowsing_prefixes in the [main] section of the config')
+        sys.exit(1)
+
+    prefixes = fetch_prefixes(config['main']['safebrowsingapi'], config['main']['nickname'], 'tyggbot')
+    write_prefixes(config['main']['safebrowsing_prefixes'], prefixes)
+    log.info('Wrote {0} hash prefixes to {1}'.format(len(prefixes), config['main']['safebrowsing_prefixes']))
@@ -0,0 +1,151 @@
+import collections
+import struct
+import pickle
+import random
+import mmap
+import zlib
+import time
+import os
+
+import logging
+
+log = logging.getLogger('tyggbot')
+
+
+class Snapshot:
+    """
+    Binary snapshot of the bot's state, used for fast restarts.
+
+    The file starts with a fixed size header, followed by the pickled
+    state. A snapshot is only used if its header matches the current
+    database version, and the stamp that was stored in `tb_idata' when it
+    was written. Every write the bot makes to a table in the snapshot
+    resets that stamp first (see invalidate).
+
+    Other programs that write to those tables should call invalidate as
+    well, like scripts/update_emotes.py does. As a fallback, the row count
+    and highest id of every table in the snapshot is stored with it (see
+    fingerprint), so rows added or removed behind the bot's back are
+    noticed. Rows that are changed in place by another program without
+    calling invalidate are not, delete the snapshot file in that case.
+    """
+
+    magic = b'TBSNAP\r\n'
+    format_version = 2
+
+    fingerprint_query = 'SELECT COUNT(*), MAX(`id`) FROM `{0}`'
+
+    # magic, format version, db version, stamp, time written, payload length, payload crc32
+    header = struct.Struct('<8sIIIdQI')
+
+    def __init__(self, path):
+        self.path = path
+
+        self.last_write_time = 0.0
+        self.last_write_size = 0
+        self.num_writes = 0
+        self.load_time = 0.0
+
+    @classmethod
+    def from_config(cls, snapshot_config, base_path):
+        path = cls.path_from_config(snapshot_config, base_path)
+        return cls(path)
+
+    @staticmethod
+    def path_from_config(snapshot_config, base_path):
+        path = snapshot_config.get('path', 'snapshot.bin')
+        if not os.path.isabs(path):
+            path = os.path.join(base_path, path)
+        return path
+
+    def write(self, cursor, db_version, state, fingerprint):
+        """ Write the snapshot, and stamp it as valid in the database """
+        start = time.time()
+        stamp = random.randint(1, 2 ** 31 - 1)
+        payload = pickle.dumps((fingerprint, state), pickle.HIGHEST_PROTOCOL)
+        header = self.header.pack(self.magic, self.format_version, db_version, stamp, time.time(), len(payload), zlib.crc32(payload))
+
+        # Write to a temporary file first, so a crash never leaves a half-written snapshot behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(header)
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+        cursor.execute('INSERT INTO `tb_idata` (`id`, `value`, `type`) VALUES(%s, %s, %s) ON DUPLICATE KEY UPDATE value=%s',
+                ('snapshot_stamp', stamp, 'value', stamp))
+
+        self.last_write_time = time.time() - start
+        self.last_write_size = len(header) + len(payload)
+        self.num_writes += 1
+
+    @staticmethod
+    def invalidate(cursor):
+        """ Mark any snapshot as out of date. Call this before writing to a table that's stored in the snapshot. """
+        cursor.execute('UPDATE `tb_idata` SET `value`=0 WHERE `id`=%s', ('snapshot_stamp', ))
+
+    @classmethod
+    def fingerprint(cls, cursor, tables):
+        """ Returns the row count and highest id of the given tables """
+        fingerprint = []
+        for table in tables:
+            cursor.execute(cls.fingerprint_query.format(table))
+            count, max_id = cursor.fetchone()
+            fingerprint.append((table, count, max_id))
+        return fingerprint
+
+    def read(self, db_version, stamp, fingerprint):
+        """ Returns the state stored in the snapshot, or None if there's no valid snapshot """
+        start = time.time()
+        try:
+            with open(self.path, 'rb') as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    state = self._read(data, db_version, stamp, fingerprint)
+        except (OSError, ValueError):
+            log.info('No snapshot to load from {0}'.format(self.path))
+            return None
+        except:
+            log.exception('Unable to load snapshot')
+            return None
+
+        self.load_time = time.time() - start
+        if state is not None:
+            log.info('Loaded snapshot in {0:.1f}ms'.format(self.load_time * 1000))
+        return state
+
+    def _read(self, data, db_version, stamp, fingerprint):
+        if len(data) < self.header.size:
+            log.warning('Snapshot is too small')
+            return None
+
+        magic, format_version, snapshot_db_version, snapshot_stamp, written, length, crc = self.header.unpack_from(data)
+        if magic != self.magic or format_version != self.format_version:
+            log.warning('Snapshot has an unknown format')
+            return None
+
+        if snapshot_db_version != db_version or snapshot_stamp != stamp:
+            log.info('Snapshot is out of date, loading from the database')
+            return None
+
+        payload = data[self.header.size:self.header.size + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            log.warning('Snapshot is corrupt')
+            return None
+
+        snapshot_fingerprint, state = pickle.loads(payload)
+        if snapshot_fingerprint != fingerprint:
+            log.info('Snapshot does not match the tables in the database, loading from the database')
+            return None
+
+        log.debug('Loading snapshot written {0:.0f} seconds ago'.format(time.time() - written))
+        return state
+
+    def stats(self):
+        return collections.OrderedDict([
+            ('writes', self.num_writes),
+            ('last_write', '{0:.1f}ms'.format(self.last_write_time * 1000)),
+            ('size', self.last_write_size),
+            ('load_time', '{0:.1f}ms'.format(self.load_time * 1000)),
+            ])
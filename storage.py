@@ -0,0 +1,251 @@
+import contextlib
+import threading
+import collections
+import hashlib
+import datetime
+import sqlite3
+import time
+import re
+
+import logging
+
+from dbpool import ConnectionPool
+from querytrace import QueryTracer
+
+log = logging.getLogger('tyggbot')
+
+
+class MySQLStorage(ConnectionPool):
+    """ MySQL storage, using a pool of connections """
+    dialect = 'mysql'
+
+
+def parse_sqlite_datetime(value):
+    value = value.decode('utf-8')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    return None
+
+sqlite3.register_converter('DATETIME', parse_sqlite_datetime)
+
+
+def sqlite_md5(value):
+    if value is None:
+        return None
+    return hashlib.md5(str(value).encode('utf-8')).hexdigest()
+
+
+def dict_factory(cursor, row):
+    return dict((column[0], value) for column, value in zip(cursor.description, row))
+
+
+class SQLiteCursor:
+    """
+    Cursor on an SQLite connection that accepts the MySQL flavoured SQL the
+    models use, see SQLiteStorage.translate.
+    """
+
+    def __init__(self, storage, conn, cursor):
+        self.storage = storage
+        self.connection = conn
+        self.cursor = cursor
+        self.template = None
+
+    def execute(self, query, args=None):
+        self.storage.num_queries += 1
+        if args is None:
+            args = ()
+        elif not isinstance(args, (tuple, list, dict)):
+            # pymysql accepts a single value as the argument list
+            args = (args, )
+        start = time.perf_counter()
+        try:
+            self.cursor.execute(self.storage.translate(query), args)
+        finally:
+            self.template = self.storage.tracer.record(query, time.perf_counter() - start, self.cursor.rowcount)
+        return self.cursor.rowcount
+
+    def executemany(self, query, args):
+        self.storage.num_queries += 1
+        start = time.perf_counter()
+        try:
+            self.cursor.executemany(self.storage.translate(query), args)
+        finally:
+            self.template = self.storage.tracer.record(query, time.perf_counter() - start, self.cursor.rowcount)
+        return self.cursor.rowcount
+
+    # SQLite doesn't know how many rows a SELECT returns until they're fetched,
+    # so they are counted for the query tracer here instead
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.storage.tracer.add_rows(self.template, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.cursor.fetchmany(size or self.cursor.arraysize)
+        self.storage.tracer.add_rows(self.template, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.storage.tracer.add_rows(self.template, len(rows))
+        return rows
+
+    def close(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SQLiteStorage:
+    """
+    Embedded SQLite storage.
+
+    Every thread gets its own connection to the database file, which is
+    opened in WAL mode so readers don't block the writer.
+    The models are written for MySQL, so queries are translated to
+    SQLite's dialect before they're run.
+    """
+
+    dialect = 'sqlite'
+
+    # Columns that ON DUPLICATE KEY UPDATE refers to, per table
+    unique_keys = {
+            'tb_idata': '`id`',
+            'tb_emote': '`emote_id`',
+            'tb_link_data': '`url_hash`',
+            }
+
+    duplicate_key_re = re.compile(r'\s+ON DUPLICATE KEY UPDATE\s+(.*)$', re.IGNORECASE | re.DOTALL)
+    insert_table_re = re.compile(r'^\s*INSERT\s+INTO\s+`?(\w+)`?', re.IGNORECASE)
+    values_re = re.compile(r'VALUES\(\s*(`?\w+`?)\s*\)', re.IGNORECASE)
+    rand_re = re.compile(r'\bRAND\(\)', re.IGNORECASE)
+
+    def __init__(self, path, busy_timeout=5):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        self.translations = {}
+
+        self.num_connections = 0
+        self.num_queries = 0
+        self.num_transactions = 0
+        self.tracer = QueryTracer()
+
+        # Open a connection right away, so errors show up at startup
+        self._get_connection()
+
+    @classmethod
+    def from_config(cls, sql_config):
+        return cls(sql_config.get('path', 'tyggbot.db'))
+
+    def _get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                    detect_types=sqlite3.PARSE_DECLTYPES)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('MD5', 1, sqlite_md5)
+            self.local.conn = conn
+            self.local.depth = 0
+            self.num_connections += 1
+
+        return conn
+
+    def translate(self, query):
+        """ Translate a MySQL query to SQLite """
+        translated = self.translations.get(query)
+        if translated is not None:
+            return translated
+
+        translated = query.replace('%s', '?')
+        translated = self.rand_re.sub('RANDOM()', translated)
+
+        match = self.duplicate_key_re.search(translated)
+        if match:
+            table = self.insert_table_re.match(translated).group(1)
+            updates = self.values_re.sub(r'excluded.\1', match.group(1))
+            translated = '{0} ON CONFLICT({1}) DO UPDATE SET {2}'.format(translated[:match.start()], self.unique_keys[table], updates)
+
+        self.translations[query] = translated
+        return translated
+
+    def get_cursor(self, cursor_class=None, partition=None):
+        """
+        Returns a cursor. Passing any cursor_class (i.e. pymysql's DictCursor)
+        makes the cursor return rows as dicts.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        if cursor_class is not None:
+            cursor.row_factory = dict_factory
+        return SQLiteCursor(self, conn, cursor)
+
+    @contextlib.contextmanager
+    def cursor(self, cursor_class=None, transaction=False, partition=None):
+        cursor = self.get_cursor(cursor_class)
+        conn = cursor.connection
+
+        # Transactions can't be nested in SQLite, so only the outermost one is real
+        begin = transaction and self.local.depth == 0
+        if transaction:
+            self.local.depth += 1
+        try:
+            if begin:
+                conn.execute('BEGIN IMMEDIATE')
+                self.num_transactions += 1
+            yield cursor
+            if begin:
+                conn.execute('COMMIT')
+        except:
+            if begin:
+                try:
+                    conn.execute('ROLLBACK')
+                except:
+                    log.exception('Caught exception while rolling back')
+            raise
+        finally:
+            if transaction:
+                self.local.depth -= 1
+            cursor.close()
+
+    @contextlib.contextmanager
+    def connection(self, partition=None):
+        yield self._get_connection()
+
+    def stats(self):
+        return collections.OrderedDict([
+            ('path', self.path),
+            ('connections', self.num_connections),
+            ('queries', self.num_queries),
+            ('transactions', self.num_transactions),
+            ])
+
+
+def create_storage(sql_config):
+    """ Create the storage backend given by `type' in the [sql] config section (mysql or sqlite) """
+    storage_type = sql_config.get('type', 'mysql')
+    if storage_type == 'sqlite':
+        return SQLiteStorage.from_config(sql_config)
+    elif storage_type == 'mysql':
+        return MySQLStorage.from_config(sql_config)
+
+    raise ValueError('Unknown storage type: {0}'.format(storage_type))
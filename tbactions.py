@@ -1,13 +1,14 @@
 import re
 import logging
 
-from tyggbot import TyggBot
 from command import Command
 
 log = logging.getLogger('tyggbot')
 
 
 class Substitution:
+    """ cb is the name of the TyggBot method that returns the value """
+
     def __init__(self, cb, key=None, argument=None):
         self.cb = cb
         self.key = key
@@ -122,19 +123,19 @@ class MessageAction(BaseAction):
                 key_value = key[1:]
 
                 if path == 'kvi':
-                    cb = TyggBot.instance.get_kvi_value
+                    cb = 'get_kvi_value'
                 elif path == 'tb':
-                    cb = TyggBot.instance.get_value
+                    cb = 'get_value'
                 elif path == 'lasttweet':
-                    cb = TyggBot.instance.get_last_tweet
+                    cb = 'get_last_tweet'
                 elif path == 'etm':
-                    cb = TyggBot.instance.get_emote_tm
+                    cb = 'get_emote_tm'
                 elif path == 'ecount':
-                    cb = TyggBot.instance.get_emote_count
+                    cb = 'get_emote_count'
                 elif path == 'etmrecord':
-                    cb = TyggBot.instance.get_emote_tm_record
+                    cb = 'get_emote_tm_record'
                 elif path == 'source':
-                    cb = TyggBot.instance.get_source_value
+                    cb = 'get_source_value'
                 else:
                     log.error('Unimplemented path: {0}'.format(path))
                     continue
@@ -171,7 +172,7 @@ class MessageAction(BaseAction):
             else:
                 log.error('Unknown param for response.')
                 continue
-            value = sub.cb(param, extra)
+            value = getattr(tyggbot, sub.cb)(param, extra)
             if value is None:
                 return None
             resp = resp.replace(needle, str(value))
@@ -0,0 +1,171 @@
+import threading
+import time
+import math
+import collections
+
+import logging
+
+log = logging.getLogger('tyggbot')
+
+
+class Timer:
+    """ A handle to a scheduled function, which can be used to cancel it """
+
+    __slots__ = ('wheel', 'expires', 'tick', 'function', 'arguments', 'period', 'cancelled')
+
+    def __init__(self, expires, function, arguments=(), period=None):
+        self.wheel = None
+        self.expires = expires
+        self.tick = None  # None when the timer is not in the wheel
+        self.function = function
+        self.arguments = arguments
+        self.period = period
+        self.cancelled = False
+
+    def cancel(self):
+        if self.wheel is not None:
+            self.wheel.cancel(self)
+        else:
+            self.cancelled = True
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel.
+
+    Level 0 has one slot per `resolution' seconds. Each slot in level N
+    covers a full turn of level N-1, and when the wheel turns over into a
+    slot of a higher level, the timers in it are moved down to the lower
+    levels. This makes scheduling and cancelling timers O(1), no matter how
+    many timers are pending.
+    With the default settings, the levels cover 25.6 seconds, 27 minutes,
+    29 hours and 78 days. Timers further away than that are parked in the
+    last level until they get closer.
+
+    Timers are scheduled from any thread, but only run when advance() is
+    called, which the bot does from the reactor thread.
+    """
+
+    def __init__(self, resolution=0.1, wheel_sizes=(256, 64, 64, 64)):
+        self.resolution = resolution
+        self.wheel_sizes = wheel_sizes
+        self.wheels = [[[] for i in range(size)] for size in wheel_sizes]
+
+        # spans[level] = number of ticks covered by one slot in the given level
+        self.spans = [1]
+        for size in wheel_sizes:
+            self.spans.append(self.spans[-1] * size)
+
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.current_tick = 0
+        self.num_pending = 0
+        self.num_run = 0
+        self.max_lateness = 0.0
+
+    def _tick_for(self, timestamp):
+        return max(int(math.ceil((timestamp - self.start_time) / self.resolution)), self.current_tick + 1)
+
+    def _insert(self, timer):
+        """ Put the timer in the right slot. The lock must be held. """
+        delta = timer.tick - self.current_tick
+        for level, size in enumerate(self.wheel_sizes):
+            if delta < self.spans[level + 1]:
+                tick = timer.tick
+                break
+        else:
+            # Too far away, park it in the last level until it gets closer
+            level = len(self.wheel_sizes) - 1
+            tick = self.current_tick + self.spans[level + 1] - 1
+
+        slot = (tick // self.spans[level]) % self.wheel_sizes[level]
+        self.wheels[level][slot].append(timer)
+
+    def schedule(self, timer):
+        with self.lock:
+            timer.wheel = self
+            timer.tick = self._tick_for(timer.expires)
+            self._insert(timer)
+            self.num_pending += 1
+
+        return timer
+
+    def execute_at(self, at, function, arguments=()):
+        return self.schedule(Timer(at, function, arguments))
+
+    def execute_delayed(self, delay, function, arguments=()):
+        return self.schedule(Timer(time.time() + delay, function, arguments))
+
+    def execute_every(self, period, function, arguments=()):
+        return self.schedule(Timer(time.time() + period, function, arguments, period))
+
+    def cancel(self, timer):
+        with self.lock:
+            timer.cancelled = True
+            if timer.tick is not None:
+                # The timer is still in the wheel, it will be skipped when its slot expires
+                timer.tick = None
+                self.num_pending -= 1
+
+    def _expire_tick(self):
+        """ Turn the wheel one tick and return the timers that expired. The lock must be held. """
+        self.current_tick += 1
+
+        # Move timers down from the higher levels, starting with the highest
+        # level, so timers are moved all the way down in one go.
+        for level in reversed(range(1, len(self.wheel_sizes))):
+            if self.current_tick % self.spans[level] == 0:
+                slot = (self.current_tick // self.spans[level]) % self.wheel_sizes[level]
+                timers = self.wheels[level][slot]
+                self.wheels[level][slot] = []
+                for timer in timers:
+                    if not timer.cancelled:
+                        self._insert(timer)
+
+        slot = self.current_tick % self.wheel_sizes[0]
+        expired = self.wheels[0][slot]
+        self.wheels[0][slot] = []
+        return expired
+
+    def advance(self, now=None):
+        """ Run all timers that have expired by `now' """
+        if now is None:
+            now = time.time()
+
+        target_tick = int((now - self.start_time) / self.resolution)
+        expired = []
+        with self.lock:
+            if self.num_pending == 0:
+                self.current_tick = max(self.current_tick, target_tick)
+                return
+
+            while self.current_tick < target_tick:
+                expired.extend(self._expire_tick())
+
+            expired = [timer for timer in expired if not timer.cancelled]
+            for timer in expired:
+                timer.tick = None
+            self.num_pending -= len(expired)
+
+        for timer in expired:
+            self.max_lateness = max(self.max_lateness, now - timer.expires)
+            self.num_run += 1
+            try:
+                timer.function(*timer.arguments)
+            except:
+                log.exception('Unhandled exception in timer {0}'.format(timer.function))
+
+            if timer.period is not None and not timer.cancelled:
+                # Schedule the next run from when this one should have run, so the timer doesn't drift
+                timer.expires = max(timer.expires + timer.period, now)
+                self.schedule(timer)
+
+    def __len__(self):
+        return self.num_pending
+
+    def stats(self):
+        return collections.OrderedDict([
+            ('pending', self.num_pending),
+            ('run', self.num_run),
+            ('max_lateness', '{0:.0f}ms'.format(self.max_lateness * 1000)),
+            ])
@@ -9,54 +9,45 @@ import subprocess
 
 from datetime import datetime
 
-from helpers import get_chatters, get_subscribers
+from helpers import get_chatters, get_subscribers, get_new_subscribers
 from models.user import UserManager
 from models.emote import EmoteManager
 from models.setting import Setting
-from models.connection import ConnectionManager
-from models.whisperconnection import WhisperConnectionManager
 from models.linkchecker import LinkChecker
 from models.linktracker import LinkTracker
-from scripts.database import update_database
+from models.presence import PresenceManager
+from scripts.database import update_database, latest_db_version
 
 from apiwrappers import TwitchAPI
 
 import pymysql
-import wolframalpha
-import tweepy
 
 from dispatch import Dispatch
 from kvidata import KVIData
 from tbmath import TBMath
-from pytz import timezone
 from tbutil import time_since, tweet_prettify_urls
 
-import irc.client
-
 from command import Filter
-from actions import Action, ActionQueue
+from actions import Action
+from storage import create_storage
+from journal import Journal
+from snapshot import Snapshot
 
 log = logging.getLogger('tyggbot')
 
 
-class TMI:
-    message_limit = 90
-    whispers_message_limit = 3
-    whispers_limit_interval = 3  # in seconds
-
-
 class TyggBot:
     """
-    Main class for the twitch bot
+    Main class for the twitch bot, one instance per channel.
+    The instances are run by a BotHost (see bothost.py).
     """
 
-    """ Singleton instance of TyggBot, one instance of the script
-    should never have two active classes. """
-    instance = None
-
     version = '1.3.0'
     date_fmt = '%H:%M'
     update_chatters_interval = 5
+    reconcile_chatters_interval = 15
+    update_subscribers_interval = 5
+    full_subscribers_sync_interval = 30
 
     default_settings = {
             'broadcaster': 'test_broadcaster',
@@ -68,22 +59,46 @@ class TyggBot:
             'lines_offline': True,
             }
 
+    # Tables read by load_all, which are also stored in snapshots
+    load_queries = {
+            'commands': 'SELECT * FROM `tb_commands`',
+            'filters': 'SELECT * FROM `tb_filters`',
+            'settings': 'SELECT * FROM `tb_settings`',
+            'ignores': 'SELECT * FROM `tb_ignores`',
+            'motd': 'SELECT * FROM `tb_motd` WHERE `enabled`=1',
+            }
+
+    # Tables stored in snapshots, see Snapshot.fingerprint
+    snapshot_tables = ['tb_commands', 'tb_filters', 'tb_settings', 'tb_ignores', 'tb_motd', 'tb_emote']
+
     def parse_args():
         parser = argparse.ArgumentParser()
         parser.add_argument('--config', '-c',
-                            default='config.ini',
+                            action='append',
                             help='Specify which config file to use '
-                                    '(default: config.ini)')
+                                    '(default: config.ini). Pass it once '
+                                    'per channel to run several channels '
+                                    'in one process')
         parser.add_argument('--silent',
                             action='count',
                             help='Decides whether the bot should be '
                             'silent or not')
+        parser.add_argument('--profile-imports',
+                            action='store_true',
+                            help='Log how long each module took to import '
+                            'when the bot has started')
         # TODO: Add a log level argument.
 
-        return parser.parse_args()
+        args = parser.parse_args()
+        if not args.config:
+            args.config = ['config.ini']
+
+        return args
 
     def init_twitter(self):
         try:
+            import tweepy
+
             self.twitter_auth = tweepy.OAuthHandler(self.config['twitter']['consumer_key'], self.config['twitter']['consumer_secret'])
             self.twitter_auth.set_access_token(self.config['twitter']['access_token'], self.config['twitter']['access_token_secret'])
 
@@ -105,6 +120,10 @@ class TyggBot:
 
     def connect_to_twitter_stream(self):
         try:
+            import tweepy
+
+            bot = self
+
             class MyStreamListener(tweepy.StreamListener):
                 relevant_users = [
                     'tyggbar', 'forsensc2', 'pajtest', 'rubarthasdf', 'nymn_hs'
@@ -114,7 +133,7 @@ class TyggBot:
                     if tweet.user.screen_name.lower() in self.relevant_users:
                         if not tweet.text.startswith('RT ') and tweet.in_reply_to_screen_name is None:
                             tw = tweet_prettify_urls(tweet)
-                            TyggBot.instance.say('Volcania New tweet from {0}: {1}'.format(tweet.user.screen_name, tw.replace("\n", " ")))
+                            bot.say('Volcania New tweet from {0}: {1}'.format(tweet.user.screen_name, tw.replace("\n", " ")))
 
                 def on_error(self, status):
                     log.warning('Unhandled in twitter stream: {0}'.format(status))
@@ -123,7 +142,8 @@ class TyggBot:
                 listener = MyStreamListener()
                 self.twitter_stream = tweepy.Stream(self.twitter_auth, listener, retry_420=3 * 60, daemonize_thread=True)
 
-            self.twitter_stream.userstream(_with='followings', replies='all', async=True)
+            # `async' is a keyword since Python 3.7, but older versions of tweepy still call the argument that
+            self.twitter_stream.userstream(_with='followings', replies='all', **{'async': True})
         except:
             log.exception('Exception caught while trying to connect to the twitter stream')
 
@@ -154,15 +174,15 @@ class TyggBot:
         else:
             self.phrases = default_phrases
 
-    def __init__(self, config, args):
+    def __init__(self, config, args, host):
         self.config = config
+        self.host = host
         self.nickname = config['main']['nickname']
         self.password = config['main']['password']
         self.default_settings['broadcaster'] = config['main']['streamer']
 
         try:
-            self.sqlconn = pymysql.connect(unix_socket=config['sql']['unix_socket'], user=config['sql']['user'], passwd=config['sql']['passwd'], charset='utf8mb4')
-            self.sqlconn.select_db(config['sql']['db'])
+            self.db = create_storage(config['sql'])
         except pymysql.err.OperationalError as e:
             error_code, error_message = e.args
             if error_code == 1045:
@@ -173,16 +193,18 @@ class TyggBot:
                 log.error(e)
             sys.exit(1)
 
-        self.sqlconn.autocommit(True)
-
-        update_database(self.sqlconn)
+        update_database(self.db)
 
         self.load_default_phrases()
 
-        self.reactor = irc.client.Reactor()
-        self.connection_manager = ConnectionManager(self.reactor, self, TMI.message_limit)
+        # Timers, connections and worker threads are shared with the other channels in this process
+        self.timers = host.timers
+        self.connector = host.connector
+        self.connection_manager = host.connection_manager
+        self.action_queue = host.action_queue
+        self.mainthread_queue = host.mainthread_queue
 
-        self.twitchapi = TwitchAPI(type='api')
+        self.twitchapi = host.twitchapi
         if 'twitchapi' in self.config:
             client_id = None
             oauth = None
@@ -194,16 +216,11 @@ class TyggBot:
         else:
             self.krakenapi = False
 
-        self.reactor.add_global_handler('all_events', self._dispatcher, -10)
-
         if 'wolfram' in config['main']:
-            Dispatch.wolfram = wolframalpha.Client(config['main']['wolfram'])
+            import wolframalpha
+            self.wolfram = wolframalpha.Client(config['main']['wolfram'])
         else:
-            Dispatch.wolfram = None
-
-        self.whisper_manager = None
-
-        TyggBot.instance = self
+            self.wolfram = None
 
         self.is_online = False
         self.ascii_timeout_duration = 120
@@ -218,6 +235,16 @@ class TyggBot:
         self.data_cb['time_norway'] = self.c_time_norway
         self.data_cb['bot_uptime'] = self.c_uptime
         self.data_cb['time_since_latest_deck'] = self.c_time_since_latest_deck
+        self.stats_cb = dict(host.stats_cb)
+        self.stats_cb['db'] = self.db.stats
+        self.stats_cb['queries'] = self.db.tracer.stats
+
+        # Log the query templates that take the most time, every `trace_log_interval' seconds
+        trace_log_interval = 3600
+        if 'trace_log_interval' in self.config['sql']:
+            trace_log_interval = int(self.config['sql']['trace_log_interval'])
+        if trace_log_interval > 0:
+            self.execute_every(trace_log_interval, self.db.tracer.log_summary)
         self.ignores = []
 
         self.start_time = datetime.now()
@@ -229,13 +256,45 @@ class TyggBot:
             self.channel = config['main']['target']
             self.streamer = self.channel[1:]
 
-        self.kvi = KVIData(self.sqlconn)
+        self.kvi = KVIData(self.db)
         self.tbm = TBMath()
         self.last_sync = time.time()
 
-        self.users = UserManager(self.sqlconn)
-        self.emotes = EmoteManager(self.sqlconn)
-        self.emotes.load()
+        """
+        Counter increments are written to a journal on disk as they happen,
+        so they survive a crash even if the bot syncs to the database rarely.
+        """
+        self.journal = None
+        self.sync_interval = 10 * 60
+        if 'journal' in config:
+            self.journal = Journal.from_config(config['journal'], self.base_path)
+            self.stats_cb['journal'] = self.journal.stats
+            if 'sync_interval' in config['journal']:
+                self.sync_interval = int(config['journal']['sync_interval'])
+
+        """
+        The state of the bot is saved to a snapshot on quit and every `interval' seconds.
+        If the database hasn't changed since, the bot starts up from the snapshot.
+        """
+        self.snapshot = None
+        snapshot_state = None
+        if 'snapshot' in config:
+            self.snapshot = Snapshot.from_config(config['snapshot'], self.base_path)
+            self.stats_cb['snapshot'] = self.snapshot.stats
+            with self.db.cursor() as cursor:
+                fingerprint = Snapshot.fingerprint(cursor, self.snapshot_tables)
+            snapshot_state = self.snapshot.read(latest_db_version, int(self.kvi.get('snapshot_stamp')), fingerprint)
+            self.max_snapshot_users = int(config['snapshot'].get('max_users', 5000))
+            self.execute_every(int(config['snapshot'].get('interval', 600)), self.save_snapshot)
+
+        self.users = UserManager(self.db, self.journal)
+        self.emotes = EmoteManager(self.db, self.journal)
+        if snapshot_state:
+            self.users.load_rows(snapshot_state['users'])
+            self.emotes.load(snapshot_state['emotes'])
+            self.restore_emote_windows(snapshot_state['emote_windows'])
+        else:
+            self.emotes.load()
 
         self.silent = False
         self.dev = False
@@ -267,10 +326,11 @@ class TyggBot:
         self.motd_messages = []
         self.execute_every(60, self.motd_tick)
 
-        self.load_all()
-
-        self.whisper_manager = WhisperConnectionManager(self.reactor, self, self.streamer, TMI.whispers_message_limit, TMI.whispers_limit_interval)
-        self.whisper_manager.start(accounts=[{'username': self.nickname, 'oauth': self.password}])
+        if snapshot_state:
+            self.load_all(snapshot_state['rows'])
+            self.restore_cooldowns(snapshot_state['cooldowns'])
+        else:
+            self.load_all()
 
         self.num_offlines = 0
         if self.krakenapi:
@@ -288,71 +348,108 @@ class TyggBot:
             self.init_websocket_server()
             self.execute_every(1, self.refresh_emote_data)
 
-        # Actions in this queue are run in a separate thread.
-        # This means actions should NOT access any database-related stuff.
-        self.action_queue = ActionQueue()
-        self.action_queue.start()
+        # The link checker is set up by the first channel, its link lists are stored in that channel's database
+        if host.link_checker is None:
+            host.link_checker = LinkChecker(self)
+        self.link_checker = host.link_checker
+        self.stats_cb['linkchecker'] = self.link_checker.cache.stats
+        self.stats_cb['linkchecker_http'] = self.link_checker.http.stats
+        if self.link_checker.safeBrowsingAPI:
+            self.stats_cb['safebrowsing'] = self.link_checker.safeBrowsingAPI.stats
+        if snapshot_state:
+            self.link_checker.cache.restore(snapshot_state['link_verdicts'])
+        self.link_tracker = LinkTracker(self.db)
+
+        if self.journal:
+            self.replay_journal()
 
         """
-        For actions that need to access the main thread,
-        we can use the mainthread_queue.
+        Users in chat are tracked from JOIN/PART messages.
+        Minutes in chat and points are credited every `update_chatters_interval' minutes,
+        and users who join are loaded from the database every few seconds.
         """
-        self.mainthread_queue = ActionQueue()
-        self.execute_every(1, self.mainthread_queue.parse_action)
-
-        self.link_checker = LinkChecker(self, self.execute_delayed)
-        self.link_tracker = LinkTracker(self.sqlconn)
+        self.presence = PresenceManager(self.users)
+        self.execute_every(self.update_chatters_interval * 60, self.presence_tick)
+        self.execute_every(5, self.presence.preload)
 
         """
-        Update chatters every `update_chatters_interval' minutes.
-        By default, this is set to run every 5 minutes.
+        Reconcile the users in chat with the chatters list every `reconcile_chatters_interval' minutes.
+        By default, this is set to run every 15 minutes.
         """
-        self.execute_every(self.update_chatters_interval * 60,
+        self.execute_every(self.reconcile_chatters_interval * 60,
                            self.action_queue.add,
-                           (self.update_chatters_stage1, ))
+                           (self.update_chatters_stage1, [], {}, 'low'))
 
+        """
+        Check for new subscribers every `update_subscribers_interval' minutes,
+        and do a full sync of all subscribers every `full_subscribers_sync_interval' minutes.
+        """
+        self.subscribers = None  # Set of subscribers as of the last sync
+        self.last_full_subscribers_sync = 0
         try:
             if self.krakenapi and self.config['twitchapi']['update_subscribers'] == '1':
-                self.execute_every(30 * 60,
-                                   self.action_queue.add,
-                                   (self.update_subscribers_stage1, ))
+                self.execute_every(self.update_subscribers_interval * 60, self.update_subscribers)
         except:
             pass
 
-    def update_subscribers_stage1(self):
-        subscribers = get_subscribers(self.krakenapi, self.streamer)
-        if len(subscribers) > 0:
-            self.mainthread_queue.add(self.update_subscribers_stage2,
-                                      args=[subscribers])
-
-    def update_subscribers_stage2(self, subscribers):
-        self.kvi.insert('active_subs', len(subscribers) - 1)
+    def update_subscribers(self):
+        """
+        Decide between a full and a partial sync of the subscribers here on the main thread.
+        The action queue runs actions concurrently, so stage 1 only gets a copy of the subscribers.
+        """
+        if self.subscribers is None or time.time() - self.last_full_subscribers_sync >= self.full_subscribers_sync_interval * 60:
+            self.action_queue.add(self.update_subscribers_stage1, args=[None], lane='low')
+        else:
+            self.action_queue.add(self.update_subscribers_stage1, args=[frozenset(self.subscribers)], lane='low')
+
+    def update_subscribers_stage1(self, known_subscribers):
+        """ known_subscribers: the subscribers as of the last sync, or None for a full sync """
+        if known_subscribers is None:
+            subscribers = get_subscribers(self.krakenapi, self.streamer)
+            if len(subscribers) > 0:
+                self.mainthread_queue.add(self.update_subscribers_stage2,
+                                          args=[subscribers])
+        else:
+            new_subscribers = get_new_subscribers(self.krakenapi, self.streamer, known_subscribers)
+            if len(new_subscribers) > 0:
+                self.mainthread_queue.add(self.update_subscribers_stage2,
+                                          args=[new_subscribers],
+                                          kwargs={'full_sync': False})
+
+    def update_subscribers_stage2(self, subscribers, full_sync=True):
+        if full_sync:
+            self.last_full_subscribers_sync = time.time()
+            self.subscribers = set(subscribers)
+
+            for username, user in self.users.items():
+                if user.subscriber and username not in self.subscribers:
+                    user.subscriber = False
+                    user.needs_sync = True
+        else:
+            self.subscribers.update(subscribers)
 
-        for username, user in self.users.items():
-            if user.subscriber:
-                user.subscriber = False
-                user.needs_sync = True
+        self.kvi.insert('active_subs', len(self.subscribers) - 1)
 
         for subscriber in subscribers:
             user = self.users[subscriber]
-            user.subscriber = True
-            user.needs_sync = True
+            if not user.subscriber:
+                user.subscriber = True
+                user.needs_sync = True
 
     def update_chatters_stage1(self):
+        fetched_at = time.time()
         chatters = get_chatters(self.streamer)
-        if len(chatters) > 0:
-            self.mainthread_queue.add(self.update_chatters_stage2, args=[chatters])
+        if chatters is None:
+            return
 
-    def update_chatters_stage2(self, chatters):
-        points = 1 if self.is_online else 0
+        self.mainthread_queue.add(self.update_chatters_stage2, args=[chatters, fetched_at])
 
-        for chatter in chatters:
-            user = self.users[chatter]
-            if self.is_online:
-                user.minutes_in_chat_online += self.update_chatters_interval
-            else:
-                user.minutes_in_chat_offline += self.update_chatters_interval
-            user.touch(points * (5 if user.subscriber else 1))
+    def update_chatters_stage2(self, chatters, fetched_at):
+        """ chatters: the full chatters list, fetched at `fetched_at' """
+        self.presence.reconcile(chatters, fetched_at)
+
+    def presence_tick(self):
+        self.presence.accrue(self.is_online)
 
     def motd_tick(self):
         if len(self.motd_messages) == 0:
@@ -376,7 +473,20 @@ class TyggBot:
         if not self.krakenapi:
             return
 
-        data = self.krakenapi.get(['streams', self.streamer])
+        # The stream status decides how strict the moderation is, so it gets priority
+        self.action_queue.add(self.refresh_stream_status_stage1, lane='high')
+
+    def refresh_stream_status_stage1(self):
+        try:
+            data = self.krakenapi.get(['streams', self.streamer])
+        except:
+            log.exception('Caught exception while fetching stream status')
+            return
+
+        if data:
+            self.mainthread_queue.add(self.refresh_stream_status_stage2, args=[data])
+
+    def refresh_stream_status_stage2(self, data):
         if data:
             try:
                 status = 'stream' in data and data['stream'] is not None
@@ -427,24 +537,26 @@ class TyggBot:
         from autobahn.twisted.websocket import WebSocketServerFactory, \
                 WebSocketServerProtocol
 
+        bot = self
+
         class MyServerProtocol(WebSocketServerProtocol):
             def onConnect(self, request):
                 log.info('Client connecting: {0}'.format(request.peer))
 
             def onOpen(self):
                 log.info('WebSocket connection open. {0}'.format(self))
-                TyggBot.instance.ws_clients.append(self)
+                bot.ws_clients.append(self)
 
             def onMessage(self, payload, isBinary):
                 if isBinary:
                     log.info('Binary message received: {0} bytes'.format(len(payload)))
                 else:
-                    TyggBot.instance.me('Recieved message: {0}'.format(payload.decode('utf8')))
+                    bot.me('Recieved message: {0}'.format(payload.decode('utf8')))
                     log.info('Text message received: {0}'.format(payload.decode('utf8')))
 
             def onClose(self, wasClean, code, reason):
                 log.info('WebSocket connection closed: {0}'.format(reason))
-                TyggBot.instance.ws_clients.remove(self)
+                bot.ws_clients.remove(self)
 
         factory = WebSocketServerFactory()
         factory.protocol = MyServerProtocol
@@ -462,16 +574,6 @@ class TyggBot:
 
         self.ws_factory = factory
 
-    def _dispatcher(self, connection, event):
-        if connection == self.connection_manager.get_main_conn() or connection in self.whisper_manager:
-            do_nothing = lambda c, e: None
-            method = getattr(self, "on_" + event.type, do_nothing)
-            method(connection, event)
-
-    def start(self):
-        """Start the IRC client."""
-        self.reactor.process_forever()
-
     def get_kvi_value(self, key, extra={}):
         return self.kvi.get(key)
 
@@ -531,12 +633,12 @@ class TyggBot:
         return None
 
     def get_cursor(self):
-        self.sqlconn.ping()
-        return self.sqlconn.cursor()
+        """ Returns a cursor from the connection pool. Close it when you're done! """
+        return self.db.get_cursor()
 
     def get_dictcursor(self):
-        self.sqlconn.ping()
-        return self.sqlconn.cursor(pymysql.cursors.DictCursor)
+        """ Returns a dict cursor from the connection pool. Close it when you're done! """
+        return self.db.get_cursor(pymysql.cursors.DictCursor)
 
     def reload(self):
         self.sync_to()
@@ -552,6 +654,7 @@ class TyggBot:
             log.exception('Exception caught while sending privmsg')
 
     def c_time_norway(self):
+        from pytz import timezone
         return datetime.now(timezone('Europe/Oslo')).strftime(TyggBot.date_fmt)
 
     def c_uptime(self):
@@ -581,13 +684,13 @@ class TyggBot:
         self.privmsg('.ban {0}'.format(username))
 
     def execute_at(self, at, function, arguments=()):
-        self.reactor.execute_at(at, function, arguments)
+        return self.timers.execute_at(at, function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
-        self.reactor.execute_delayed(delay, function, arguments)
+        return self.timers.execute_delayed(delay, function, arguments)
 
     def execute_every(self, period, function, arguments=()):
-        self.reactor.execute_every(period, function, arguments)
+        return self.timers.execute_every(period, function, arguments)
 
     def ban(self, username):
         self._timeout(username, 30)
@@ -614,8 +717,8 @@ class TyggBot:
             self.execute_delayed(1, self._timeout, (user.username, duration))
 
     def whisper(self, username, message):
-        if self.whisper_manager:
-            self.whisper_manager.whisper(username, message)
+        if self.host.whisper_manager:
+            self.host.whisper_manager.whisper(username, message)
         else:
             log.debug('No whisper conn set up.')
 
@@ -646,50 +749,155 @@ class TyggBot:
                 self.privmsg('.me ' + message[:500], channel)
 
     def sync_to(self):
-        self.sqlconn.ping()
-        self.sqlconn.autocommit(False)
-        cursor = self.sqlconn.cursor()
-
         log.debug('Syncing data from TyggBot to the database...')
 
-        self.users.sync()
+        if self.journal:
+            # Everything journaled up to now is included in this sync
+            journal_generation = self.journal.rotate()
 
-        for trigger, command in self.commands.items():
-            if not command.synced:
-                command.sync(cursor)
-                command.synced = True
+        # Everything is synced in one transaction
+        with self.db.cursor(transaction=True) as cursor:
+            self.users.sync(cursor)
 
-        for filter in self.filters:
-            if not filter.synced:
-                filter.sync(cursor)
-                filter.synced = True
+            for trigger, command in self.commands.items():
+                if not command.synced:
+                    command.sync(cursor)
+                    command.synced = True
 
-        self.emotes.sync()
+            for filter in self.filters:
+                if not filter.synced:
+                    filter.sync(cursor)
+                    filter.synced = True
 
-        self.link_tracker.sync()
+            self.emotes.sync(cursor)
 
-        self.sqlconn.commit()
-        self.sqlconn.autocommit(True)
-        cursor.close()
+            self.link_tracker.sync(cursor)
 
-    def load_all(self):
-        self._load_commands()
-        self._load_filters()
-        self._load_settings()
-        self._load_ignores()
-        self._load_motd()
+            if self.snapshot:
+                # The snapshot doesn't match the database anymore
+                self.snapshot.invalidate(cursor)
 
-    def _load_commands(self):
-        cursor = self.sqlconn.cursor(pymysql.cursors.DictCursor)
+            if self.journal:
+                self.journal.mark_synced(cursor, journal_generation)
 
-        from command import Command
+        if self.journal:
+            self.journal.truncate(journal_generation)
 
-        cursor.execute('SELECT * FROM `tb_commands`')
+    def invalidate_snapshot(self):
+        """ Call this before writing to a table that's stored in the snapshot, outside of sync_to """
+        if self.snapshot:
+            with self.db.cursor() as cursor:
+                self.snapshot.invalidate(cursor)
+
+    def save_snapshot(self):
+        """ Sync to the database, and write a snapshot of the current state """
+        self.sync_to()
+
+        now = time.time()
+        state = {
+                'rows': dict((name, self._fetch_rows(name)) for name in self.load_queries),
+                'users': self.users.get_hot_rows(self.max_snapshot_users),
+                'emotes': [emote.get_row() for emote in self.emotes.all() if emote.id != -1],
+                'emote_windows': dict((emote.journal_key, emote.tm) for emote in self.emotes.all() if emote.tm > 0),
+                'cooldowns': {},
+                'link_verdicts': self.link_checker.cache.dump(),
+                }
+
+        for command in set(self.commands.values()):
+            if command.id == -1:
+                continue
+
+            last_run_by_user = dict((username, last_run) for username, last_run in command.last_run_by_user.items() if now - last_run < command.delay_user)
+            if now - command.last_run < command.delay_all or len(last_run_by_user) > 0:
+                state['cooldowns'][command.id] = (command.last_run, last_run_by_user)
+
+        try:
+            with self.db.cursor() as cursor:
+                fingerprint = Snapshot.fingerprint(cursor, self.snapshot_tables)
+                self.snapshot.write(cursor, latest_db_version, state, fingerprint)
+            log.debug('Wrote snapshot in {0:.1f}ms'.format(self.snapshot.last_write_time * 1000))
+        except:
+            log.exception('Unable to write snapshot')
+
+    def restore_cooldowns(self, cooldowns):
+        for command in set(self.commands.values()):
+            if command.id in cooldowns:
+                command.last_run, command.last_run_by_user = cooldowns[command.id]
+
+    def restore_emote_windows(self, emote_windows):
+        """ Restore how many times emotes have been used in the last minute, and let them expire as usual """
+        for key, tm in emote_windows.items():
+            emote = self.emotes.data.get(key[0] if isinstance(key, tuple) else key)
+            if emote is not None:
+                emote.tm = tm
+                self.execute_delayed(60, emote.reduce, (tm, ))
+
+    def replay_journal(self):
+        """ Apply the counter increments from the journal that were never synced to the database """
+        num_replayed = self.journal.replay(int(self.kvi.get('journal_generation')), self.apply_journal_record)
+        if num_replayed > 0:
+            log.info('Replayed {0} counter increments from the journal'.format(num_replayed))
+            self.sync_to()
+
+    def apply_journal_record(self, kind, key, field, delta):
+        if kind in ('command', 'filter') and key == -1:
+            # Not in the database, so there's no telling which command or filter this was (older journals have these)
+            return
+
+        if kind == 'user':
+            obj = self.users[key]
+        elif kind == 'emote':
+            if isinstance(key, list):
+                emote_id, code = key
+                obj = self.emotes[emote_id]
+                if obj.code is None and code is not None:
+                    obj.code = code
+                    if code not in self.emotes:
+                        self.emotes[code] = obj
+            else:
+                obj = self.emotes.data.get(key)
+        elif kind == 'command':
+            obj = next((command for command in self.commands.values() if command.id == key), None)
+        elif kind == 'filter':
+            obj = next((filter for filter in self.filters if filter.id == key), None)
+        else:
+            obj = None
+
+        if obj is None:
+            log.warning('Unable to find the {0} {1} from the journal'.format(kind, key))
+            return
+
+        setattr(obj, field, getattr(obj, field) + delta)
+        if kind in ('command', 'filter'):
+            obj.synced = False
+        else:
+            obj.needs_sync = True
+
+    def load_all(self, rows=None):
+        """ Load everything from the database, or from `rows' (i.e. from a snapshot) if given """
+        if rows is None:
+            rows = {}
+        self._load_commands(rows.get('commands'))
+        self._load_filters(rows.get('filters'))
+        self._load_settings(rows.get('settings'))
+        self._load_ignores(rows.get('ignores'))
+        self._load_motd(rows.get('motd'))
+
+    def _fetch_rows(self, name):
+        with self.db.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(self.load_queries[name])
+            return cursor.fetchall()
+
+    def _load_commands(self, rows=None):
+        if rows is None:
+            rows = self._fetch_rows('commands')
+
+        from command import Command
 
         self.commands = {}
 
         self.commands['reload'] = Command.admin_command(self.reload)
-        self.commands['quit'] = Command.admin_command(self.quit)
+        self.commands['quit'] = Command.admin_command(self.host.quit)
         self.commands['ignore'] = Command.admin_command(Dispatch.ignore, type='func')
         self.commands['unignore'] = Command.admin_command(Dispatch.unignore, type='func')
         self.commands['add'] = Command()
@@ -719,7 +927,7 @@ class TyggBot:
         self.commands['debug'].load_from_db({
             'id': -1,
             'level': 250,
-            'action': '{ "type":"multi", "default":"nothing", "args": [ { "level":250, "command":"command", "action": { "type":"func", "cb":"debug_command" } }, { "level":250, "command":"user", "action": { "type":"func", "cb":"debug_user" } }, { "level":250, "command":"nothing", "action": { "type":"say", "message":"" } } ] }',
+            'action': '{ "type":"multi", "default":"nothing", "args": [ { "level":250, "command":"command", "action": { "type":"func", "cb":"debug_command" } }, { "level":250, "command":"user", "action": { "type":"func", "cb":"debug_user" } }, { "level":1000, "command":"stats", "action": { "type":"func", "cb":"debug_stats" } }, { "level":250, "command":"nothing", "action": { "type":"say", "message":"" } } ] }',
             'do_sync': False,
             'delay_all': 0,
             'delay_user': 1,
@@ -731,10 +939,11 @@ class TyggBot:
         num_commands = 0
         num_aliases = 0
 
-        for row in cursor:
+        for row in rows:
             try:
                 cmd = Command()
                 cmd.load_from_db(row)
+                cmd.journal = self.journal
 
                 if cmd.is_enabled():
                     for alias in row['command'].split('|'):
@@ -750,20 +959,19 @@ class TyggBot:
                 continue
 
         log.debug('Loaded {0} commands ({1} aliases)'.format(num_commands, num_aliases))
-        cursor.close()
 
-    def _load_filters(self):
-        cursor = self.sqlconn.cursor(pymysql.cursors.DictCursor)
-
-        cursor.execute('SELECT * FROM `tb_filters`')
+    def _load_filters(self, rows=None):
+        if rows is None:
+            rows = self._fetch_rows('filters')
 
         self.filters = []
 
         num_filters = 0
 
-        for row in cursor:
+        for row in rows:
             try:
                 filter = Filter(row)
+                filter.journal = self.journal
 
                 if filter.is_enabled():
                     self.filters.append(filter)
@@ -773,16 +981,14 @@ class TyggBot:
                 continue
 
         log.debug('Loaded {0} filters'.format(num_filters))
-        cursor.close()
-
-    def _load_settings(self):
-        cursor = self.sqlconn.cursor(pymysql.cursors.DictCursor)
 
-        cursor.execute('SELECT * FROM `tb_settings`')
+    def _load_settings(self, rows=None):
+        if rows is None:
+            rows = self._fetch_rows('settings')
 
         self.settings = {}
 
-        for row in cursor:
+        for row in rows:
             self.settings[row['setting']] = Setting.parse(row['type'], row['value'])
             if self.settings[row['setting']] is None:
                 log.error('ERROR LOADING SETTING {0}'.format(row['setting']))
@@ -791,50 +997,24 @@ class TyggBot:
             if setting not in self.settings:
                 self.settings[setting] = self.default_settings[setting]
 
-        cursor.close()
-
-    def _load_ignores(self):
-        cursor = self.sqlconn.cursor(pymysql.cursors.DictCursor)
-
-        cursor.execute('SELECT * FROM `tb_ignores`')
+    def _load_ignores(self, rows=None):
+        if rows is None:
+            rows = self._fetch_rows('ignores')
 
         self.ignores = []
 
-        for row in cursor:
+        for row in rows:
             self.ignores.append(row['username'])
 
-        cursor.close()
-
-    def _load_motd(self):
-        cursor = self.sqlconn.cursor(pymysql.cursors.DictCursor)
-
-        cursor.execute('SELECT * FROM `tb_motd` WHERE `enabled`=1')
+    def _load_motd(self, rows=None):
+        if rows is None:
+            rows = self._fetch_rows('motd')
 
         self.motd_messages = []
 
-        for row in cursor:
+        for row in rows:
             self.motd_messages.append(row['message'])
 
-        cursor.close()
-
-    def on_welcome(self, chatconn, event):
-        if chatconn in self.whisper_manager:
-            log.debug('Connected to Whisper server.')
-        else:
-            log.debug('Connected to IRC server.')
-
-    def connect(self):
-        return self.connection_manager.start()
-
-    def on_disconnect(self, chatconn, event):
-        if chatconn in self.whisper_manager:
-            log.debug('Disconnecting from Whisper server')
-            self.whisper_manager.on_disconnect(chatconn)
-
-        else:
-            log.debug('Disconnected from IRC server')
-            self.connection_manager.on_disconnect(chatconn)
-
     def check_msg_content(self, source, msg_raw, event):
         msg_lower = msg_raw.lower()
 
@@ -871,13 +1051,13 @@ class TyggBot:
                         emote_indices = emote_occurrence.split(',')
                         emote_count = len(emote_indices)
                         emote = self.emotes[int(emote_id)]
-                        emote.add(emote_count, self.reactor)
                         if emote.id == -1 and emote.code is None:
                             # The emote we just detected is new, set its code.
                             first_index, last_index = emote_indices[0].split('-')
                             emote.code = msg_raw[int(first_index):int(last_index) + 1]
                             if emote.code not in self.emotes:
                                 self.emotes[emote.code] = emote
+                        emote.add(emote_count, self.timers)
                     except:
                         log.exception('Exception caught while splitting emote data')
             elif tag['key'] == 'display-name' and tag['value']:
@@ -889,7 +1069,7 @@ class TyggBot:
         for emote in self.emotes.custom_data:
             num = len(emote.regex.findall(msg_raw))
             if num > 0:
-                emote.add(num, self.reactor)
+                emote.add(num, self.timers)
 
         if source is None and not event:
             log.error('No nick or event passed to parse_message')
@@ -908,10 +1088,11 @@ class TyggBot:
                 self.link_tracker.add(url)
 
                 if source.level < 500:
-                    # Action which will be taken when a bad link is found
-                    action = Action(self.timeout, args=[source.username, 20])
+                    # Action which will be taken when a bad link is found.
+                    # Links are checked on worker threads, so the timeout is passed on to the main thread.
+                    action = Action(self.mainthread_queue.add, args=[self.timeout], kwargs={'args': [source.username, 20]})
                     # Queue up a check on the URL
-                    self.action_queue.add(self.link_checker.check_url, args=[url, action])
+                    self.link_checker.queue_url(url, action, source.level)
 
             # TODO: Change to if source.ignored
             if source.username in self.ignores:
@@ -931,6 +1112,19 @@ class TyggBot:
 
         source.wrote_message(not whisper and (self.is_online or self.settings['lines_offline']))
 
+    def on_join(self, chatconn, event):
+        if event.target == self.channel:
+            self.presence.join(event.source.nick)
+
+    def on_part(self, chatconn, event):
+        if event.target == self.channel:
+            self.presence.part(event.source.nick)
+
+    def on_namreply(self, chatconn, event):
+        # arguments: channel type, channel, space-separated list of names
+        if event.arguments[1] == self.channel:
+            self.presence.names(event.arguments[2].split())
+
     def on_whisper(self, chatconn, event):
         # We use .lower() in case twitch ever starts sending non-lowercased usernames
         source = self.users[event.source.user.lower()]
@@ -971,14 +1165,30 @@ class TyggBot:
                     self.whisper(source.username, 'You have been timed out for {0} seconds because your message was too long.'.format(self.msg_length_timeout_duration))
                     return
 
-        if cur_time - self.last_sync >= 10 * 60:
+        if cur_time - self.last_sync >= self.sync_interval:
             self.sync_to()
             self.last_sync = cur_time
 
         self.parse_message(event.arguments[0], source, event, tags=event.tags)
 
+    def say_welcome(self):
+        if self.phrases['welcome']:
+            phrase_data = {
+                    'nickname': self.nickname,
+                    'version': self.version,
+                    }
+
+            self.say(self.phrases['welcome'].format(**phrase_data))
+
     def quit(self):
-        self.sync_to()
+        """ Tear down this channel. The whole process is stopped with BotHost.quit, which calls this for every channel """
+        if self.snapshot:
+            self.save_snapshot()
+        else:
+            self.sync_to()
+        self.db.tracer.log_summary()
+        if self.journal:
+            self.journal.close()
         if self.phrases['quit']:
             phrase_data = {
                     'nickname': self.nickname,
@@ -992,8 +1202,3 @@ class TyggBot:
 
         if self.twitter_stream:
             self.twitter_stream.disconnect()
-
-        if self.whisper_manager:
-            self.whisper_manager.quit()
-
-        sys.exit(0)